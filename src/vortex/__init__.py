@@ -32,6 +32,7 @@ ec2-instance-metadata.html
 from __future__ import absolute_import, print_function, unicode_literals
 
 import logging
+import sys
 import vortex.logsetup
 
 # NB important side-effect: this import runs pre-requisite checks.
@@ -63,3 +64,127 @@ def stage2():
     # get started
     from vortex.runtime import runtime
     runtime.run()
+
+
+def gc():
+    """
+    Entry point to collect garbage from Vortex's caches without performing a
+    deployment run.
+
+    This may be used as the bootstrap entry point (``vortex:gc``), or run as
+    ``python -m vortex gc``. See :mod:`vortex.housekeeping`.
+    """
+    vortex.logsetup.configure(None)
+    check_modules(install=True)
+
+    from vortex.config import cfg
+    from vortex.housekeeping import collect_garbage
+    vortex.logsetup.configure(cfg)
+    collect_garbage()
+
+
+def run_agent():
+    """
+    Entry point to run Vortex as a long-running agent, periodically
+    re-converging the instance. See :mod:`vortex.agent`.
+
+    This may be used as the bootstrap entry point (``vortex:run_agent``), or
+    run as ``python -m vortex agent``.
+    """
+    vortex.logsetup.configure(None)
+    check_modules(install=True)
+
+    from vortex.agent import Agent
+    from vortex.config import cfg
+    vortex.logsetup.configure(cfg)
+    Agent().run()
+
+
+def prepare():
+    """
+    Entry point to prepare a machine image, acquiring payloads into the
+    persistent caches and downloading packages without deploying anything.
+    Exits with status 1 if any payload could not be prepared. See
+    :mod:`vortex.prebake`.
+
+    This may be used as the bootstrap entry point (``vortex:prepare``), or run
+    as ``python -m vortex prepare``.
+    """
+    vortex.logsetup.configure(None)
+    check_modules(install=True)
+
+    from vortex.config import cfg
+    from vortex.prebake import prepare
+    vortex.logsetup.configure(cfg)
+    if not prepare():
+        sys.exit(1)
+
+
+def finalize():
+    """
+    Entry point to deploy an instance booted from an image prepared with
+    :func:`prepare`, fetching only what has changed since. See
+    :mod:`vortex.prebake`.
+
+    This may be used as the bootstrap entry point (``vortex:finalize``), or run
+    as ``python -m vortex finalize``.
+    """
+    vortex.logsetup.configure(None)
+    check_modules(install=True)
+
+    from vortex.config import cfg
+    from vortex.prebake import finalize
+    vortex.logsetup.configure(cfg)
+    finalize()
+
+
+def rollback(*payloads):
+    """
+    Entry point to switch the named payloads (or, if none are named, every
+    payload with a ``release_dir``) back to their previous releases. Exits
+    with status 1 if any of them could not be rolled back. The run lock (see
+    :mod:`vortex.runlock`) is held throughout, so that a rollback cannot
+    overlap a deployment. See :mod:`vortex.release`.
+
+    This is run as ``python -m vortex rollback [payload...]``.
+    """
+    vortex.logsetup.configure(None)
+    check_modules(install=True)
+
+    from vortex.config import cfg
+    from vortex.payload import Payload
+    from vortex.release import ReleaseError
+    from vortex.runlock import RunLock
+    vortex.logsetup.configure(cfg)
+
+    configured = Payload.configured_payloads()
+    unknown = set(payloads) - set(payload.name for payload in configured)
+    for name in sorted(unknown):
+        logger.warning("Ignoring unknown payload {name}".format(name=name))
+
+    failed = False
+    with RunLock().exclusive():
+        for payload in configured:
+            if payload.name in payloads or \
+                    (not payloads and payload.releases is not None):
+                try:
+                    payload.rollback()
+                except ReleaseError as e:
+                    logger.error(
+                        "Cannot roll back payload {name}: {e}".format(
+                            name=payload.name, e=e))
+                    failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+def notify(*payloads):
+    """
+    Entry point to tell a running agent that the named payloads (or, if none
+    are named, any payloads) have changed. See :mod:`vortex.trigger`.
+
+    This is run as ``python -m vortex notify [payload...]``.
+    """
+    from vortex.trigger import notify
+    notify(list(payloads))
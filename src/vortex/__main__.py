@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Command-line interface to the Vortex entry points, for use as
+``python -m vortex <command>``.
+
+The following commands are available:
+
+``run``
+   Perform a deployment run (:func:`vortex.stage2`). This is the default.
+
+``gc``
+   Collect garbage from Vortex's caches (:func:`vortex.gc`).
+
+``agent``
+   Run as a long-running agent (:func:`vortex.run_agent`).
+
+``prepare``
+   Prepare a machine image (:func:`vortex.prepare`).
+
+``finalize``
+   Deploy an instance booted from a prepared image (:func:`vortex.finalize`).
+
+``rollback [payload...]``
+   Switch payloads back to their previous releases (:func:`vortex.rollback`).
+
+``notify [payload...]``
+   Tell a running agent that payloads have changed (:func:`vortex.notify`).
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+import vortex
+
+#: Map of command names to entry point functions
+COMMANDS = {
+    'agent': vortex.run_agent,
+    'finalize': vortex.finalize,
+    'gc': vortex.gc,
+    'notify': vortex.notify,
+    'prepare': vortex.prepare,
+    'rollback': vortex.rollback,
+    'run': vortex.stage2,
+}
+
+#: Commands whose entry points take further arguments (payload names)
+TAKES_ARGS = frozenset(['notify', 'rollback'])
+
+
+def main(argv):
+    """
+    Run the entry point named by the first argument in `argv` (excluding the
+    program name), passing it any further arguments if it takes them, and
+    return an exit status.
+    """
+    command = argv[0] if argv else 'run'
+    args = argv[1:]
+
+    entry = COMMANDS.get(command)
+    if entry is None or (args and command not in TAKES_ARGS):
+        print("Usage: python -m vortex [{commands}] [payload...]".format(
+            commands='|'.join(sorted(COMMANDS))), file=sys.stderr)
+        return 2
+
+    entry(*args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -25,9 +25,22 @@ tarball from a web server.
 from __future__ import absolute_import, print_function, unicode_literals
 
 import abc
+import hashlib
+import json
+import logging
+import os.path
+import shutil
 import six
 
+from vortex.cache import Cache
 from vortex.compat import import_module
+from vortex.config import cfg
+from vortex.state import StateFile
+from vortex.throttle import BandwidthLimit, acquisition_bucket
+from vortex.utils import copy_tree
+
+
+logger = logging.getLogger(__name__)
 
 
 class AcquisitionError(Exception):
@@ -43,9 +56,27 @@ class Acquirer(object):
 
     Various factory methods are provided in order to register and locate
     concrete sub-classes.
+
+    The following configuration option is *optional* for every acquisition
+    method:
+
+        ``bandwidth`` = ``0``
+           The maximum download rate for this payload, in KiB/s. Zero means
+           no limit (other than ``[runtime].bandwidth``). See
+           :class:`vortex.throttle.BandwidthLimit`; acquirers enforce the
+           limit through their :attr:`bandwidth` attribute.
     """
     __registered = {}
 
+    #: Configuration options which don't affect what is acquired, and so are
+    #: ignored when computing :class:`CachingAcquirer` keys.
+    cache_ignore = frozenset(['bandwidth', 'timeout'])
+
+    #: The revision (in the form returned by :meth:`resolve_revision`) which
+    #: the last call to :meth:`acquire_into` actually acquired, or ``None`` if
+    #: it isn't known. Sub-classes set this when they can.
+    acquired_revision = None
+
     @classmethod
     def factory(cls, method, section):
         """
@@ -63,7 +94,9 @@ class Acquirer(object):
 
         The located class is then instantiated with the given `section` passed
         to the constructor as its only argument. The resulting object is
-        returned.
+        wrapped in a :class:`ThrottledAcquirer` and then, unless the
+        acquisition cache is disabled, in a :class:`CachingAcquirer`. The
+        resulting object is returned.
         """
         # Turn the method name into a module name
         if '.' in method:
@@ -72,7 +105,12 @@ class Acquirer(object):
             module = 'vortex.acquirer.' + method
 
         klass = cls.__locate(module)
-        acquirer = klass(section)
+        acquirer = ThrottledAcquirer(klass(section))
+
+        for (option, value) in six.iteritems(CachingAcquirer.defaults):
+            cfg.set_default('acquirer', option, value)
+        if cfg.getboolean('acquirer', 'cache'):
+            acquirer = CachingAcquirer(acquirer, method)
 
         return acquirer
 
@@ -129,6 +167,14 @@ class Acquirer(object):
         self.section = section
         self.configure()
 
+        rate = cfg.get(section, 'bandwidth') \
+            if cfg.has_option(section, 'bandwidth') else '0'
+        try:
+            self.bandwidth = BandwidthLimit(rate)
+        except ValueError:
+            raise AcquisitionError("{sec}: invalid bandwidth: {rate}".format(
+                sec=section, rate=rate))
+
     @abc.abstractmethod
     def configure(self):
         """
@@ -156,3 +202,187 @@ class Acquirer(object):
         .. note:: This is an *abstract method* and **must** be implemented by
             sub-classes.
         """
+
+    def resolve_revision(self):
+        """
+        Return a string identifying exactly what :meth:`acquire_into` would
+        acquire, or ``None`` if that can't be determined cheaply.
+
+        The string is used (together with the acquisition method and
+        configuration) as the key for the acquisition cache, so it must change
+        whenever the acquired content would; for example a Git commit ID or an
+        archive checksum. Returning ``None`` bypasses the cache.
+
+        The default implementation returns ``None``.
+        """
+        return None
+
+
+class ThrottledAcquirer(object):
+    """
+    Wrapper around an :class:`Acquirer` which takes a token from the
+    acquisition rate limit (see :func:`vortex.throttle.acquisition_bucket`)
+    before each acquisition or revision lookup, and reports the throughput of
+    each acquisition (see :class:`vortex.throttle.BandwidthLimit`). The most
+    recent figures for each payload are kept in the ``transfers.json`` state
+    file. Attributes not defined here are looked up on the wrapped acquirer.
+    """
+    def __init__(self, acquirer):
+        super(ThrottledAcquirer, self).__init__()
+        self.acquirer = acquirer
+
+    def __getattr__(self, name):
+        return getattr(self.acquirer, name)
+
+    def __wait(self, what):
+        # Take a token from the acquisition rate limit
+        waited = acquisition_bucket().consume()
+        if waited > 0:
+            logger.info("{sec}: {what} delayed {t:.1f}s by rate limit".format(
+                sec=self.acquirer.section, what=what, t=waited))
+
+    def resolve_revision(self):
+        """
+        Return the wrapped acquirer's revision, once the rate limit allows.
+        In agent mode, this is the request made of every payload source on
+        every cycle.
+
+        See :meth:`Acquirer.resolve_revision`.
+        """
+        self.__wait('revision lookup')
+        return self.acquirer.resolve_revision()
+
+    def acquire_into(self, directory):
+        """
+        Acquire the payload into the given directory, once the rate limit
+        allows.
+
+        See :meth:`Acquirer.acquire_into`.
+        """
+        self.__wait('acquisition')
+
+        self.acquirer.bandwidth.reset()
+        self.acquirer.acquire_into(directory)
+
+        report = self.acquirer.bandwidth.report()
+        if not report['bytes']:
+            return
+
+        logger.info(
+            "{sec}: transferred {bytes} bytes in {seconds:.1f}s "
+            "({kib:.0f} KiB/s, {delayed:.1f}s delayed by bandwidth limits)"
+            .format(sec=self.acquirer.section, kib=report['rate'] / 1024.0,
+                    **report))
+
+        transfers = StateFile('transfers.json')
+        transfers.data[self.acquirer.section] = report
+        transfers.save()
+
+
+class CachingAcquirer(object):
+    """
+    Wrapper around an :class:`Acquirer` which keeps copies of acquired
+    payloads in the ``acquired`` cache (see :class:`vortex.cache.Cache`).
+
+    If the wrapped acquirer's :meth:`Acquirer.resolve_revision` returns a
+    revision which has been acquired before with the same configuration, the
+    payload is copied from the cache (using reflinks where possible, see
+    :func:`vortex.utils.copy_tree`) and the acquirer is not used at all.
+    Otherwise the acquirer is used as normal, and the result copied into the
+    cache. Attributes not defined here are looked up on the wrapped acquirer.
+
+    The following configuration options are *optional*:
+
+    ``[acquirer].cache`` = ``yes``
+       Whether to use the acquisition cache.
+
+    ``[acquirer].cache_size`` = ``2048``
+       Size budget of the acquisition cache, in MiB. After an acquisition is
+       cached, the least recently used entries are removed until the cache
+       fits within its budget.
+    """
+    #: Default values for the ``[acquirer]`` configuration section
+    defaults = {
+        'cache': 'yes',
+        'cache_size': '2048',
+    }
+
+    def __init__(self, acquirer, method):
+        super(CachingAcquirer, self).__init__()
+        self.acquirer = acquirer
+        self.method = method
+        self.cache = Cache('acquired')
+
+        try:
+            self.budget = int(cfg.get('acquirer', 'cache_size')) * 1024 * 1024
+        except ValueError:
+            raise AcquisitionError("Invalid [acquirer].cache_size: {s}".format(
+                s=cfg.get('acquirer', 'cache_size')))
+
+    def __getattr__(self, name):
+        return getattr(self.acquirer, name)
+
+    def resolve_revision(self):
+        """
+        Return the wrapped acquirer's revision. It is only resolved once per
+        :class:`CachingAcquirer`.
+
+        See :meth:`Acquirer.resolve_revision`.
+        """
+        try:
+            return self.__revision
+        except AttributeError:
+            self.__revision = self.acquirer.resolve_revision()
+            return self.__revision
+
+    def cache_key(self, revision):
+        """
+        Return the cache key for the given `revision` of the payload.
+        """
+        options = dict(
+            (option, value)
+            for (option, value) in cfg.items(self.acquirer.section)
+            if option not in self.acquirer.cache_ignore)
+        document = json.dumps({
+            'method': self.method,
+            'options': options,
+            'revision': revision,
+        }, sort_keys=True)
+        return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+    def acquire_into(self, directory):
+        """
+        Acquire the payload into the given directory, from the cache if
+        possible.
+
+        See :meth:`Acquirer.acquire_into`.
+        """
+        revision = self.resolve_revision()
+        if revision is None:
+            return self.acquirer.acquire_into(directory)
+
+        # Whether or not the cache is used, the payload is the revision it is
+        # keyed by
+        self.acquired_revision = revision
+
+        key = self.cache_key(revision)
+        entry = self.cache.entry_path(key)
+
+        if os.path.isdir(entry):
+            try:
+                copy_tree(entry, directory)
+                self.cache.touch(key)
+                logger.info(
+                    "{sec}: revision {rev} found in acquisition cache".format(
+                        sec=self.acquirer.section, rev=revision))
+                return
+            except (IOError, OSError) as e:
+                logger.warning(
+                    "{sec}: cannot copy from acquisition cache: {e}".format(
+                        sec=self.acquirer.section, e=e))
+                shutil.rmtree(directory, ignore_errors=True)
+
+        self.acquirer.acquire_into(directory)
+
+        if self.cache.write_tree(key, directory):
+            self.cache.trim(self.budget)
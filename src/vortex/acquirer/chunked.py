@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import posixpath
+import re
+import six
+
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import urlopen
+
+from vortex.acquirer import Acquirer, AcquisitionError
+from vortex.cache import Cache
+from vortex.chunks import INDEX_VERSION, chunk_path
+from vortex.config import cfg
+from vortex.throttle import READ_SIZE
+from vortex.utils import is_within, parse_timeout, run_concurrently
+
+
+logger = logging.getLogger(__name__)
+
+
+@Acquirer.register
+class ChunkedAcquirer(Acquirer):
+    """
+    Payload acquisition from a chunk index and chunk store.
+
+    The payload is described by an index listing its files, each of which is
+    made up of content-defined chunks kept in a chunk store (see
+    :mod:`vortex.chunks`). Chunks are kept locally in the ``chunks`` cache
+    (see :class:`vortex.cache.Cache`), so acquiring a new version of a payload
+    only downloads the chunks that have changed since a previous version was
+    acquired.
+
+    The following configuration options are *required*:
+
+        ``index``
+           Location of the index. This may be an ``http``, ``https`` or
+           ``file`` URL, or a local path.
+
+    The following configuration options are *optional*:
+
+        ``store``
+           Location of the chunk store, as a URL or local path. By default,
+           this is the ``chunks`` directory alongside the index.
+
+        ``sha256``
+           The expected SHA-256 checksum of the index, as a hex string. Each
+           chunk is always verified against its own checksum, both when it is
+           downloaded and when it is read back from the local store.
+
+        ``workers`` = ``8``
+           The number of chunks to fetch at once.
+
+        ``timeout`` = ``300``
+           The number of seconds to wait for a server to respond before the
+           acquisition fails. Zero means no timeout.
+    """
+    #: Options which don't affect what is acquired
+    cache_ignore = Acquirer.cache_ignore | frozenset(['workers'])
+
+    #: Matches a chunk digest
+    DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+    def configure(self):
+        """
+        Configure this acquirer based on settings from the vortex
+        configuration.
+
+        See :meth:`vortex.acquirer.Acquirer.configure`.
+        """
+        required = [
+            'index',
+        ]
+        defaults = {
+            'sha256': '',
+            'store': '',
+            'timeout': '300',
+            'workers': '8',
+        }
+
+        # Validate the configuration and absorb the values into this object
+        cfg.absorb(self, self.section, required, defaults)
+
+        self.sha256 = self.sha256.lower()
+        if not self.store:
+            self.store = posixpath.join(
+                posixpath.dirname(self.index), 'chunks')
+
+        try:
+            self.workers = max(1, int(self.workers))
+        except ValueError:
+            raise AcquisitionError("{sec}: invalid workers: {w}".format(
+                sec=self.section, w=self.workers))
+
+        try:
+            self.timeout = parse_timeout(self.timeout)
+        except ValueError:
+            raise AcquisitionError("{sec}: invalid timeout: {t}".format(
+                sec=self.section, t=self.timeout))
+
+    def _read(self, location):
+        # Read the whole of a URL or local file
+        if not urlparse(location).scheme:
+            try:
+                with io.open(location, 'rb') as fp:
+                    return fp.read()
+            except (IOError, OSError) as e:
+                raise AcquisitionError("Cannot read {loc}: {e}".format(
+                    loc=location, e=e))
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            with contextlib.closing(urlopen(location, **kwargs)) as response:
+                blocks = []
+                for data in iter(lambda: response.read(READ_SIZE), b''):
+                    self.bandwidth.consume(len(data))
+                    blocks.append(data)
+                return b''.join(blocks)
+        except HTTPError as e:
+            raise AcquisitionError(
+                "Failed to download {loc}: HTTP {code} {msg}".format(
+                    loc=location, code=e.code, msg=e.msg))
+        except (URLError, IOError, OSError) as e:
+            raise AcquisitionError("Failed to download {loc}: {e}".format(
+                loc=location, e=getattr(e, 'reason', e)))
+
+    def _load_index(self):
+        # Fetch, verify and parse the index
+        data = self._read(self.index)
+
+        if self.sha256:
+            digest = hashlib.sha256(data).hexdigest()
+            if digest != self.sha256:
+                raise AcquisitionError(
+                    "Checksum mismatch for {loc}: expected {exp}, got {got}"
+                    .format(loc=self.index, exp=self.sha256, got=digest))
+
+        try:
+            index = json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            raise AcquisitionError("Invalid index {loc}: {e}".format(
+                loc=self.index, e=e))
+
+        if not isinstance(index, dict) or \
+                index.get('version') != INDEX_VERSION:
+            raise AcquisitionError(
+                "Unsupported index format: {loc}".format(loc=self.index))
+
+        # Chunk digests are used as paths in the local store, so must be
+        # exactly what they claim to be
+        entries = index.get('entries')
+        if not isinstance(entries, list):
+            raise AcquisitionError(
+                "Invalid index {loc}: no entries".format(loc=self.index))
+        for entry in entries:
+            chunks = entry.get('chunks', []) if isinstance(entry, dict) \
+                else None
+            if not isinstance(chunks, list) or not all(
+                    isinstance(digest, six.string_types) and
+                    self.DIGEST_RE.match(digest) for digest in chunks):
+                raise AcquisitionError(
+                    "Invalid chunk digest in index {loc}".format(
+                        loc=self.index))
+
+        return entries
+
+    def _fetch_chunk(self, cache, digest):
+        # Download a chunk into the local store, verifying its checksum
+        data = self._read(self.store.rstrip('/') + '/' + chunk_path(digest))
+
+        got = hashlib.sha256(data).hexdigest()
+        if got != digest:
+            raise AcquisitionError(
+                "Checksum mismatch for chunk {digest} (got {got})".format(
+                    digest=digest, got=got))
+
+        if not cache.write(digest, data):
+            raise AcquisitionError(
+                "Cannot store chunk {digest} in {path}".format(
+                    digest=digest, path=cache.path))
+
+        return len(data)
+
+    def _fetch_missing(self, cache, entries):
+        # Download all chunks used by the index that aren't stored locally
+        wanted = set()
+        for entry in entries:
+            if entry['type'] == 'file':
+                wanted.update(entry['chunks'])
+
+        missing = sorted(
+            digest for digest in wanted
+            if not os.path.isfile(cache.entry_path(digest)))
+
+        logger.info(
+            "{section}: {have} of {total} chunks stored locally, fetching "
+            "{n}".format(section=self.section, have=len(wanted) - len(missing),
+                         total=len(wanted), n=len(missing)))
+
+        sizes = run_concurrently(
+            [(lambda d=digest: self._fetch_chunk(cache, d))
+             for digest in missing], self.workers)
+
+        logger.info("{section}: downloaded {n} bytes".format(
+            section=self.section, n=sum(sizes)))
+
+    @staticmethod
+    def _safe_path(directory, path):
+        # Resolve an index path, refusing any that lead outside the directory,
+        # whether directly or through a symlink created earlier
+        norm = os.path.normpath(path)
+        if os.path.isabs(norm) or norm == '..' or norm.startswith('../'):
+            raise AcquisitionError(
+                "Refusing unsafe path in index: {path}".format(path=path))
+
+        full = os.path.join(directory, norm)
+        if not is_within(os.path.dirname(full), directory):
+            raise AcquisitionError(
+                "Refusing path through a symlink in index: {path}".format(
+                    path=path))
+        return full
+
+    @staticmethod
+    def _read_chunk(cache, digest):
+        # Read a chunk from the local store, verifying its checksum
+        data = cache.read(digest)
+        if data is None:
+            raise AcquisitionError(
+                "Chunk {digest} missing from {path}".format(
+                    digest=digest, path=cache.path))
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            cache.remove(digest)
+            raise AcquisitionError(
+                "Corrupt chunk {digest} removed from {path}".format(
+                    digest=digest, path=cache.path))
+
+        return data
+
+    def _assemble(self, cache, entries, directory):
+        # Build the payload tree from the index and the local chunk store
+        dir_modes = []
+
+        for entry in entries:
+            path = self._safe_path(directory, entry['path'])
+
+            if entry['type'] == 'dir':
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                dir_modes.append((path, entry['mode']))
+            elif entry['type'] == 'symlink':
+                target = entry['target']
+                if os.path.isabs(target) or not is_within(
+                        os.path.join(os.path.dirname(path), target),
+                        directory):
+                    raise AcquisitionError(
+                        "Refusing unsafe symlink in index: {path}".format(
+                            path=entry['path']))
+                os.symlink(target, path)
+            elif entry['type'] == 'file':
+                with io.open(path, 'wb') as fp:
+                    for digest in entry['chunks']:
+                        fp.write(self._read_chunk(cache, digest))
+                os.chmod(path, entry['mode'])
+            else:
+                raise AcquisitionError(
+                    "Unknown index entry type: {type}".format(
+                        type=entry['type']))
+
+        # Directory permissions are set last, in case any are read-only
+        for (path, mode) in reversed(dir_modes):
+            os.chmod(path, mode)
+
+    def resolve_revision(self):
+        """
+        Return the configured checksum of the index, if any.
+
+        See :meth:`vortex.acquirer.Acquirer.resolve_revision`.
+        """
+        return self.sha256 or None
+
+    def acquire_into(self, directory):
+        """
+        Perform the resource acquisition into the given directory.
+
+        See :meth:`vortex.acquirer.Acquirer.acquire_into`.
+        """
+        logger.info("Acquiring chunked payload {index} into {dir}".format(
+            index=self.index, dir=directory))
+
+        cache = Cache('chunks')
+        entries = self._load_index()
+        self._fetch_missing(cache, entries)
+
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        try:
+            self._assemble(cache, entries, directory)
+        except (IOError, OSError, KeyError) as e:
+            raise AcquisitionError(
+                "Failed to assemble payload from {index}: {e}".format(
+                    index=self.index, e=e))
+
+        self.acquired_revision = self.sha256 or None
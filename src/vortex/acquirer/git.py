@@ -18,13 +18,19 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import contextlib
+import hashlib
 import logging
 import os
 import os.path
+import re
+import shutil
 
 from vortex.acquirer import Acquirer, AcquisitionError
+from vortex.cache import Cache, disk_usage
 from vortex.config import cfg
-from vortex.environment import install_package, runcmd
+from vortex.environment import (
+    CommandTimeout, decode_line, install_package, runcmd)
+from vortex.utils import parse_timeout
 
 
 logger = logging.getLogger(__name__)
@@ -50,6 +56,23 @@ class GitAcquirer(Acquirer):
            branch name, tag name, ref name, commit ID or anything else
            understood by ``git checkout``. Note that in many cases, the
            resulting payload may end up on a "detached HEAD".
+
+        ``timeout`` = ``0``
+           The number of seconds each Git command is allowed to run for before
+           it is killed and the acquisition fails. Zero means no timeout.
+
+        ``mirror`` = ``no``
+           Whether to keep a bare mirror of the repository in the ``mirrors``
+           cache (see :class:`vortex.cache.Cache`). The revision is fetched
+           into the mirror, so that only the objects which are new since the
+           last acquisition are downloaded, and the payload is then fetched
+           from the mirror. This is particularly useful in machine images
+           prepared with :func:`vortex.prepare`.
+
+    Bandwidth limits (see :class:`vortex.acquirer.Acquirer`) are enforced by
+    running ``git fetch`` under trickle_, if it is installed.
+
+    .. _trickle: https://github.com/mariusae/trickle
     """
     #: Path to the git binary
     GIT = '/usr/bin/git'
@@ -58,6 +81,18 @@ class GitAcquirer(Acquirer):
     #: :func:`vortex.environment.install_package` if Git needs installing.
     GIT_PKG = 'git'
 
+    #: Path to the trickle binary, used to limit the bandwidth of fetches
+    TRICKLE = '/usr/bin/trickle'
+
+    #: Matches a full commit ID
+    COMMIT_RE = re.compile(r'^[0-9a-f]{40}$')
+
+    #: The mirror is just a faster route to the same content
+    cache_ignore = Acquirer.cache_ignore | frozenset(['mirror'])
+
+    #: The result of the last :meth:`resolve_revision` call
+    __resolved = None
+
     def __init__(self, section):
         super(GitAcquirer, self).__init__(section)
         self.__check_installed()
@@ -86,11 +121,20 @@ class GitAcquirer(Acquirer):
             'repository',
         ]
         defaults = {
+            'mirror': 'no',
             'revision': 'HEAD',
+            'timeout': '0',
         }
 
         # Validate the configuration and absorb the values into this object
         cfg.absorb(self, self.section, required, defaults)
+        self.mirror = cfg.getboolean(self.section, 'mirror')
+
+        try:
+            self.timeout = parse_timeout(self.timeout)
+        except ValueError:
+            raise AcquisitionError("{sec}: invalid timeout: {t}".format(
+                sec=self.section, t=self.timeout))
 
     @contextlib.contextmanager
     def __git_helper(self, cwd):
@@ -98,9 +142,18 @@ class GitAcquirer(Acquirer):
         # this context manager. It just returns a function that can mangle the
         # arguments and call runcmd() for us, then check that everything went
         # OK.
-        def git_wrapper(*args):
-            command = [self.GIT] + list(args)
-            (ret, out) = runcmd(command, cwd=cwd)
+        def git_wrapper(*args, **kwargs):
+            command = kwargs.get('prefix', []) + [self.GIT] + list(args)
+            try:
+                (ret, out) = runcmd(
+                    command, cwd=cwd, stream=True, context=self.section,
+                    timeout=self.timeout)
+            except CommandTimeout as e:
+                raise AcquisitionError(
+                    "Timed out after {elapsed:.1f}s acquiring Git repo {repo}"
+                    .format(elapsed=e.elapsed, repo=self.repository),
+                    e.output)
+
             if ret == 0:
                 return
 
@@ -109,6 +162,50 @@ class GitAcquirer(Acquirer):
 
         yield git_wrapper
 
+    def __transport(self):
+        # Return a command prefix which limits the bandwidth of a Git command
+        limit = self.bandwidth.limit
+        if not limit:
+            return []
+
+        if not os.path.isfile(self.TRICKLE):
+            logger.warning(
+                "{sec}: cannot limit bandwidth; {trickle} is not installed"
+                .format(sec=self.section, trickle=self.TRICKLE))
+            return []
+
+        return [self.TRICKLE, '-s', '-d', str(max(1, int(limit // 1024)))]
+
+    def resolve_revision(self):
+        """
+        Return the commit ID(s) the configured revision currently refers to,
+        using ``git ls-remote``.
+
+        See :meth:`vortex.acquirer.Acquirer.resolve_revision`.
+        """
+        if self.COMMIT_RE.match(self.revision):
+            return self.revision
+
+        try:
+            (ret, out) = runcmd(
+                [self.GIT, 'ls-remote', self.repository, self.revision],
+                timeout=self.timeout)
+        except CommandTimeout:
+            return None
+
+        if ret != 0:
+            return None
+
+        # Several refs may match (e.g. a branch and a tag); they all take part
+        # in the result so that it changes if any of them moves. Anything
+        # else (such as warnings on standard error) is ignored.
+        lines = [decode_line(line) for line in out.splitlines()]
+        refs = sorted(
+            line.replace('\t', ' ') for line in lines
+            if self.COMMIT_RE.match(line[:40]) and line[40:41] == '\t')
+        self.__resolved = ';'.join(refs) or None
+        return self.__resolved
+
     def acquire_into(self, directory):
         """
         Perform the resource acquisition into the given directory.
@@ -121,8 +218,66 @@ class GitAcquirer(Acquirer):
         if not os.path.exists(directory):
             os.mkdir(directory)
 
+        source = self.__update_mirror() if self.mirror else None
+
         with self.__git_helper(directory) as git:
             git('init')
             git('remote', 'add', 'origin', self.repository)
-            git('fetch', 'origin', self.revision)
+            if source is None:
+                git('fetch', 'origin', self.revision,
+                    prefix=self.__transport())
+            else:
+                git('fetch', source[0], source[1])
             git('checkout', 'FETCH_HEAD')
+
+        # HEAD is detached, so holds the ID of the commit just checked out.
+        # If the revision was resolved to that commit beforehand, record it in
+        # the same form, so that it can be compared with later resolutions.
+        with open(os.path.join(directory, '.git', 'HEAD')) as fp:
+            commit = fp.read().strip()
+        resolved = self.__resolved
+        if resolved is not None and \
+                commit in [ref[:40] for ref in resolved.split(';')]:
+            self.acquired_revision = resolved
+        else:
+            self.acquired_revision = commit
+
+        # The fetched objects are (near enough) what was transferred
+        if source is None:
+            self.bandwidth.record(
+                disk_usage(os.path.join(directory, '.git', 'objects')))
+
+    def __update_mirror(self):
+        # Fetch the revision into a bare mirror of the repository, returning
+        # the mirror's path and the ref the revision was stored under. Each
+        # revision is kept under a ref of its own so that later fetches need
+        # only download new objects.
+        cache = Cache('mirrors')
+        key = hashlib.sha256(self.repository.encode('utf-8')).hexdigest()
+        path = cache.entry_path(key)
+        ref = 'refs/vortex/' + hashlib.sha256(
+            self.revision.encode('utf-8')).hexdigest()[:16]
+
+        created = not os.path.isdir(path)
+        if created:
+            logger.info("Creating mirror of {repo} in {path}".format(
+                repo=self.repository, path=path))
+            if not os.path.isdir(cache.path):
+                os.makedirs(cache.path, 0o700)
+            with self.__git_helper(cache.path) as git:
+                git('init', '--quiet', '--bare', key)
+
+        before = disk_usage(path)
+        try:
+            with self.__git_helper(path) as git:
+                git('fetch', self.repository,
+                    '+{rev}:{ref}'.format(rev=self.revision, ref=ref),
+                    prefix=self.__transport())
+        except AcquisitionError:
+            if created:
+                shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        cache.touch(key)
+        self.bandwidth.record(max(0, disk_usage(path) - before))
+        return (path, ref)
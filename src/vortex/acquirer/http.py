@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import shutil
+import six
+
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import Request, urlopen
+
+from vortex.acquirer import Acquirer, AcquisitionError
+from vortex.archive import (
+    ArchiveError, HashingReader, detect_compression, extract_stream)
+from vortex.cache import Cache
+from vortex.config import cfg
+from vortex.utils import copy_tree, parse_timeout
+
+
+logger = logging.getLogger(__name__)
+
+
+@Acquirer.register
+class HttpAcquirer(Acquirer):
+    """
+    Payload acquisition by downloading a tarball over HTTP(S).
+
+    The archive is decompressed and unpacked as it is downloaded, so it is
+    never stored on disk as a whole. This makes it well suited to payloads
+    published as build artifacts, which are much quicker to fetch this way
+    than by cloning and checking out a Git repository.
+
+    The following configuration options are *required*:
+
+        ``url``
+           URL of the tarball to download. ``http``, ``https`` and ``file``
+           URLs are supported.
+
+    The following configuration options are *optional*:
+
+        ``sha256``
+           The expected SHA-256 checksum of the tarball, as a hex string. The
+           checksum is calculated as the tarball is downloaded; if it does not
+           match, the acquisition fails and the payload directory is removed.
+
+        ``format``
+           The compression format of the tarball: one of ``gz``, ``xz``,
+           ``zst`` or ``none``. By default this is determined from the URL.
+
+        ``cache`` = ``yes``
+           Whether to keep a copy of the unpacked tarball in the ``http``
+           cache (see :class:`vortex.cache.Cache`). When a cached copy exists,
+           the tarball is only downloaded again if the server reports that it
+           has changed (using the ``ETag`` and ``Last-Modified`` headers it
+           sent last time). If a ``sha256`` is configured and matches the
+           cached copy, the server is not contacted at all. Because of this,
+           the generic acquisition cache (see
+           :class:`vortex.acquirer.CachingAcquirer`) is not used for tarballs.
+
+        ``timeout`` = ``300``
+           The number of seconds to wait for the server to respond before the
+           acquisition fails. Zero means no timeout.
+    """
+    #: Name of the file recording the cached tarball's metadata
+    CACHE_META = 'meta.json'
+
+    #: Name of the directory holding the cached tarball's contents
+    CACHE_TREE = 'tree'
+
+    def configure(self):
+        """
+        Configure this acquirer based on settings from the vortex
+        configuration.
+
+        See :meth:`vortex.acquirer.Acquirer.configure`.
+        """
+        required = [
+            'url',
+        ]
+        defaults = {
+            'cache': 'yes',
+            'format': '',
+            'sha256': '',
+            'timeout': '300',
+        }
+
+        # Validate the configuration and absorb the values into this object
+        cfg.absorb(self, self.section, required, defaults)
+
+        self.cache = cfg.getboolean(self.section, 'cache')
+        self.sha256 = self.sha256.lower()
+
+        if not self.format:
+            self.format = detect_compression(urlparse(self.url).path)
+        if self.format is None:
+            raise AcquisitionError(
+                "{sec}: cannot determine archive format of {url}".format(
+                    sec=self.section, url=self.url))
+
+        try:
+            self.timeout = parse_timeout(self.timeout)
+        except ValueError:
+            raise AcquisitionError("{sec}: invalid timeout: {t}".format(
+                sec=self.section, t=self.timeout))
+
+    @property
+    def cache_key(self):
+        """
+        The key of this tarball's entry in the ``http`` cache.
+        """
+        return hashlib.sha256(self.url.encode('utf-8')).hexdigest()
+
+    def __read_meta(self, entry):
+        # Return the metadata of a complete cache entry, or None
+        try:
+            with io.open(os.path.join(entry, self.CACHE_META), 'r',
+                         encoding='utf-8') as fp:
+                meta = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not os.path.isdir(os.path.join(entry, self.CACHE_TREE)):
+            return None
+
+        return meta
+
+    def __store(self, cache, directory, meta):
+        # Copy a freshly unpacked tarball into the cache. The copy is built
+        # alongside the entry and renamed into place.
+        entry = cache.entry_path(self.cache_key)
+        tmp = "{entry}.{pid}.tmp".format(entry=entry, pid=os.getpid())
+
+        try:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp, 0o700)
+            copy_tree(directory, os.path.join(tmp, self.CACHE_TREE))
+            with io.open(os.path.join(tmp, self.CACHE_META), 'w',
+                         encoding='utf-8') as fp:
+                fp.write(six.text_type(json.dumps(meta, sort_keys=True)))
+
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        except (IOError, OSError) as e:
+            logger.debug("Cannot cache {url}: {e}".format(url=self.url, e=e))
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def __restore(self, cache, directory):
+        # Copy the cached tarball contents into the payload directory
+        entry = cache.entry_path(self.cache_key)
+        copy_tree(os.path.join(entry, self.CACHE_TREE), directory)
+        cache.touch(self.cache_key)
+
+    def __request(self, meta):
+        # Build the (possibly conditional) request for the tarball
+        request = Request(self.url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        return request
+
+    def __open(self, meta):
+        # Open the URL, returning None if the server says it hasn't changed
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            return urlopen(self.__request(meta), **kwargs)
+        except HTTPError as e:
+            if e.code == 304 and meta is not None:
+                return None
+            raise AcquisitionError(
+                "Failed to download {url}: HTTP {code} {msg}".format(
+                    url=self.url, code=e.code, msg=e.msg))
+        except (URLError, IOError, OSError) as e:
+            raise AcquisitionError("Failed to download {url}: {e}".format(
+                url=self.url, e=getattr(e, 'reason', e)))
+
+    def __download(self, response, directory):
+        # Stream the response into the directory, verifying its checksum
+        reader = HashingReader(response, throttle=self.bandwidth)
+
+        try:
+            extract_stream(reader, directory, self.format)
+            reader.drain()
+        except ArchiveError as e:
+            raise AcquisitionError("Failed to unpack {url}: {e}".format(
+                url=self.url, e=e))
+        except (IOError, OSError) as e:
+            raise AcquisitionError("Failed to download {url}: {e}".format(
+                url=self.url, e=e))
+
+        digest = reader.hexdigest()
+        if self.sha256 and digest != self.sha256:
+            raise AcquisitionError(
+                "Checksum mismatch for {url}: expected {exp}, got {got}"
+                .format(url=self.url, exp=self.sha256, got=digest))
+
+        logger.info("Downloaded {n} bytes from {url}".format(
+            n=reader.count, url=self.url))
+
+        return digest
+
+    def acquire_into(self, directory):
+        """
+        Perform the resource acquisition into the given directory.
+
+        See :meth:`vortex.acquirer.Acquirer.acquire_into`.
+        """
+        logger.info("Acquiring tarball {url} into {dir}".format(
+            url=self.url, dir=directory))
+
+        cache = Cache('http') if self.cache else None
+        meta = None
+        if cache is not None:
+            meta = self.__read_meta(cache.entry_path(self.cache_key))
+
+        # A matching checksum means the cached copy is exactly what we want
+        if meta is not None and self.sha256 and \
+                meta.get('sha256') == self.sha256:
+            logger.info("Using cached copy of {url}".format(url=self.url))
+            self.__restore(cache, directory)
+            return
+
+        # A cached copy with a different checksum is no use, so don't let the
+        # server tell us to use it
+        if meta is not None and self.sha256:
+            meta = None
+
+        response = self.__open(meta)
+        if response is None:
+            logger.info("{url} not modified; using cached copy".format(
+                url=self.url))
+            self.__restore(cache, directory)
+            return
+
+        with contextlib.closing(response):
+            try:
+                digest = self.__download(response, directory)
+            except AcquisitionError:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+
+            headers = response.info()
+            meta = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'sha256': digest,
+            }
+
+        if cache is not None:
+            self.__store(cache, directory, meta)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import os.path
+
+from vortex.acquirer import Acquirer, AcquisitionError
+from vortex.compat import monotonic
+from vortex.config import cfg
+from vortex.utils import copy_tree
+
+
+logger = logging.getLogger(__name__)
+
+
+@Acquirer.register
+class LocalAcquirer(Acquirer):
+    """
+    Payload acquisition from a directory on the local machine.
+
+    This is useful for pre-baked machine images and CI, where the payload is
+    already on disk. The directory is copied using
+    :func:`vortex.utils.copy_tree`, which uses reflinks where the filesystem
+    supports them, so even a large tree is copied almost instantly on Btrfs or
+    XFS.
+
+    The following configuration options are *required*:
+
+        ``path``
+           The directory to copy the payload from.
+
+    The following configuration options are *optional*:
+
+        ``link`` = ``no``
+           Whether to hard-link files rather than copying them. This is the
+           fastest method on any filesystem, but the payload's files are then
+           the *same* files as in ``path``: only enable it if the source tree
+           is immutable and the payload's deployment steps never modify its
+           files in place.
+    """
+    def configure(self):
+        """
+        Configure this acquirer based on settings from the vortex
+        configuration.
+
+        See :meth:`vortex.acquirer.Acquirer.configure`.
+        """
+        required = [
+            'path',
+        ]
+        defaults = {
+            'link': 'no',
+        }
+
+        # Validate the configuration and absorb the values into this object
+        cfg.absorb(self, self.section, required, defaults)
+
+        self.link = cfg.getboolean(self.section, 'link')
+
+    def acquire_into(self, directory):
+        """
+        Perform the resource acquisition into the given directory.
+
+        See :meth:`vortex.acquirer.Acquirer.acquire_into`.
+        """
+        logger.info("Acquiring local directory {path} into {dir}".format(
+            path=self.path, dir=directory))
+
+        if not os.path.isdir(self.path):
+            raise AcquisitionError("No such directory: {path}".format(
+                path=self.path))
+
+        start = monotonic()
+        try:
+            counts = copy_tree(self.path, directory, link=self.link)
+        except (IOError, OSError) as e:
+            raise AcquisitionError("Failed to copy {path}: {e}".format(
+                path=self.path, e=e))
+
+        logger.info(
+            "Populated {dir} in {t:.2f}s: {linked} linked, {reflinked} "
+            "reflinked, {copied} copied".format(
+                dir=directory, t=monotonic() - start, **counts))
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import datetime
+import hashlib
+import hmac
+import io
+import logging
+import os
+import os.path
+import shutil
+
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import quote, urlparse
+from six.moves.urllib.request import Request, urlopen
+
+from vortex.acquirer import Acquirer, AcquisitionError
+from vortex.archive import (
+    ArchiveError, HashingReader, detect_compression, extract_stream)
+from vortex.compat import monotonic, preallocate, pwrite
+from vortex.config import cfg
+from vortex.runtime import runtime
+from vortex.throttle import READ_SIZE
+from vortex.utils import parse_timeout, run_concurrently
+
+
+logger = logging.getLogger(__name__)
+
+#: SHA-256 of an empty request body
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign_request(request, region, access_key, secret_key, token=None,
+                 now=None):
+    """
+    Add AWS Signature Version 4 headers to the :class:`urllib.request.Request`
+    `request` for the ``s3`` service in `region`.
+
+    The request is signed as having an empty body, which is all that's needed
+    for the ``GET`` and ``HEAD`` requests made by :class:`S3Acquirer`. `token`
+    is an optional session token for temporary credentials; `now` may be given
+    as a :class:`datetime.datetime` (in UTC) for testing.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+    url = urlparse(request.get_full_url())
+
+    headers = {
+        'host': url.netloc,
+        'x-amz-content-sha256': EMPTY_SHA256,
+        'x-amz-date': amz_date,
+    }
+    if token:
+        headers['x-amz-security-token'] = token
+
+    signed = ';'.join(sorted(headers))
+    canonical = '\n'.join([
+        request.get_method(),
+        url.path or '/',
+        url.query,
+        ''.join('{k}:{v}\n'.format(k=k, v=headers[k])
+                for k in sorted(headers)),
+        signed,
+        EMPTY_SHA256,
+    ])
+
+    scope = '{date}/{region}/s3/aws4_request'.format(
+        date=date, region=region)
+    to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical.encode('utf-8')).hexdigest(),
+    ])
+
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (date, region, 's3', 'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(
+        key, to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    for (name, value) in headers.items():
+        if name != 'host':
+            request.add_header(name, value)
+    request.add_header(
+        'Authorization',
+        'AWS4-HMAC-SHA256 Credential={ak}/{scope}, SignedHeaders={signed}, '
+        'Signature={sig}'.format(
+            ak=access_key, scope=scope, signed=signed, sig=signature))
+
+
+@Acquirer.register
+class S3Acquirer(Acquirer):
+    """
+    Payload acquisition by downloading a tarball from an S3-compatible object
+    store.
+
+    Large objects are downloaded as several byte ranges at once, each written
+    directly to its place in a preallocated temporary file, which is then
+    unpacked into the payload directory. This makes much better use of an
+    instance's network bandwidth than a single download stream. Objects
+    smaller than one part are unpacked as they are downloaded, as with the
+    :mod:`vortex.acquirer.http` acquirer.
+
+    Requests are made using path-style URLs (``<endpoint>/<bucket>/<key>``),
+    so any S3-compatible server can be used by setting ``endpoint``, including
+    a local stand-in such as MinIO for testing.
+
+    The following configuration options are *required*:
+
+        ``bucket``
+           Name of the bucket containing the tarball.
+
+        ``key``
+           Key of the tarball within the bucket.
+
+    The following configuration options are *optional*:
+
+        ``region`` = ``us-east-1``
+           The region of the bucket, used to sign requests and to choose the
+           default endpoint.
+
+        ``endpoint``
+           Base URL of the object store. By default, this is the AWS S3
+           endpoint for ``region``.
+
+        ``access_key`` and ``secret_key``
+           Credentials used to sign requests. They default to the
+           ``AWS_ACCESS_KEY_ID`` and ``AWS_SECRET_ACCESS_KEY`` environment
+           variables (and ``AWS_SESSION_TOKEN``, if set). If no credentials are
+           available, requests are not signed, which is suitable for public
+           objects.
+
+        ``sha256``
+           The expected SHA-256 checksum of the tarball, as a hex string. If
+           it does not match, the acquisition fails and the payload directory
+           is removed.
+
+        ``format``
+           The compression format of the tarball: one of ``gz``, ``xz``,
+           ``zst`` or ``none``. By default this is determined from the key.
+
+        ``parts`` = ``8``
+           The number of byte ranges to download at once.
+
+        ``part_size`` = ``8``
+           The minimum size of each byte range, in MiB.
+
+        ``timeout`` = ``300``
+           The number of seconds to wait for the server to respond before the
+           acquisition fails. Zero means no timeout.
+    """
+    #: Options which don't affect what is acquired
+    cache_ignore = Acquirer.cache_ignore | frozenset(
+        ['access_key', 'part_size', 'parts', 'secret_key'])
+
+    def configure(self):
+        """
+        Configure this acquirer based on settings from the vortex
+        configuration.
+
+        See :meth:`vortex.acquirer.Acquirer.configure`.
+        """
+        required = [
+            'bucket',
+            'key',
+        ]
+        defaults = {
+            'access_key': '',
+            'endpoint': '',
+            'format': '',
+            'part_size': '8',
+            'parts': '8',
+            'region': 'us-east-1',
+            'secret_key': '',
+            'sha256': '',
+            'timeout': '300',
+        }
+
+        # Validate the configuration and absorb the values into this object
+        cfg.absorb(self, self.section, required, defaults)
+
+        # Fall back to the credentials in the environment, if any
+        self.token = None
+        if not self.access_key and not self.secret_key:
+            self.access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+            self.secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+            self.token = os.environ.get('AWS_SESSION_TOKEN')
+        self.sha256 = self.sha256.lower()
+
+        if not self.endpoint:
+            self.endpoint = 'https://s3.{region}.amazonaws.com'.format(
+                region=self.region)
+        self.url = '{endpoint}/{bucket}/{key}'.format(
+            endpoint=self.endpoint.rstrip('/'), bucket=quote(self.bucket),
+            key=quote(self.key.lstrip('/'), safe='/~'))
+
+        if not self.format:
+            self.format = detect_compression(self.key)
+        if self.format is None:
+            raise AcquisitionError(
+                "{sec}: cannot determine archive format of {key}".format(
+                    sec=self.section, key=self.key))
+
+        try:
+            self.parts = max(1, int(self.parts))
+            self.part_size = max(1, int(self.part_size)) * 1024 * 1024
+        except ValueError:
+            raise AcquisitionError(
+                "{sec}: parts and part_size must be integers".format(
+                    sec=self.section))
+
+        try:
+            self.timeout = parse_timeout(self.timeout)
+        except ValueError:
+            raise AcquisitionError("{sec}: invalid timeout: {t}".format(
+                sec=self.section, t=self.timeout))
+
+    def _open(self, method='GET', headers=None):
+        # Make a (signed, if we have credentials) request for the object
+        request = Request(self.url, headers=headers or {})
+        request.get_method = lambda: method
+
+        if self.access_key and self.secret_key:
+            sign_request(request, self.region, self.access_key,
+                         self.secret_key, self.token)
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            return urlopen(request, **kwargs)
+        except HTTPError as e:
+            raise AcquisitionError(
+                "Failed to download {url}: HTTP {code} {msg}".format(
+                    url=self.url, code=e.code, msg=e.msg))
+        except (URLError, IOError, OSError) as e:
+            raise AcquisitionError("Failed to download {url}: {e}".format(
+                url=self.url, e=getattr(e, 'reason', e)))
+
+    def _size(self):
+        # Find the size of the object
+        with contextlib.closing(self._open('HEAD')) as response:
+            try:
+                return int(response.info().get('Content-Length'))
+            except (TypeError, ValueError):
+                return None
+
+    def resolve_revision(self):
+        """
+        Return the configured checksum of the object if there is one, or
+        otherwise its current ``ETag``.
+
+        See :meth:`vortex.acquirer.Acquirer.resolve_revision`.
+        """
+        if self.sha256:
+            return self.sha256
+
+        try:
+            with contextlib.closing(self._open('HEAD')) as response:
+                etag = response.info().get('ETag')
+        except AcquisitionError:
+            return None
+
+        return etag and 'etag:' + etag
+
+    def _fetch_range(self, fd, start, end):
+        # Download bytes start..end (inclusive) of the object into the file
+        headers = {'Range': 'bytes={start}-{end}'.format(start=start, end=end)}
+        offset = start
+
+        with contextlib.closing(self._open(headers=headers)) as response:
+            if response.getcode() != 206:
+                raise AcquisitionError(
+                    "Server ignored range request for {url}".format(
+                        url=self.url))
+
+            for data in iter(lambda: response.read(READ_SIZE), b''):
+                self.bandwidth.consume(len(data))
+                while data:
+                    n = pwrite(fd, data, offset)
+                    offset += n
+                    data = data[n:]
+
+        if offset != end + 1:
+            raise AcquisitionError(
+                "Short read downloading {url} (bytes {start}-{end})".format(
+                    url=self.url, start=start, end=end))
+
+    def _download(self, path, size):
+        # Download the object into a preallocated file using ranged requests
+        count = min(self.parts, (size + self.part_size - 1) // self.part_size)
+        part = (size + count - 1) // count
+        ranges = [(start, min(start + part, size) - 1)
+                  for start in range(0, size, part)]
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            preallocate(fd, size)
+            run_concurrently(
+                [(lambda r=r: self._fetch_range(fd, *r)) for r in ranges],
+                self.parts)
+        finally:
+            os.close(fd)
+
+    def _extract(self, fileobj, directory, throttle=None):
+        # Unpack the tarball from a file object, verifying its checksum
+        reader = HashingReader(fileobj, throttle=throttle)
+
+        try:
+            extract_stream(reader, directory, self.format)
+            reader.drain()
+        except ArchiveError as e:
+            raise AcquisitionError("Failed to unpack {url}: {e}".format(
+                url=self.url, e=e))
+        except (IOError, OSError) as e:
+            raise AcquisitionError("Failed to download {url}: {e}".format(
+                url=self.url, e=e))
+
+        digest = reader.hexdigest()
+        if self.sha256 and digest != self.sha256:
+            raise AcquisitionError(
+                "Checksum mismatch for {url}: expected {exp}, got {got}"
+                .format(url=self.url, exp=self.sha256, got=digest))
+
+        return reader.count
+
+    def _acquire(self, directory):
+        start = monotonic()
+        size = self._size()
+
+        if size is None or size <= self.part_size or self.parts == 1:
+            # Not worth splitting up; just stream it
+            with contextlib.closing(self._open()) as response:
+                size = self._extract(
+                    response, directory, throttle=self.bandwidth)
+        else:
+            path = os.path.join(
+                runtime.tmpdir, "s3-{pid}-{id}.download".format(
+                    pid=os.getpid(), id=id(self)))
+            try:
+                self._download(path, size)
+                with io.open(path, 'rb') as fp:
+                    self._extract(fp, directory)
+            finally:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        elapsed = monotonic() - start
+        logger.info(
+            "Downloaded {n} bytes from {url} in {t:.1f}s ({rate:.1f} MiB/s)"
+            .format(n=size, url=self.url, t=elapsed,
+                    rate=size / max(elapsed, 0.001) / (1024 * 1024)))
+
+    def acquire_into(self, directory):
+        """
+        Perform the resource acquisition into the given directory.
+
+        See :meth:`vortex.acquirer.Acquirer.acquire_into`.
+        """
+        logger.info("Acquiring s3://{bucket}/{key} into {dir}".format(
+            bucket=self.bucket, key=self.key, dir=directory))
+
+        try:
+            self._acquire(directory)
+        except AcquisitionError:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        # The checksum has been verified; an ETag may have changed since
+        self.acquired_revision = self.sha256 or None
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Long-running agent mode.
+
+Rather than exiting after a single run, the agent stays resident and
+periodically re-converges the instance. Each cycle resolves the current
+revision of every payload (see
+:meth:`vortex.acquirer.Acquirer.resolve_revision`), and only acquires and
+deploys the payloads whose revision differs from the one last deployed.
+Payloads whose revision cannot be resolved in advance are converged every
+cycle.
+
+Because the process stays resident, the configuration, imported modules and
+persistent caches are reused from cycle to cycle; nothing is re-bootstrapped.
+
+The agent is started with the :func:`vortex.run_agent` entry point (for
+example ``entry=vortex:run_agent`` in the bootstrap configuration, or
+``python -m vortex agent``). It exits cleanly on ``SIGTERM`` or ``SIGINT``.
+
+The following configuration options are *optional*:
+
+``[agent].interval`` = ``1800``
+   The average number of seconds between cycles.
+
+``[agent].jitter`` = ``0.2``
+   The fraction by which each interval is randomly lengthened or shortened,
+   so that a fleet of agents started together do not stay in step.
+
+``[agent].listen``
+   Address on which to accept push notifications of changed payloads, for
+   example ``unix:/run/vortex.sock`` or ``tcp:127.0.0.1:8642``. See
+   :mod:`vortex.trigger`. By default, no notifications are accepted.
+
+``[agent].debounce`` = ``2``
+   After a notification, the agent waits until no further notifications have
+   arrived for this many seconds, then converges all the notified payloads in
+   a single run.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import random
+import signal
+import six
+import threading
+
+from vortex.compat import monotonic
+from vortex.config import cfg
+from vortex.housekeeping import auto_collect_garbage
+from vortex.payload import AsyncHook, Payload
+from vortex.runlock import RunLock
+from vortex.runtime import runtime
+from vortex.state import StateFile
+from vortex.throttle import splay
+from vortex.trigger import TriggerListener
+
+
+logger = logging.getLogger(__name__)
+
+
+class Agent(object):
+    """
+    The Vortex agent. See the module documentation for details.
+    """
+    #: Default values for the ``[agent]`` configuration section
+    defaults = {
+        'debounce': '2',
+        'interval': '1800',
+        'jitter': '0.2',
+        'listen': '',
+    }
+
+    #: Stands for "all payloads" in the set of pending notifications
+    ALL = object()
+
+    def __init__(self):
+        super(Agent, self).__init__()
+        for (option, value) in six.iteritems(self.defaults):
+            cfg.set_default('agent', option, value)
+
+        self.interval = float(cfg.get('agent', 'interval'))
+        self.jitter = min(1.0, max(0.0, float(cfg.get('agent', 'jitter'))))
+        self.debounce = float(cfg.get('agent', 'debounce'))
+        self.listen = cfg.get('agent', 'listen')
+        self.random = random.Random()
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        # Notifications received but not yet acted upon
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.last_trigger = None
+
+    def next_interval(self):
+        """
+        Return the number of seconds to wait before the next cycle.
+        """
+        spread = self.interval * self.jitter
+        return max(0.0, self.interval + self.random.uniform(-spread, spread))
+
+    def changed_payloads(self, payloads):
+        """
+        Return those of `payloads` whose revision differs from the revision
+        last deployed, or cannot be determined.
+        """
+        deployed = StateFile('revisions.json').data
+        changed = []
+
+        for payload in payloads:
+            try:
+                revision = payload.revision
+            except Exception:
+                logger.exception(
+                    "Cannot resolve revision of payload {name}".format(
+                        name=payload.name))
+                revision = None
+
+            if revision is None or deployed.get(payload.name) != revision:
+                changed.append(payload)
+            else:
+                logger.debug("Payload {name} is unchanged".format(
+                    name=payload.name))
+
+        return changed
+
+    def cycle(self, names=None):
+        """
+        Perform one convergence cycle, returning whether it succeeded.
+
+        If `names` is given, only the payloads with those names are
+        considered.
+        """
+        payloads = Payload.configured_payloads()
+        if names is not None:
+            unknown = set(names) - set(payload.name for payload in payloads)
+            for name in sorted(unknown):
+                logger.warning("Ignoring unknown payload {name}".format(
+                    name=name))
+            payloads = [
+                payload for payload in payloads if payload.name in names]
+
+        for payload in Payload.configured_payloads():
+            payload.reset()
+
+        changed = self.changed_payloads(payloads)
+        if not changed:
+            logger.info("All payloads are up to date.")
+            return True
+
+        logger.info("Converging payloads: {names}".format(
+            names=', '.join(payload.name for payload in changed)))
+
+        try:
+            with RunLock().exclusive():
+                return runtime.converge(changed)
+        finally:
+            AsyncHook.collect()
+            auto_collect_garbage()
+
+    def trigger(self, names=None):
+        """
+        Ask for the payloads named in `names` (or all payloads, if `names` is
+        ``None``) to be converged soon, without waiting for the next periodic
+        cycle. Notifications arriving within the debounce period of each
+        other are handled together. This may be called from any thread.
+        """
+        with self.lock:
+            if names is None:
+                self.pending.add(self.ALL)
+            else:
+                self.pending.update(names)
+            self.last_trigger = monotonic()
+
+        logger.info("Notified of changes to {names}".format(
+            names=', '.join(names) if names else 'all payloads'))
+        self.wakeup.set()
+
+    def _wait(self, delay):
+        # Wait for the next cycle, returning the names of the payloads it
+        # should consider (None meaning all of them).
+        self.wakeup.wait(delay)
+        self.wakeup.clear()
+
+        while not self.stopping:
+            with self.lock:
+                if not self.pending:
+                    return None
+                remaining = self.last_trigger + self.debounce - monotonic()
+                if remaining <= 0:
+                    (names, self.pending) = (self.pending, set())
+                    return None if self.ALL in names else names
+
+            self.wakeup.wait(remaining)
+            self.wakeup.clear()
+
+        return None
+
+    def stop(self, *args):
+        """
+        Ask the agent to exit once the current cycle has finished. May be used
+        as a signal handler.
+        """
+        self.stopping = True
+        self.wakeup.set()
+
+    def run(self):
+        """
+        Run convergence cycles until asked to stop.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        logger.info("Vortex agent starting; interval {i:.0f}s".format(
+            i=self.interval))
+        splay()
+
+        listener = None
+        if self.listen:
+            listener = TriggerListener(self, self.listen)
+            listener.start()
+
+        names = None
+        try:
+            while not self.stopping:
+                try:
+                    if not self.cycle(names):
+                        logger.error("Convergence cycle failed; will retry.")
+                except Exception:
+                    logger.exception("Convergence cycle failed; will retry.")
+
+                if self.stopping:
+                    break
+
+                delay = self.next_interval()
+                logger.info("Next convergence cycle in {t:.0f}s".format(
+                    t=delay))
+                names = self._wait(delay)
+        finally:
+            if listener is not None:
+                listener.close()
+
+        logger.info("Vortex agent stopping.")
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Helpers for unpacking (possibly compressed) tar archives as they are read
+from a stream, without first storing the archive anywhere.
+
+Supported compression formats are ``gz`` (gzip), ``xz`` and ``zst``
+(Zstandard), plus ``none`` for an uncompressed archive. Gzip is handled by the
+Python standard library, as is xz on Python 3.3+. Otherwise (including for
+Zstandard, which the standard library does not support), the archive is piped
+through the relevant command-line tool, which is installed using
+:func:`vortex.environment.install_package` if necessary.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import logging
+import os
+import os.path
+import subprocess
+import tarfile
+import threading
+
+from vortex.environment import install_package
+from vortex.throttle import READ_SIZE
+from vortex.utils import is_within
+
+
+logger = logging.getLogger(__name__)
+
+#: Map of filename suffixes to compression formats, used by
+#: :func:`detect_compression`.
+SUFFIXES = [
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.xz', 'xz'),
+    ('.txz', 'xz'),
+    ('.tar.zst', 'zst'),
+    ('.tzst', 'zst'),
+    ('.tar', 'none'),
+]
+
+#: External decompression commands, and the packages providing them
+DECOMPRESSORS = {
+    'xz': ('/usr/bin/xz', 'xz-utils'),
+    'zst': ('/usr/bin/zstd', 'zstd'),
+}
+
+try:
+    import lzma  # noqa
+    _NATIVE = ('gz', 'xz')
+except ImportError:
+    _NATIVE = ('gz',)
+
+
+class ArchiveError(Exception):
+    """
+    Problems raised while unpacking an archive.
+    """
+
+
+class HashingReader(object):
+    """
+    File-like wrapper which hashes (using SHA-256) and counts the bytes read
+    through it.
+
+    `fileobj` is the underlying object to read from. If `throttle` is given,
+    its ``consume(n)`` method is called for each chunk of ``n`` bytes read;
+    the underlying object is read in chunks of at most
+    :data:`vortex.throttle.READ_SIZE` bytes, however much is asked for.
+    """
+    def __init__(self, fileobj, throttle=None):
+        super(HashingReader, self).__init__()
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.hash = hashlib.sha256()
+        self.count = 0
+
+    def read(self, size=-1):
+        """
+        Read up to `size` bytes (or, if `size` is negative, everything) from
+        the underlying object.
+        """
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(READ_SIZE), b''))
+
+        chunks = []
+        while size > 0:
+            data = self.fileobj.read(min(size, READ_SIZE))
+            if not data:
+                break
+            self.hash.update(data)
+            self.count += len(data)
+            if self.throttle is not None:
+                self.throttle.consume(len(data))
+            chunks.append(data)
+            size -= len(data)
+
+        return b''.join(chunks)
+
+    def drain(self):
+        """
+        Read (and hash) everything remaining in the underlying object.
+        """
+        while self.read(65536):
+            pass
+
+    def hexdigest(self):
+        """
+        Return the SHA-256 of everything read so far, as a hex string.
+        """
+        return self.hash.hexdigest()
+
+
+def detect_compression(name):
+    """
+    Guess the compression format of an archive from its `name` (a filename or
+    URL path). Returns ``None`` if the format cannot be determined.
+    """
+    for (suffix, compression) in SUFFIXES:
+        if name.endswith(suffix):
+            return compression
+    return None
+
+
+def _safe_member(member, directory):
+    # Refuse archive members which would be written outside the directory,
+    # whether directly or through a symlink extracted earlier
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name == '..' or name.startswith('../'):
+        raise ArchiveError(
+            "Refusing to extract unsafe path: {name}".format(name=member.name))
+
+    parent = os.path.dirname(os.path.join(directory, name))
+    if not is_within(parent, directory):
+        raise ArchiveError(
+            "Refusing to extract through a symlink: {name}".format(
+                name=member.name))
+
+    if member.islnk():
+        target = os.path.normpath(member.linkname)
+        if os.path.isabs(target) or target.startswith('../'):
+            raise ArchiveError(
+                "Refusing to extract unsafe hard link: {name}".format(
+                    name=member.name))
+
+    if member.issym():
+        target = os.path.join(parent, member.linkname)
+        if os.path.isabs(member.linkname) or not is_within(target, directory):
+            raise ArchiveError(
+                "Refusing to extract unsafe symlink: {name}".format(
+                    name=member.name))
+
+    # Files are owned by whoever runs Vortex, as with any other acquisition
+    # method, rather than by whatever user built the archive.
+    member.uid = os.getuid()
+    member.gid = os.getgid()
+    member.uname = ''
+    member.gname = ''
+
+    return member
+
+
+def _extract(tar, directory):
+    # Extract each member of an open stream-mode tarfile in turn
+    for member in tar:
+        tar.extract(_safe_member(member, directory), directory)
+
+
+def _extract_piped(fileobj, directory, compression):
+    # Decompress using an external command, feeding it from a thread while
+    # tarfile reads its output.
+    (binary, package) = DECOMPRESSORS[compression]
+    if not os.path.isfile(binary):
+        install_package(package)
+
+    p = subprocess.Popen(
+        [binary, '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        close_fds=True)
+    errors = []
+
+    def feed():
+        try:
+            for chunk in iter(lambda: fileobj.read(65536), b''):
+                p.stdin.write(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                p.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    try:
+        tar = tarfile.open(fileobj=p.stdout, mode='r|')
+        _extract(tar, directory)
+        tar.close()
+    finally:
+        # Consume anything after the end of the archive so that the feeder
+        # and decompressor can finish.
+        while p.stdout.read(65536):
+            pass
+        feeder.join()
+        ret = p.wait()
+
+    if errors:
+        raise errors[0]
+    if ret != 0:
+        raise ArchiveError("{cmd} failed ({ret})".format(cmd=binary, ret=ret))
+
+
+def extract_stream(fileobj, directory, compression):
+    """
+    Extract a tar archive read sequentially from `fileobj` into `directory`.
+
+    `compression` is one of the supported compression formats (see
+    :func:`detect_compression`). `fileobj` only needs to support ``read()``;
+    the archive is never seeked or stored, so it may be read directly from a
+    network connection. The `directory` is created if it does not exist.
+
+    Members with absolute paths or paths leading outside the directory
+    (including through symlinks), and symlinks pointing outside it, are
+    refused with an :exc:`ArchiveError`. Extracted files are owned by the
+    user running Vortex.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    if compression in _NATIVE or compression == 'none':
+        mode = 'r|' if compression == 'none' else 'r|' + compression
+        try:
+            tar = tarfile.open(fileobj=fileobj, mode=mode)
+            _extract(tar, directory)
+            tar.close()
+        except tarfile.TarError as e:
+            raise ArchiveError("Cannot extract archive: {e}".format(e=e))
+    elif compression in DECOMPRESSORS:
+        try:
+            _extract_piped(fileobj, directory, compression)
+        except tarfile.TarError as e:
+            raise ArchiveError("Cannot extract archive: {e}".format(e=e))
+    else:
+        raise ArchiveError("Unsupported archive compression: {c}".format(
+            c=compression))
@@ -43,6 +43,20 @@ The following configuration options are *optional*:
    default this points at :func:`vortex.stage2`, which is used to continue the
    bootstrap process.
 
+``[bootstrap].cache`` = ``no``
+   Whether to keep a copy of the downloaded Egg file in the ``bootstrap``
+   cache, beneath ``[runtime].cache_dir``. When there is a cached copy, the
+   Egg is only downloaded again if the server reports that it has changed
+   (using the ``ETag`` and ``Last-Modified`` headers it sent last time), and
+   the cached copy is used if the source cannot be reached. This is intended
+   for machine images prepared with :func:`vortex.prepare`.
+
+The ``[runtime].splay``, ``[runtime].acquire_rate`` and
+``[runtime].acquire_burst`` options (see :mod:`vortex.throttle`) are also
+honoured: the download is delayed by the same amount that Vortex itself would
+delay it, and the splay is not applied again by the later stages, or by later
+runs during the same boot.
+
 Some of the code in this file is made up of simpler / stripped
 re-implementations of code found elsewhere in Vortex, or even from parts of
 :mod:`six`.
@@ -53,11 +67,15 @@ from __future__ import absolute_import, print_function, unicode_literals
 # Straight module imports
 import atexit
 import collections
+import hashlib
+import json
 import os
 import os.path
 import shutil
+import socket
 import sys
 import tempfile
+import time
 
 # Workaround for Sphinx bug 1641. Without this kind of thing, Sphinx barfs when
 # using print as a function. https://github.com/sphinx-doc/sphinx/issues/1641
@@ -79,6 +97,12 @@ try:
 except ImportError:
     from urllib.request import urlretrieve
 
+try:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+except ImportError:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+
 try:
     from urlparse import urlparse
 except ImportError:
@@ -109,6 +133,7 @@ tmpdir = tempfile.mkdtemp(prefix='vortex-')
 # Configuration defaults
 config.add_section('bootstrap')
 config.set('bootstrap', 'entry', 'vortex:stage2')
+config.set('bootstrap', 'cache', 'no')
 
 
 @atexit.register
@@ -142,21 +167,150 @@ def read_config():
             ini=VORTEX_INI))
 
 
+def host_fraction(purpose):
+    """
+    Return a number in the range [0, 1) which is fixed for this instance and
+    the given `purpose`. See :func:`vortex.throttle.host_fraction`.
+    """
+    identity = None
+    for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+        try:
+            with open(path) as f:
+                identity = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if identity:
+            break
+    if not identity:
+        identity = socket.gethostname()
+
+    seed = '{id}:{purpose}'.format(id=identity, purpose=purpose)
+    digest = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / float(1 << 32)
+
+
+def throttle():
+    """
+    Wait for this instance's splay, then for a token from a fresh acquisition
+    token bucket. See :mod:`vortex.throttle`.
+    """
+    def option(name, default):
+        if not config.has_option('runtime', name):
+            return default
+        try:
+            return float(config.get('runtime', name))
+        except ValueError:
+            return default
+
+    # The same marker as vortex.throttle.splay() uses
+    splayed = '/run/vortex-splayed'
+
+    delay = 0.0
+    if not (os.environ.get('VORTEX_SPLAYED') or os.path.exists(splayed)):
+        os.environ['VORTEX_SPLAYED'] = '1'
+        delay += option('splay', 0.0) * host_fraction('splay')
+
+    rate = option('acquire_rate', 0.0)
+    if rate > 0:
+        burst = max(1.0, option('acquire_burst', 1.0))
+        tokens = burst * host_fraction('acquire')
+        delay += max(0.0, (1 - tokens) / rate)
+
+    if delay > 0:
+        time.sleep(delay)
+
+    try:
+        with open(splayed, 'a'):
+            pass
+    except (IOError, OSError):
+        pass
+
+
+def fetch_cached(url, filepath):
+    """
+    Download `url` to `filepath`, using and maintaining a copy in the
+    ``bootstrap`` cache as described for ``[bootstrap].cache`` above.
+    """
+    cache_dir = '/var/cache/vortex'
+    if config.has_option('runtime', 'cache_dir'):
+        cache_dir = config.get('runtime', 'cache_dir')
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    entry = os.path.join(cache_dir, 'bootstrap', key)
+    egg = os.path.join(entry, 'vortex.egg')
+
+    meta = None
+    try:
+        with open(os.path.join(entry, 'meta.json')) as fp:
+            meta = json.load(fp)
+    except (IOError, OSError, ValueError):
+        pass
+    if meta is not None and not os.path.isfile(egg):
+        meta = None
+
+    request = Request(url)
+    if meta is not None:
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        response = urlopen(request)
+    except (HTTPError, URLError, IOError, OSError) as e:
+        if meta is None:
+            raise
+        if getattr(e, 'code', None) != 304:
+            print_("{url}: {e}; using cached copy".format(url=url, e=e),
+                   file=sys.stderr)
+        shutil.copyfile(egg, filepath)
+        os.utime(entry, None)
+        return
+
+    try:
+        with open(filepath, 'wb') as fp:
+            shutil.copyfileobj(response, fp)
+        headers = response.info()
+        meta = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+    finally:
+        response.close()
+
+    # Store the new copy; failing to do so doesn't stop us carrying on
+    tmp = "{entry}.{pid}.tmp".format(entry=entry, pid=os.getpid())
+    try:
+        os.makedirs(tmp, 0o700)
+        shutil.copyfile(filepath, os.path.join(tmp, 'vortex.egg'))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+    except (IOError, OSError):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
 def fetch_vortex():
     """
     Download the Vortex Egg file.
 
     Returns the full path to the downloaded file, which will be within the
-    :data:`tmpdir` directory.
+    :data:`tmpdir` directory. The download waits for :func:`throttle` first.
 
     .. todo:: Validate cryptographic signature.
     """
+    throttle()
+
     url = config.get('bootstrap', 'source')
     o = urlparse(url)
     filename = os.path.basename(o.path)
     filepath = os.path.join(tmpdir, filename)
 
-    urlretrieve(url, filename=filepath)
+    if config.getboolean('bootstrap', 'cache'):
+        fetch_cached(url, filepath)
+    else:
+        urlretrieve(url, filename=filepath)
 
     # FIXME: validate signature
 
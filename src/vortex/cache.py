@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Persistent caches kept by Vortex between runs.
+
+Each cache is a directory beneath :attr:`vortex.runtime.Runtime.cache_dir`
+containing one file or directory per entry. Entries are named by a key chosen
+by the user of the cache, typically a content hash. The modification time of
+an entry records when it was last used.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import io
+import logging
+import os
+import os.path
+import shutil
+
+from vortex.compat import scandir
+from vortex.runtime import runtime
+from vortex.utils import copy_tree
+
+
+logger = logging.getLogger(__name__)
+
+
+def disk_usage(path):
+    """
+    Return the number of bytes of disk space used by the file or directory
+    tree at `path`. Files with several hard links within the tree are only
+    counted once.
+    """
+    total = 0
+    seen = set()
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0
+    total += st.st_blocks * 512
+    if not os.path.isdir(path) or os.path.islink(path):
+        return total
+
+    for (root, dirs, files) in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+
+    return total
+
+
+class Cache(object):
+    """
+    A named cache directory.
+
+    `name` is the name of the cache's directory within the cache directory,
+    for example ``steps``. The directory is created when first written to.
+    """
+    def __init__(self, name):
+        super(Cache, self).__init__()
+        self.name = name
+        self.path = os.path.join(runtime.cache_dir, name)
+
+    def entry_path(self, key):
+        """
+        Return the path of the cache entry named `key`. A :exc:`ValueError` is
+        raised if `key` is not a plain file name within the cache.
+        """
+        if not key or os.sep in key or '..' in key or \
+                os.path.isabs(key):
+            raise ValueError("Invalid cache key: {key!r}".format(key=key))
+        return os.path.join(self.path, key)
+
+    def touch(self, key):
+        """
+        Record that the entry named `key` has just been used.
+        """
+        try:
+            os.utime(self.entry_path(key), None)
+        except OSError:
+            pass
+
+    def read(self, key):
+        """
+        Return the contents of the file entry named `key` (as a byte string),
+        or ``None`` if there is no such entry.
+        """
+        try:
+            with io.open(self.entry_path(key), 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError):
+            return None
+
+        self.touch(key)
+        return data
+
+    def write(self, key, data):
+        """
+        Store `data` (a byte string) as the file entry named `key`.
+
+        The entry is written alongside its final location and then renamed
+        into place, so readers never see a partial entry. Failure to write to
+        the cache is logged but otherwise ignored: a cache is only ever an
+        optimisation.
+        """
+        path = self.entry_path(key)
+        tmp = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            with io.open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.debug("Cannot write {name} cache entry {key}: {e}".format(
+                name=self.name, key=key, e=e))
+            return False
+
+        return True
+
+    def write_tree(self, key, directory):
+        """
+        Store a copy of the directory tree `directory` as the directory entry
+        named `key`, replacing any existing entry. The tree is copied using
+        :func:`vortex.utils.copy_tree`.
+
+        As with :meth:`write`, the entry is copied alongside its final location
+        and renamed into place, and failures are logged and otherwise ignored.
+        """
+        path = self.entry_path(key)
+        tmp = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            copy_tree(directory, tmp)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+            self.touch(key)
+        except (IOError, OSError) as e:
+            logger.debug("Cannot write {name} cache entry {key}: {e}".format(
+                name=self.name, key=key, e=e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+
+        return True
+
+    def entries(self):
+        """
+        Return a list of ``(key, mtime, size)`` tuples describing the entries
+        in the cache, least recently used first. Partially written entries are
+        not included.
+        """
+        entries = []
+
+        try:
+            listing = list(scandir(self.path))
+        except OSError:
+            return entries
+
+        for entry in listing:
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                mtime = os.lstat(entry.path).st_mtime
+            except OSError:
+                continue
+            entries.append((entry.name, mtime, disk_usage(entry.path)))
+
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+
+    def remove(self, key):
+        """
+        Remove the entry named `key`, if it exists.
+        """
+        path = self.entry_path(key)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def trim(self, budget):
+        """
+        Remove least recently used entries until the cache uses no more than
+        `budget` bytes. Returns the number of bytes reclaimed.
+        """
+        entries = self.entries()
+        used = sum(size for (key, mtime, size) in entries)
+        reclaimed = 0
+
+        for (key, mtime, size) in entries:
+            if used <= budget:
+                break
+            logger.debug("Evicting {name} cache entry {key}".format(
+                name=self.name, key=key))
+            self.remove(key)
+            used -= size
+            reclaimed += size
+
+        return reclaimed
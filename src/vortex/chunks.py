@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Content-defined chunking of payload trees.
+
+A payload tree is described by an *index*: a JSON document listing every
+directory, file and symbolic link in the tree. Each file is listed as a
+sequence of *chunks*, named by their SHA-256 checksums, which are kept in a
+*chunk store*. Chunk boundaries are chosen from the content itself using a
+rolling hash, so an insertion or deletion in a file only changes the chunks
+around it; the rest of the file produces the same chunks as before.
+
+Chunk stores are plain directory trees (served over HTTP or accessed
+directly), with each chunk stored as ``<first 4 hex digits>/<checksum>``.
+
+Indexes and chunk stores are produced by :func:`build_index` and consumed by
+the :mod:`vortex.acquirer.chunked` acquirer. For example, on a build machine::
+
+    from vortex.chunks import build_index, write_index
+    write_index(build_index('build/myapp', 'dist/chunks'),
+                'dist/myapp.json')
+
+An index looks like this:
+
+.. code-block:: json
+
+   {
+    "entries": [
+     {"mode": 493, "path": "bin", "type": "dir"},
+     {"chunks": ["3a7b...", "9f01..."], "mode": 493, "path": "bin/myapp",
+      "type": "file"},
+     {"path": "current", "target": "bin", "type": "symlink"}
+    ],
+    "version": 1
+   }
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import stat
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+#: Version of the index format written by :func:`build_index`
+INDEX_VERSION = 1
+
+#: Chunks are never smaller than this (except at the end of a file)...
+MIN_CHUNK = 16 * 1024
+
+#: ... never larger than this ...
+MAX_CHUNK = 256 * 1024
+
+#: ... and a boundary is declared where the rolling hash has these bits clear,
+#: giving chunks of around 64KiB on average.
+CHUNK_MASK = (1 << 16) - 1
+
+
+def _gear_table():
+    # 256 pseudo-random 32-bit values, derived deterministically so that all
+    # producers choose the same chunk boundaries.
+    table = []
+    for i in range(256):
+        digest = hashlib.sha256(struct.pack('>I', i)).digest()
+        table.append(struct.unpack('>I', digest[:4])[0])
+    return table
+
+
+_GEAR = _gear_table()
+
+
+def chunk_path(digest):
+    """
+    Return the path of the chunk with checksum `digest`, relative to the root
+    of a chunk store.
+    """
+    return '{prefix}/{digest}'.format(prefix=digest[:4], digest=digest)
+
+
+def _boundary(data):
+    # Return the length of the first chunk in `data` (a bytearray)
+    limit = min(len(data), MAX_CHUNK)
+    if limit <= MIN_CHUNK:
+        return limit
+
+    gear = _GEAR
+    h = 0
+    for i in range(MIN_CHUNK, limit):
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & CHUNK_MASK:
+            return i + 1
+
+    return limit
+
+
+def iter_chunks(fp):
+    """
+    Split the contents of the binary file object `fp` into content-defined
+    chunks, yielding each chunk as a byte string.
+    """
+    buf = bytearray()
+    eof = False
+
+    while True:
+        while not eof and len(buf) < MAX_CHUNK:
+            data = fp.read(MAX_CHUNK)
+            if not data:
+                eof = True
+            buf.extend(data)
+
+        if not buf:
+            return
+
+        n = _boundary(buf)
+        yield bytes(buf[:n])
+        del buf[:n]
+
+
+def _store_chunk(store, data):
+    # Add a chunk to the chunk store directory, returning its checksum
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(store, chunk_path(digest))
+
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + '.tmp'
+        with io.open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp, path)
+
+    return digest
+
+
+def build_index(directory, store):
+    """
+    Chunk every file beneath `directory`, adding the chunks to the chunk store
+    directory `store`, and return the index describing the tree (as a
+    dictionary).
+
+    Chunks already present in the store are not rewritten, so publishing each
+    release into the same store only adds the chunks that changed.
+    """
+    entries = []
+
+    for (root, dirs, files) in os.walk(directory):
+        dirs.sort()
+        rel_root = os.path.relpath(root, directory)
+
+        for name in dirs + sorted(files):
+            path = os.path.join(root, name)
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            st = os.lstat(path)
+            mode = stat.S_IMODE(st.st_mode)
+
+            if stat.S_ISLNK(st.st_mode):
+                entries.append({
+                    'path': rel,
+                    'type': 'symlink',
+                    'target': os.readlink(path),
+                })
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append({'path': rel, 'type': 'dir', 'mode': mode})
+            elif stat.S_ISREG(st.st_mode):
+                with io.open(path, 'rb') as fp:
+                    chunks = [_store_chunk(store, chunk)
+                              for chunk in iter_chunks(fp)]
+                entries.append({
+                    'path': rel,
+                    'type': 'file',
+                    'mode': mode,
+                    'chunks': chunks,
+                })
+            else:
+                logger.warning("Skipping special file {path}".format(
+                    path=path))
+
+    return {'version': INDEX_VERSION, 'entries': entries}
+
+
+def write_index(index, path):
+    """
+    Write the `index` returned by :func:`build_index` to the file `path`.
+    """
+    with io.open(path, 'wb') as fp:
+        fp.write(json.dumps(index, sort_keys=True, indent=1).encode('utf-8'))
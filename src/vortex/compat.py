@@ -33,11 +33,59 @@ Compatibility functions and wrappers.
    On Python >= 3.3, this is a re-exported and renamed version of
    :func:`shlex.quote`. Otherwise, this is a re-exported and renamed version of
    :func:`pipes.quote`.
+
+.. py:function:: load_source(name, path)
+
+   Load the Python source file at ``path`` as a module called ``name``, and
+   return the module object. The module is not added to :data:`sys.modules`.
+   On Python >= 3.5 this uses :mod:`importlib.util`; otherwise it is a wrapper
+   around :func:`imp.load_source`.
+
+.. py:function:: scandir(path)
+
+   On Python >= 3.5, this is a re-exported version of :func:`os.scandir`.
+   Otherwise, this is a simple emulation built on :func:`os.listdir` that
+   yields objects with ``name`` and ``path`` attributes and ``is_dir()``,
+   ``is_file()`` and ``stat()`` methods (which always follow symlinks, and
+   each of which costs a :func:`os.stat` call).
+
+.. py:function:: monotonic()
+
+   On Python >= 3.3, this is a re-exported version of :func:`time.monotonic`.
+   Otherwise, this is :func:`time.time`, which is adequate for measuring
+   elapsed time in the absence of large clock adjustments.
+
+.. py:data:: new_session_kwargs
+
+   Dictionary of keyword arguments for :class:`subprocess.Popen` which cause
+   the child process to be started in a new session (and therefore a new
+   process group), allowing it and all its descendants to be signalled at once
+   using :func:`os.killpg`. On Python >= 3.2 this uses ``start_new_session``;
+   otherwise :func:`os.setsid` is passed as the ``preexec_fn``.
+
+.. py:function:: pwrite(fd, data, offset)
+
+   On Python >= 3.3, this is a re-exported version of :func:`os.pwrite`.
+   Otherwise, this seeks to ``offset`` and writes ``data`` while holding a
+   lock, so that threads writing to different offsets of the same file
+   descriptor (using this function) do not interfere with each other. Returns
+   the number of bytes written, which may be fewer than requested.
+
+.. py:function:: preallocate(fd, size)
+
+   Allocate ``size`` bytes of disk space for the file open as ``fd``. This uses
+   :func:`os.posix_fallocate` where it is available and supported by the
+   filesystem; otherwise the file is simply extended to ``size`` bytes with
+   :func:`os.ftruncate`.
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import errno
+import os
 import sys
+import threading
+import time
 
 # IMPORTANT: All code in this file must only use the Python standard library
 # modules only. In particular, one cannot assume that Six is available.
@@ -57,3 +105,80 @@ try:
 except ImportError:
     # Undocumented but exists in Python 2.6
     from pipes import quote as shell_quote  # noqa
+
+try:
+    from importlib.util import module_from_spec, spec_from_file_location
+
+    def load_source(name, path):
+        spec = spec_from_file_location(name, path)
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+except ImportError:
+    import imp
+
+    def load_source(name, path):
+        module = imp.load_source(name, path)
+        del sys.modules[name]
+        return module
+
+try:
+    from os import scandir  # noqa
+except ImportError:
+    import stat as _stat
+
+    class _DirEntry(object):
+        def __init__(self, directory, name):
+            self.name = name
+            self.path = os.path.join(directory, name)
+
+        def stat(self):
+            return os.stat(self.path)
+
+        def is_dir(self):
+            try:
+                return _stat.S_ISDIR(self.stat().st_mode)
+            except OSError:
+                return False
+
+        def is_file(self):
+            try:
+                return _stat.S_ISREG(self.stat().st_mode)
+            except OSError:
+                return False
+
+    def scandir(path):
+        return (_DirEntry(path, name) for name in os.listdir(path))
+
+try:
+    from time import monotonic  # noqa
+except ImportError:
+    monotonic = time.time
+
+if sys.version_info >= (3, 2):
+    new_session_kwargs = {'start_new_session': True}
+else:
+    new_session_kwargs = {'preexec_fn': os.setsid}
+
+try:
+    from os import pwrite  # noqa
+except ImportError:
+    _pwrite_lock = threading.Lock()
+
+    def pwrite(fd, data, offset):
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+
+def preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return
+    except AttributeError:
+        pass
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+
+    os.ftruncate(fd, size)
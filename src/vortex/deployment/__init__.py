@@ -21,20 +21,35 @@ Subsystem used for abstracting how payload data is deployed.
 from __future__ import absolute_import, print_function, unicode_literals
 
 import abc
+import collections
+import functools
+import glob
+import hashlib
 import json
 import logging
 import os
 import os.path
 import six
+import stat
+import threading
+import time
 import yaml
 
 from six import PY3
-from vortex.compat import import_module
-from vortex.utils import cached_property
+from vortex.cache import Cache
+from vortex.compat import import_module, scandir
+from vortex.config import cfg
+from vortex.environment import runcmd
+from vortex.state import StateFile
+from vortex.utils import cached_property, run_concurrently
 
 
 logger = logging.getLogger(__name__)
 
+#: YAML loader used to parse step configuration: the fast libyaml-based loader
+#: if PyYAML was built with it, otherwise the pure-Python one.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 class DeploymentError(Exception):
     """
@@ -42,6 +57,124 @@ class DeploymentError(Exception):
     """
 
 
+class Manifest(object):
+    """
+    Index of the deployment configuration within an acquired payload.
+
+    The manifest is built from a single scan of the payload's ``.vortex``
+    directory and its ``hooks`` sub-directory, so that step configuration and
+    hook dispatch don't need to probe the filesystem file by file.
+
+    `directory` is the payload directory. The following attributes are
+    available:
+
+        ``exists``
+           Whether the ``.vortex`` directory exists.
+
+        ``steps``
+           A list of ``(filename, kind)`` tuples for the files in the
+           ``.vortex`` directory, sorted by filename. `kind` is ``'json'``,
+           ``'yaml'``, ``'exec'`` (an executable file) or ``None`` (a file of
+           unknown type).
+
+        ``hooks``
+           A dictionary mapping hook names to the paths of the executable hook
+           scripts in the ``hooks`` directory.
+
+        ``hook_options``
+           A dictionary mapping hook names to dictionaries of options for
+           those hooks, read from the :data:`HOOKS_METADATA` file in the
+           ``hooks`` directory if it exists. See
+           :meth:`vortex.payload.Payload.call_hooks` for the options
+           available.
+
+    A file counts as executable if it is a regular file (or a symlink to one)
+    with any of its execute permission bits set.
+    """
+    #: Name of the directory (within :data:`Deployer.CFG_DIRNAME`) holding
+    #: hook scripts.
+    HOOKS_DIRNAME = 'hooks'
+
+    #: Name of the (optional) YAML file in the hooks directory which gives
+    #: options for the hooks.
+    HOOKS_METADATA = 'hooks.yaml'
+
+    def __init__(self, directory):
+        super(Manifest, self).__init__()
+        self.config_dir = os.path.join(directory, Deployer.CFG_DIRNAME)
+        self.exists = False
+        self.steps = []
+        self.hooks = {}
+        self.hook_options = {}
+        self.__scan()
+
+    @staticmethod
+    def _entries(path):
+        # Return a sorted list of (name, path, mode) for the files in a
+        # directory, or None if the directory can't be read. Directories and
+        # broken symlinks are left out.
+        entries = []
+
+        try:
+            for entry in scandir(path):
+                try:
+                    mode = entry.stat().st_mode
+                except OSError:
+                    continue
+                if stat.S_ISREG(mode):
+                    entries.append((entry.name, entry.path, mode))
+        except OSError:
+            return None
+
+        return sorted(entries)
+
+    @staticmethod
+    def _executable(mode):
+        return bool(mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+
+    def __scan(self):
+        entries = self._entries(self.config_dir)
+        if entries is None:
+            return
+        self.exists = True
+
+        for (name, _, mode) in entries:
+            if name.endswith('.json'):
+                kind = 'json'
+            elif name.endswith('.yaml'):
+                kind = 'yaml'
+            elif self._executable(mode):
+                kind = 'exec'
+            else:
+                kind = None
+            self.steps.append((name, kind))
+
+        hooks_dir = os.path.join(self.config_dir, self.HOOKS_DIRNAME)
+        for (name, path, mode) in self._entries(hooks_dir) or []:
+            if name == self.HOOKS_METADATA:
+                self.__read_hook_options(path)
+            elif self._executable(mode):
+                self.hooks[name] = path
+
+    def __read_hook_options(self, path):
+        with open(path, 'rb') as fp:
+            try:
+                options = yaml.load(fp, Loader=YamlLoader)
+            except yaml.YAMLError as e:
+                logger.warning("{path}: ignoring invalid hook options: {e}"
+                               .format(path=path, e=e))
+                return
+
+        if not isinstance(options, collections.Mapping):
+            logger.warning("{path}: hook options must be a mapping".format(
+                path=path))
+            return
+
+        for (name, value) in six.iteritems(options):
+            if isinstance(value, collections.Mapping):
+                self.hook_options[name] = value
+
+
 class Deployer(object):
     """
     Read deployment configuration and run deployment steps.
@@ -53,15 +186,56 @@ class Deployer(object):
 
     The `payload` argument should be an instance of
     :class:`vortex.payload.Payload`.
+
+    The following configuration options are *optional*:
+
+    ``[deployment].workers`` = ``4``
+       The default number of steps in a ``parallel`` group (see
+       :meth:`configure`) which may run at the same time.
+
+    ``[deployment].step_cache`` = ``yes``
+       Whether to cache parsed YAML step files. The parsed documents are
+       stored as JSON in the ``steps`` cache (see :mod:`vortex.cache`), keyed
+       by a hash of the file's contents, so unchanged files need not be parsed
+       again on later runs.
+
+    ``[deployment].resume`` = ``no``
+       Whether a deployment which failed part way through is resumed from the
+       failed step, rather than started again from the beginning, when the
+       same revision of the payload is deployed again. See :meth:`deploy`.
+
+       .. note:: The payload is acquired afresh (into a new directory)
+          before it is deployed again, so anything the skipped steps wrote
+          into the payload directory, such as build output or generated
+          configuration, is *not* there when deployment resumes. Only enable
+          this if the steps of the payloads affected change the rest of the
+          system (installing packages, configuring services and so on), or
+          write their output outside the payload directory.
     """
     #: The name of the directory within the payload to read the deployment
     #: configuration from.
     CFG_DIRNAME = '.vortex'
 
+    #: Keys in a step configuration mapping which are options applying to the
+    #: steps defined alongside them, rather than deployment handler names.
+    STEP_OPTIONS = ('inputs', 'creates', 'unless', 'onlyif')
+
     def __init__(self, payload):
         super(Deployer, self).__init__()
         self.payload = payload
         self.steps = []
+        self.__step_count = 0
+        self.__state_lock = threading.Lock()
+
+        cfg.set_default('deployment', 'workers', '4')
+        cfg.set_default('deployment', 'step_cache', 'yes')
+        cfg.set_default('deployment', 'resume', 'no')
+        self.workers = cfg.getint('deployment', 'workers')
+        self.resume = cfg.getboolean('deployment', 'resume')
+        self.step_cache = None
+        if cfg.getboolean('deployment', 'step_cache'):
+            self.step_cache = Cache('steps')
+
         self.configure()
 
     @cached_property
@@ -76,28 +250,60 @@ class Deployer(object):
         .. todo:: Should the payload configuration directory
             (:data:`CFG_DIRNAME`) be configurable?
         """
-        path = os.path.join(self.payload.directory, self.CFG_DIRNAME)
-
-        if not os.path.isdir(path):
+        if not self.payload.manifest.exists:
             raise DeploymentError("Payload configuration missing")
 
-        return path
+        return self.payload.manifest.config_dir
+
+    def _make_steps(self, config, source):
+        # Iterate the keys in config (a dict), creating and returning a list
+        # of DeploymentHandler instances (or a StepGroup for a 'parallel'
+        # group). Step options are separated out and given to each of the
+        # handlers.
+        if 'parallel' in config:
+            if len(config) > 1:
+                raise DeploymentError(
+                    "{src}: 'parallel' cannot be combined with other keys"
+                    .format(src=source))
+            return [self._make_group(config['parallel'], source)]
+
+        options = dict(
+            (k, v) for (k, v) in six.iteritems(config)
+            if k in self.STEP_OPTIONS)
+        steps = []
 
-    @cached_property
-    def __config_filenames(self):
-        # Returns a sorted list of filenames (not paths) in the config
-        # directory.
-        for (_, _, filenames) in os.walk(self.config_dir):
-            # Just return the sorted list of files in the config directory
-            # itself, preventing iteration into child directories.
-            return sorted(filenames)
-
-    def _add_steps(self, config):
-        # Iterate the keys in config (a dict), creating a DeploymentHandler
-        # instance for each, then adding them to self.steps.
         for mod in config:
-            step = DeploymentHandler.factory(mod, self, config[mod])
-            self.steps.append(step)
+            if mod in options:
+                continue
+
+            step = DeploymentHandler.factory(mod, self, config[mod], options)
+            self.__step_count += 1
+            step.index = self.__step_count
+            step.key = "{source}:{mod}".format(source=source, mod=mod)
+            steps.append(step)
+
+        return steps
+
+    def _make_group(self, config, source):
+        # Create a StepGroup from the value of a 'parallel' key, which is
+        # either a list of step mappings or a mapping containing such a list
+        # as 'steps' and optionally the number of 'workers'.
+        workers = self.workers
+        if isinstance(config, collections.Mapping):
+            workers = int(config.get('workers', workers))
+            config = config.get('steps', [])
+
+        steps = []
+        for (n, member) in enumerate(config, 1):
+            steps.extend(self._make_steps(
+                member, "{src}/{n}".format(src=source, n=n)))
+
+        return StepGroup(self, steps, workers, source)
+
+    def _add_steps(self, config, source):
+        # Create the steps defined in config (a dict), adding them to
+        # self.steps.
+        self.steps.extend(self._make_steps(config, source))
 
     def _add_json_steps(self, filename):
         # Parse a JSON file, passing the result to self._add_steps()
@@ -107,17 +313,45 @@ class Deployer(object):
 
         with open(path, **open_kw) as fp:
             config = json.load(fp)
-            self._add_steps(config)
+            self._add_steps(config, filename)
+
+    def _parse_yaml(self, data):
+        # Parse the YAML documents in data (a byte string), returning them as
+        # a list. Results are looked up in, and added to, the step cache.
+        if self.step_cache is None:
+            return list(yaml.load_all(data, Loader=YamlLoader))
+
+        key = hashlib.sha256(data).hexdigest() + '.json'
+        cached = self.step_cache.read(key)
+        if cached is not None:
+            try:
+                return json.loads(cached.decode('utf-8'))
+            except ValueError:
+                pass
+
+        docs = list(yaml.load_all(data, Loader=YamlLoader))
+
+        # Only cache documents which survive a trip through JSON unchanged;
+        # YAML can express things (such as dates or non-string keys) which
+        # JSON cannot.
+        try:
+            snapshot = json.dumps(docs)
+        except (TypeError, ValueError):
+            return docs
+        if json.loads(snapshot) == docs:
+            self.step_cache.write(key, snapshot.encode('utf-8'))
+
+        return docs
 
     def _add_yaml_steps(self, filename):
         # Parse a YAML file, passing each parsed document to self._add_steps()
         path = os.path.join(self.config_dir, filename)
 
-        open_kw = {'encoding': 'utf-8'} if PY3 else {}
+        with open(path, 'rb') as fp:
+            docs = self._parse_yaml(fp.read())
 
-        with open(path, **open_kw) as fp:
-            for config in yaml.safe_load_all(fp):
-                self._add_steps(config)
+        for (n, config) in enumerate(docs, 1):
+            self._add_steps(config, "{f}#{n}".format(f=filename, n=n))
 
     def _add_exec_step(self, filename):
         # Handle an executable file (a script) by synthesising an 'exec'
@@ -126,7 +360,7 @@ class Deployer(object):
 
         self._add_steps({
             'exec': [[path]],
-        })
+        }, filename)
 
     def configure(self):
         """
@@ -135,7 +369,8 @@ class Deployer(object):
         This method:
 
         #. Processes all JSON (``.json``), YAML (``.yaml``) and executable
-           files within the ``.vortex`` configuration directory:
+           files within the ``.vortex`` configuration directory, as listed in
+           the payload's :class:`Manifest`:
 
            * JSON files must be an "object" at the root level.
            * YAML files may consist of a number of "documents", but they must
@@ -145,24 +380,58 @@ class Deployer(object):
            * If multiple deployment handlers are defined within a single
              configuration file, the order in which they are executed is
              *undefined*.
+           * The keys listed in :data:`STEP_OPTIONS` are not handler names but
+             options applying to every step in the same mapping; see
+             :meth:`deploy`.
+           * A mapping consisting of the single key ``parallel`` defines a
+             group of steps which are run concurrently (see below).
 
         #. A :class:`DeploymentHandler` subclass is instantiated for each step.
            The key from the mappings defined in the configuration files is used
            to locate the subclass. The value is passed to the sub-class in
            order to configure that particular step.
+
+        The value of a ``parallel`` key is a list of step mappings, or a
+        mapping with the list given as ``steps`` and optionally the number of
+        ``workers`` (defaulting to ``[deployment].workers``). For example:
+
+        .. code-block:: yaml
+
+           ---
+           parallel:
+             workers: 2
+             steps:
+               - exec: [/usr/local/bin/fetch-assets]
+               - packages: [nginx]
+               - creates: /etc/myapp/key.pem
+                 exec: [/usr/local/bin/make-key]
+
+        The steps in a group may run in any order and at the same time as one
+        another, up to the number of workers. The group as a whole occupies a
+        single position in the deployment sequence: it starts once all the
+        preceding steps have completed, and the following steps start only
+        once every step in the group has completed successfully. If any step
+        in the group fails, no further steps from the group are started and
+        the deployment fails once those already running have finished.
+        Package installations (such as the ``packages`` step above) can't
+        share the system's package database, so they run one at a time even
+        within a group (see :func:`vortex.environment.install_package`).
         """
-        for f in self.__config_filenames:
-            path = os.path.join(self.config_dir, f)
+        if not self.payload.manifest.exists:
+            raise DeploymentError("Payload configuration missing")
+
+        for (f, kind) in self.payload.manifest.steps:
+            count = len(self.steps)
 
-            if f.endswith('.json'):
+            if kind == 'json':
                 logger.debug("{p}: processing JSON step config".format(
                     p=os.path.join(self.CFG_DIRNAME, f)))
                 self._add_json_steps(f)
-            elif f.endswith('.yaml'):
+            elif kind == 'yaml':
                 logger.debug("{p}: processing YAML step config".format(
                     p=os.path.join(self.CFG_DIRNAME, f)))
                 self._add_yaml_steps(f)
-            elif os.access(path, os.R_OK | os.X_OK):
+            elif kind == 'exec':
                 logger.debug("{p}: processing executable step config".format(
                     p=os.path.join(self.CFG_DIRNAME, f)))
                 self._add_exec_step(f)
@@ -170,27 +439,293 @@ class Deployer(object):
                 logger.warn("{p}: skipping unknown file type".format(
                     p=os.path.join(self.CFG_DIRNAME, f)))
 
+            for step in self.steps[count:]:
+                step.filename = f
+
+    @cached_property
+    def step_state(self):
+        """
+        :class:`vortex.state.StateFile` recording the input hashes of steps
+        which last completed successfully.
+        """
+        return StateFile(os.path.join('steps', self.payload.name + '.json'))
+
+    @cached_property
+    def checkpoint(self):
+        """
+        :class:`vortex.state.StateFile` recording the progress of a deployment
+        which has not (yet) completed. See :meth:`deploy`.
+        """
+        return StateFile(
+            os.path.join('checkpoints', self.payload.name + '.json'))
+
+    def _step_hash(self, step, file_hashes):
+        # Hash a (top-level) step's configuration together with the contents
+        # of the file it was defined in. file_hashes caches the file hashes.
+        if step.filename not in file_hashes:
+            digest = hashlib.sha256()
+            path = os.path.join(self.config_dir, step.filename)
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(65536), b''):
+                    digest.update(chunk)
+            file_hashes[step.filename] = digest.hexdigest()
+
+        document = json.dumps(
+            [step.key, step.config, step.options, file_hashes[step.filename]],
+            sort_keys=True, default=str)
+        return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+    def _resume_point(self, revision, hashes):
+        # Return the number of leading steps which a checkpoint shows were
+        # completed by an earlier, failed deployment of the same revision,
+        # and which haven't changed since.
+        if not self.resume:
+            return 0
+        if revision is None:
+            logger.debug("{name}: cannot resume without a revision".format(
+                name=self.payload.name))
+            return 0
+
+        data = self.checkpoint.data
+        if data.get('revision') != revision:
+            return 0
+
+        completed = 0
+        for (done, current) in zip(data.get('steps', []), hashes):
+            if done != current:
+                break
+            completed += 1
+
+        return completed
+
+    def _guard_command(self, command):
+        # Run a guard command in the payload directory, returning True if it
+        # succeeds.
+        env = {
+            'VORTEX_ENVIRONMENT': self.payload.environment,
+        }
+        (ret, _) = runcmd(
+            ['/bin/sh', '-c', command], env=env, cwd=self.payload.directory)
+        return ret == 0
+
+    def _input_hash(self, step):
+        # Compute a hash of the step's configuration and the contents of all
+        # the files matched by its inputs. Returns None if the step has no
+        # inputs.
+        inputs = step.options.get('inputs')
+        if not inputs:
+            return None
+
+        if isinstance(inputs, six.string_types):
+            inputs = [inputs]
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            [step.key, step.config, inputs],
+            sort_keys=True, default=repr).encode('utf-8'))
+
+        paths = set()
+        for pattern in inputs:
+            pattern = os.path.join(self.payload.directory, pattern)
+            for path in glob.glob(pattern):
+                if os.path.isdir(path):
+                    for (root, _, filenames) in os.walk(path):
+                        paths.update(os.path.join(root, f) for f in filenames)
+                else:
+                    paths.add(path)
+
+        for path in sorted(paths):
+            relpath = os.path.relpath(path, self.payload.directory)
+            digest.update(b'\0' + relpath.encode('utf-8') + b'\0')
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(65536), b''):
+                    digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def _skip_reason(self, step, input_hash):
+        # Decide whether a step needs running. Returns a string explaining why
+        # the step is being skipped, or None if it should be run.
+        creates = step.options.get('creates')
+        if creates and os.path.exists(
+                os.path.join(self.payload.directory, creates)):
+            return "{path} exists".format(path=creates)
+
+        unless = step.options.get('unless')
+        if unless and self._guard_command(unless):
+            return "'unless' command succeeded"
+
+        onlyif = step.options.get('onlyif')
+        if onlyif and not self._guard_command(onlyif):
+            return "'onlyif' command failed"
+
+        if input_hash is not None:
+            with self.__state_lock:
+                last = self.step_state.data.get(step.key, {})
+            if last.get('hash') == input_hash:
+                return "inputs unchanged"
+
+        return None
+
     def deploy(self):
         """
         Execute the deployment steps defined in the configuration.
 
-        This method simply iterates over the steps configured using
-        :meth:`configure` and calls :meth:`DeploymentHandler.deploy` on each
-        step, in order.
+        This method iterates over the steps configured using :meth:`configure`
+        and calls :meth:`DeploymentHandler.deploy` on each step, in order.
+
+        A step is skipped if any of the following options were given alongside
+        it (checked in this order):
+
+        ``creates``
+           A path (relative to the payload directory, or absolute). The step
+           is skipped if the path exists.
+
+        ``unless``
+           A shell command, run in the payload directory. The step is skipped
+           if the command succeeds.
+
+        ``onlyif``
+           A shell command, run in the payload directory. The step is skipped
+           if the command fails.
+
+        ``inputs``
+           A glob pattern, or list of patterns, relative to the payload
+           directory. The step's configuration and the contents of the matched
+           files (directories are included recursively) are hashed; the step is
+           skipped if the hash matches that recorded the last time the step
+           completed successfully. The hashes are kept in a state file (see
+           :mod:`vortex.state`).
+
+        Progress is recorded in a checkpoint state file after each step
+        completes, and the checkpoint is removed once every step has
+        completed. If ``[deployment].resume`` is enabled and the checkpoint
+        shows that an earlier deployment of the same revision of the payload
+        (as recorded by the acquirer, see
+        :attr:`vortex.acquirer.Acquirer.acquired_revision`) failed, the steps
+        it completed are not run again, and deployment continues from the step
+        which failed. Only the steps before the first one whose configuration
+        or step file has changed since are treated as completed. Payloads
+        whose acquired revision is not known are always deployed from the
+        beginning. Note that the payload directory is new, so files written
+        to it by the skipped steps are missing; see ``[deployment].resume``.
+        """
+        revision = None
+        if self.resume:
+            revision = self.payload.acquirer.acquired_revision
+
+        file_hashes = {}
+        hashes = [self._step_hash(step, file_hashes) for step in self.steps]
+
+        resume = self._resume_point(revision, hashes)
+        if resume:
+            logger.info(
+                "{name}: resuming deployment at step {n}; {done} steps were "
+                "completed by an earlier attempt".format(
+                    name=self.payload.name, n=resume + 1, done=resume))
+
+        for (n, step) in enumerate(self.steps):
+            if n >= resume:
+                self._run_step(step)
+
+            self.checkpoint.data = {
+                'revision': revision,
+                'steps': hashes[:n + 1],
+                'time': time.time(),
+            }
+            self.checkpoint.save()
+
+        self.checkpoint.clear()
+
+    def prepare(self):
+        """
+        Call :meth:`DeploymentHandler.prepare` for each of the deployment
+        steps, so that as little work as possible is left for :meth:`deploy`.
+        """
+        for step in self.steps:
+            step.prepare()
+
+    def _run_step(self, step):
+        # Run a single step (or group of steps) unless it is to be skipped,
+        # recording its input hash on success.
+        input_hash = self._input_hash(step)
+        reason = self._skip_reason(step, input_hash)
+
+        if reason is not None:
+            logger.info("{name}: skipping step {n} ({key}): {why}".format(
+                name=self.payload.name, n=step.index, key=step.key,
+                why=reason))
+            return
+
+        step.deploy()
+
+        if input_hash is not None:
+            with self.__state_lock:
+                self.step_state.data[step.key] = {
+                    'hash': input_hash,
+                    'time': time.time(),
+                }
+                self.step_state.save()
+
+
+class StepGroup(object):
+    """
+    A group of deployment steps which are run concurrently.
+
+    Created by :class:`Deployer` for ``parallel`` groups in the deployment
+    configuration. `steps` is the list of :class:`DeploymentHandler` (or
+    nested :class:`StepGroup`) objects in the group, and up to `workers` of
+    them are run at once. `key` identifies the group by the configuration it
+    came from.
+    """
+    def __init__(self, deployer, steps, workers, key):
+        super(StepGroup, self).__init__()
+        self.deployer = deployer
+        self.steps = steps
+        self.workers = workers
+        self.key = key
+        self.index = None
+        self.filename = None
+        self.config = None
+        self.options = {}
+
+    def deploy(self):
+        """
+        Run all the steps in the group, returning once they have all finished.
+        """
+        logger.debug("{key}: running {n} steps with {w} workers".format(
+            key=self.key, n=len(self.steps), w=self.workers))
+
+        run_concurrently(
+            [functools.partial(self.deployer._run_step, step)
+             for step in self.steps],
+            self.workers)
+
+    def prepare(self):
+        """
+        Prepare all the steps in the group. See :meth:`Deployer.prepare`.
         """
         for step in self.steps:
-            step.deploy()
+            step.prepare()
 
 
 @six.add_metaclass(abc.ABCMeta)
 class DeploymentHandler(object):
     """
     Abstract base class for deployment handler mechanisms.
+
+    Once added to a :class:`Deployer`, the :attr:`index` attribute holds the
+    step's (1-based) position in the deployment sequence, which is useful for
+    identifying the step in log messages, and the :attr:`key` attribute holds
+    a string identifying the step by the configuration file it came from.
+
+    The handler's configuration is kept in :attr:`config`, and any step
+    options (see :meth:`Deployer.deploy`) in the :attr:`options` dictionary.
     """
     __registered = {}
 
     @classmethod
-    def factory(cls, module, deployer, config):
+    def factory(cls, module, deployer, config, options=None):
         """
         Find and configure a deployment handler.
 
@@ -204,16 +739,16 @@ class DeploymentHandler(object):
         prepended. For example, the module name ``exec`` causes the
         ``vortex.deployment.exec`` module to be loaded.
 
-        The located class is then instantiated with the given `deployer` and
-        `config` passed to the constructor as its arguments. The resulting
-        object is returned.
+        The located class is then instantiated with the given `deployer`,
+        `config` and `options` passed to the constructor as its arguments. The
+        resulting object is returned.
         """
         # Prepend package prefix if required
         if '.' not in module:
             module = 'vortex.deployment.' + module
 
         klass = cls.__locate(module)
-        handler = klass(deployer, config)
+        handler = klass(deployer, config, options)
 
         return handler
 
@@ -267,10 +802,15 @@ class DeploymentHandler(object):
 
         return handler
 
-    def __init__(self, deployer, config):
+    def __init__(self, deployer, config, options=None):
         super(DeploymentHandler, self).__init__()
         self.deployer = deployer
         self.payload = deployer.payload
+        self.config = config
+        self.options = options or {}
+        self.index = None
+        self.key = None
+        self.filename = None
         self.configure(config)
 
     @abc.abstractmethod
@@ -302,3 +842,12 @@ class DeploymentHandler(object):
         .. note:: This is an *abstract method* and **must** be implemented by
             sub-classes.
         """
+
+    def prepare(self):
+        """
+        Do whatever can be done in advance to make :meth:`deploy` quicker,
+        without changing the system, such as downloading packages. This is
+        called when preparing a machine image (see :mod:`vortex.prebake`).
+
+        The default implementation does nothing.
+        """
@@ -17,13 +17,21 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import collections
+import errno
 import logging
 import os
 import subprocess
+import sys
+import uuid
 
-from vortex.compat import shell_quote
+from vortex.compat import monotonic, new_session_kwargs, shell_quote
+from vortex.config import cfg
 from vortex.deployment import DeploymentHandler, DeploymentError
-from vortex.utils import list_to_cmdline
+from vortex.environment import (
+    OutputPump, OutputTail, Watchdog, decode_line, pump_output)
+from vortex.logsetup import AsyncFileWriter
+from vortex.utils import list_to_cmdline, parse_boolean, parse_timeout
 
 
 logger = logging.getLogger(__name__)
@@ -50,6 +58,18 @@ class ExecHandler(DeploymentHandler):
                - www/
                - /var/www/myapp/
 
+    * From a YAML document or JSON file using the mapping form, which allows
+      further options to be given for the step:
+
+        .. code-block:: yaml
+
+           ---
+           exec:
+             timeout: 300
+             commands:
+               - /usr/local/bin/fetch-assets
+               - /usr/local/bin/warm-cache
+
     * By placing executable files (that is, files with the executable bit set)
       into the ``.vortex`` directory.
 
@@ -76,8 +96,75 @@ class ExecHandler(DeploymentHandler):
     Standard input is connected to ``/dev/null``, while standard output and
     standard error are passed-through as-is: any command output will be seen on
     the executing console and unseen (and for example not redirected to syslog)
-    by Vortex.
+    by Vortex, unless capture mode is enabled.
+
+    In capture mode, standard output and standard error are read by Vortex as
+    they are produced and each line is sent to the logging framework (and
+    hence to syslog if so configured), tagged with the payload name, the step
+    number and the number of the command within the step. The last part of the
+    output is attached to the :exc:`vortex.deployment.DeploymentError` raised
+    if a command fails. If a log directory is configured, the full output of
+    each step is also written (from a background thread) to
+    ``<log_dir>/<payload>/step-<NNN>.log``.
+
+    The following options may be given in the mapping form of the
+    configuration:
+
+        ``commands``
+           The list of commands to execute, as described above.
+
+        ``timeout``
+           The number of seconds that the step as a whole is allowed to take.
+           Each command is given whatever remains of the step's allowance; if
+           a command is still running when the allowance is used up, its whole
+           process group is sent ``SIGTERM`` (and then ``SIGKILL``) and the
+           step fails. Zero means no timeout.
+
+        ``capture``
+           Whether to enable capture mode for this step (a boolean).
+
+        ``session``
+           If true, all the commands in the step are run by a single
+           long-lived shell process rather than each in a fresh process,
+           avoiding the cost of starting a shell for every command. Commands
+           are fed to the shell one at a time; each one's exit status is
+           checked and the step fails at the first command to fail. Because
+           the commands share a shell, changes such as ``cd`` or variable
+           assignments persist from one command to the next. List commands
+           are quoted and run by the shell too.
+
+    The following ``vortex.ini`` configuration options are *optional*:
+
+        ``[exec].timeout`` = ``0``
+           Default ``timeout`` for ``exec`` steps which don't specify one
+           (including executable files in the ``.vortex`` directory). Zero
+           means no timeout.
+
+        ``[exec].capture`` = ``no``
+           Default ``capture`` setting for ``exec`` steps which don't specify
+           one.
+
+        ``[exec].log_dir``
+           Directory in which to write the captured output of each step. If
+           not set, captured output is only sent to the logging framework.
     """
+    #: Configuration section in ``vortex.ini`` for handler-wide defaults
+    CFG_SECTION = 'exec'
+
+    #: Shell code used to run each command in session mode. The command is
+    #: quoted and run by ``command eval``, so that even one with a syntax error
+    #: (such as an unbalanced quote) can't swallow the lines which follow it,
+    #: or make the shell exit.
+    SESSION_SCRIPT = (
+        "{{\n"
+        "command eval {cmd}\n"
+        "}} </dev/null\n"
+        "printf '%s %d\\n' {token} \"$?\"\n"
+    )
+
+    #: Shell code added to :data:`SESSION_SCRIPT` when standard error is
+    #: captured, marking the end of each command's output on it too
+    SESSION_STDERR = "printf '%s\\n' {token} >&2\n"
 
     def configure(self, config):
         """
@@ -86,19 +173,95 @@ class ExecHandler(DeploymentHandler):
 
         See :meth:`vortex.deployment.DeploymentHandler.configure`.
         """
-        self.commands = config
+        cfg.set_default(self.CFG_SECTION, 'timeout', '0')
+        cfg.set_default(self.CFG_SECTION, 'capture', 'no')
+        cfg.set_default(self.CFG_SECTION, 'log_dir', '')
+        timeout = cfg.get(self.CFG_SECTION, 'timeout')
+        self.capture = cfg.getboolean(self.CFG_SECTION, 'capture')
+        self.log_dir = cfg.get(self.CFG_SECTION, 'log_dir')
 
-    def _runcmd(self, args):
+        if isinstance(config, collections.Mapping):
+            try:
+                self.commands = config['commands']
+            except KeyError:
+                raise DeploymentError("exec step is missing 'commands'")
+            timeout = config.get('timeout', timeout)
+            try:
+                self.capture = parse_boolean(
+                    config.get('capture', self.capture))
+                self.session = parse_boolean(config.get('session', False))
+            except ValueError as e:
+                raise DeploymentError(
+                    "Invalid exec step option: {e}".format(e=e))
+        else:
+            self.commands = config
+            self.session = False
+
+        try:
+            self.timeout = parse_timeout(timeout)
+        except ValueError:
+            raise DeploymentError(
+                "Invalid exec timeout: {t}".format(t=timeout))
+
+    def _open_step_log(self):
+        # Open the per-step log file (if configured) for captured output
+        if not self.capture or not self.log_dir:
+            return None
+
+        directory = os.path.join(self.log_dir, self.payload.name)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Another step in a parallel group may have just created it
+            if e.errno != errno.EEXIST:
+                raise
+
+        return AsyncFileWriter(os.path.join(
+            directory, "step-{index:03d}.log".format(index=self.index)))
+
+    def _line_handler(self, number, tail, step_log):
+        # Returns a function which relays a line of captured output from
+        # command `number` to the logging framework, the step log and the
+        # output tail.
+        prefix = "{name} step {step} cmd {cmd}".format(
+            name=self.payload.name, step=self.index, cmd=number)
+        extra = {
+            'payload': self.payload.name,
+            'step': self.index,
+            'command': number,
+        }
+        log_output = logger.isEnabledFor(logging.INFO)
+
+        def handle_line(stream, line):
+            tail.append(line)
+            text = decode_line(line)
+
+            if log_output:
+                extra['stream'] = stream
+                logger.info("{pfx} {stream}: {text}".format(
+                    pfx=prefix, stream=stream, text=text), extra=extra)
+
+            if step_log is not None:
+                step_log.write("[{cmd} {stream}] {text}\n".format(
+                    cmd=number, stream=stream, text=text))
+
+        return handle_line
+
+    def _capture(self, p, number, tail, step_log):
+        # Relay the output of a running command until it closes its output.
+        handle_line = self._line_handler(number, tail, step_log)
+        pump_output({'stdout': p.stdout, 'stderr': p.stderr}, handle_line)
+        p.stdout.close()
+        p.stderr.close()
+
+    def _environment(self, args):
+        # Returns the environment for running commands, logging the command
+        # line we're about to run along with it.
         env = {
             'PATH': os.environ.get('PATH'),
             'VORTEX_ENVIRONMENT': self.payload.environment,
         }
 
-        if str(args) == args:
-            # If we're asked to exec a simple string, we'll call a shell to do
-            # the work.
-            args = ['/bin/sh', '-c', args]
-
         if logger.isEnabledFor(logging.DEBUG):
             debug_env = ' '.join(
                 "{var}={val}".format(
@@ -107,12 +270,47 @@ class ExecHandler(DeploymentHandler):
             logger.debug("Running: env -i {env} {cmd}".format(
                 env=debug_env, cmd=list_to_cmdline(args)))
 
+        return env
+
+    def _runcmd(self, args, timeout, number, tail, step_log):
+        if str(args) == args:
+            # If we're asked to exec a simple string, we'll call a shell to do
+            # the work.
+            args = ['/bin/sh', '-c', args]
+
+        env = self._environment(args)
+
+        # Only detach the command into its own process group if we might need
+        # to kill it, so that otherwise signals from the console still reach
+        # it.
+        popen_kw = new_session_kwargs if timeout is not None else {}
+        output = subprocess.PIPE if self.capture else None
+
+        if step_log is not None:
+            step_log.write("[{cmd}] $ {args}\n".format(
+                cmd=number, args=list_to_cmdline(args)))
+
         with open(os.devnull, 'r') as devnull:
             p = subprocess.Popen(
                 args,
-                stdin=devnull, stdout=None, stderr=None,
-                close_fds=True, cwd=self.payload.directory, env=env)
-            ret = p.wait()
+                stdin=devnull, stdout=output, stderr=output,
+                close_fds=True, cwd=self.payload.directory, env=env,
+                **popen_kw)
+
+            with Watchdog(p, timeout) as watchdog:
+                if self.capture:
+                    self._capture(p, number, tail, step_log)
+                ret = p.wait()
+
+        if step_log is not None:
+            step_log.write("[{cmd}] exit {ret} after {elapsed:.1f}s\n".format(
+                cmd=number, ret=ret, elapsed=watchdog.elapsed))
+
+        if watchdog.expired:
+            raise DeploymentError(
+                "Deployment exec timed out after {elapsed:.1f}s: {cmd}".format(
+                    elapsed=watchdog.elapsed, cmd=list_to_cmdline(args)),
+                tail.getvalue())
 
         return ret
 
@@ -122,11 +320,157 @@ class ExecHandler(DeploymentHandler):
 
         See :meth:`vortex.deployment.DeploymentHandler.deploy`.
         """
-        for cmd in self.commands:
-            ret = self._runcmd(cmd)
+        tail = OutputTail()
+        step_log = self._open_step_log()
+
+        try:
+            if self.session:
+                self._run_session(tail, step_log)
+            else:
+                self._run_commands(tail, step_log)
+        finally:
+            if step_log is not None:
+                step_log.close()
+
+    def _run_commands(self, tail, step_log):
+        # Run each command in turn as its own process
+        start = monotonic()
+
+        for (number, cmd) in enumerate(self.commands, 1):
+            # Each command gets whatever is left of the step's allowance
+            timeout = None
+            if self.timeout is not None:
+                timeout = self.timeout - (monotonic() - start)
+                if timeout <= 0:
+                    raise DeploymentError(
+                        "Deployment exec step timed out after {t}s".format(
+                            t=self.timeout), tail.getvalue())
+
+            ret = self._runcmd(cmd, timeout, number, tail, step_log)
             logger.debug("Exit code: {ret}".format(ret=ret))
 
             if ret != 0:
                 raise DeploymentError(
-                    "Deployment exec returned failure ({ret}): {cmd}".format(
-                        ret=ret, cmd=cmd))
+                    "Deployment exec returned failure ({ret}): {cmd}"
+                    .format(ret=ret, cmd=cmd), tail.getvalue())
+
+    def _session_script(self, cmd, token):
+        # Wrap a command for the session shell: run it with standard input
+        # from /dev/null (so it can't eat the commands that follow it), then
+        # report its exit status after the session's sentinel token.
+        if str(cmd) != cmd:
+            cmd = list_to_cmdline(cmd)
+
+        script = self.SESSION_SCRIPT.format(cmd=shell_quote(cmd), token=token)
+        if self.capture:
+            script += self.SESSION_STDERR.format(token=token)
+        return script
+
+    def _run_session(self, tail, step_log):
+        # Run all the commands in a single shell process, feeding them in one
+        # at a time and waiting for the sentinel reporting each exit status.
+        token = "VORTEX-{u}".format(u=uuid.uuid4().hex)
+        sentinel = token.encode('ascii')
+        state = {
+            'number': None, 'status': None, 'handler': None, 'waiting': set(),
+        }
+        console = getattr(sys.stdout, 'buffer', sys.stdout)
+
+        def handle_line(stream, line):
+            # Each command's output ends with the sentinel on standard output
+            # (followed by its exit status) and, if captured, standard error.
+            # Only once both have been seen is all of its output in.
+            stop = False
+            if sentinel in line:
+                (line, _, status) = line.partition(sentinel)
+                if stream == 'stdout':
+                    state['status'] = int(status.strip())
+                state['waiting'].discard(stream)
+                stop = not state['waiting']
+                if not line:
+                    return stop
+
+            if state['handler'] is not None:
+                state['handler'](stream, line)
+            else:
+                console.write(line)
+                console.flush()
+
+            return stop
+
+        args = ['/bin/sh']
+        env = self._environment(args)
+        popen_kw = new_session_kwargs if self.timeout is not None else {}
+        stderr = subprocess.PIPE if self.capture else None
+
+        p = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+            close_fds=True, cwd=self.payload.directory, env=env, **popen_kw)
+
+        pipes = {'stdout': p.stdout}
+        if self.capture:
+            pipes['stderr'] = p.stderr
+        pump = OutputPump(pipes, handle_line)
+
+        with Watchdog(p, self.timeout) as watchdog:
+            try:
+                for (number, cmd) in enumerate(self.commands, 1):
+                    logger.debug("Session command {n}: {cmd}".format(
+                        n=number, cmd=cmd))
+                    if self.capture:
+                        state['handler'] = self._line_handler(
+                            number, tail, step_log)
+                    if step_log is not None:
+                        step_log.write("[{n}] $ {cmd}\n".format(
+                            n=number, cmd=cmd))
+
+                    state.update(number=number, status=None,
+                                 waiting=set(pipes))
+                    try:
+                        script = self._session_script(cmd, token)
+                        p.stdin.write(script.encode('utf-8'))
+                        p.stdin.flush()
+                    except (IOError, OSError) as e:
+                        # The shell has gone away; we'll report that below
+                        if e.errno != errno.EPIPE:
+                            raise
+                        break
+
+                    # Wait for the sentinel; stop now if the shell exited or
+                    # the command failed.
+                    if not pump.pump() or state['status'] != 0:
+                        break
+
+                    if step_log is not None:
+                        step_log.write("[{n}] exit 0\n".format(n=number))
+            finally:
+                # Closing the shell's input makes it exit; drain any output
+                # it produces on the way.
+                try:
+                    p.stdin.close()
+                except (IOError, OSError):
+                    pass
+                while pump.pump():
+                    pass
+                ret = p.wait()
+
+        if watchdog.expired:
+            raise DeploymentError(
+                "Deployment exec session timed out after {elapsed:.1f}s "
+                "running command {n}".format(
+                    elapsed=watchdog.elapsed, n=state['number']),
+                tail.getvalue())
+
+        if state['status'] is None:
+            raise DeploymentError(
+                "Deployment exec session shell exited ({ret}) while running "
+                "command {n}".format(ret=ret, n=state['number']),
+                tail.getvalue())
+
+        if state['status'] != 0:
+            raise DeploymentError(
+                "Deployment exec returned failure ({ret}): {cmd}".format(
+                    ret=state['status'],
+                    cmd=self.commands[state['number'] - 1]),
+                tail.getvalue())
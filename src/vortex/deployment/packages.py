@@ -95,3 +95,11 @@ class PackagesHandler(DeploymentHandler):
         See :meth:`vortex.deployment.DeploymentHandler.deploy`.
         """
         install_package(self.packages)
+
+    def prepare(self):
+        """
+        Download the packages without installing them.
+
+        See :meth:`vortex.deployment.DeploymentHandler.prepare`.
+        """
+        install_package(self.packages, download_only=True)
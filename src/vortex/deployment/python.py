@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import hashlib
+import io
+import logging
+import os
+import os.path
+import re
+import shutil
+import six
+import threading
+import weakref
+
+from vortex.compat import load_source
+from vortex.deployment import DeploymentHandler, DeploymentError
+from vortex.environment import runcmd
+
+
+logger = logging.getLogger(__name__)
+
+#: Module names must be plain Python identifiers; they name files in the
+#: payload's library directory.
+_MODULE_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class StepContext(object):
+    """
+    Helper object passed to functions called by the ``python`` deployment
+    handler.
+
+    The following attributes are available:
+
+        ``payload``
+           The :class:`vortex.payload.Payload` being deployed.
+
+        ``deployer``
+           The :class:`vortex.deployment.Deployer` deploying the payload.
+
+        ``directory``
+           The payload directory (a shortcut for ``payload.directory``).
+
+        ``environment``
+           The payload's configured environment name, as passed to ``exec``
+           steps in the ``VORTEX_ENVIRONMENT`` variable.
+
+        ``logger``
+           A :class:`logging.Logger` for the function to report its progress.
+
+    Relative paths given to the helper methods are interpreted relative to
+    the payload directory.
+    """
+    def __init__(self, handler):
+        super(StepContext, self).__init__()
+        self.deployer = handler.deployer
+        self.payload = handler.payload
+        self.directory = handler.payload.directory
+        self.environment = handler.payload.environment
+        self.logger = logging.getLogger(
+            "{mod}.{payload}".format(mod=__name__, payload=self.payload.name))
+
+    def path(self, *parts):
+        """
+        Join `parts` into a path, relative to the payload directory unless the
+        result is absolute.
+        """
+        return os.path.join(self.directory, *parts)
+
+    def ensure_dir(self, path, mode=None):
+        """
+        Create the directory `path` (and any parents) if it doesn't exist. If
+        `mode` is given, the directory's permissions are set to it.
+        """
+        path = self.path(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if mode is not None:
+            os.chmod(path, mode)
+        return path
+
+    def write_file(self, path, content, mode=None):
+        """
+        Atomically replace the file at `path` with `content`.
+
+        `content` may be text (written as UTF-8) or bytes. The new file is
+        written alongside the destination then renamed into place, so readers
+        never see a partially-written file. If `mode` is given, the file's
+        permissions are set to it.
+        """
+        path = self.path(path)
+        tmp = "{path}.vortex-tmp".format(path=path)
+
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+
+        with io.open(tmp, 'wb') as fp:
+            fp.write(content)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.rename(tmp, path)
+
+        return path
+
+    def copy(self, src, dst):
+        """
+        Copy the file `src` to `dst`, preserving its permissions.
+        """
+        dst = self.path(dst)
+        shutil.copy2(self.path(src), dst)
+        return dst
+
+    def run(self, args, env=None, timeout=None):
+        """
+        Run a command using :func:`vortex.environment.runcmd` in streaming
+        mode, from the payload directory. Returns the command's output, or
+        raises a :exc:`vortex.deployment.DeploymentError` if it fails.
+        """
+        if env is None:
+            env = {}
+        env.setdefault('VORTEX_ENVIRONMENT', self.environment)
+
+        (ret, out) = runcmd(
+            list(args), env=env, cwd=self.directory, stream=True,
+            context=self.payload.name, timeout=timeout)
+
+        if ret != 0:
+            raise DeploymentError(
+                "Command returned failure ({ret}): {cmd}".format(
+                    ret=ret, cmd=args[0]), out)
+
+        return out
+
+
+@DeploymentHandler.register
+class PythonHandler(DeploymentHandler):
+    """
+    ``python`` deployment handler.
+
+    This deployment handler calls Python functions from modules shipped within
+    the payload, in the Vortex process itself. This avoids the cost of
+    starting a new process for each step, which makes it well suited to steps
+    that mostly manipulate files.
+
+    Modules are loaded from the ``lib`` directory within the payload's
+    ``.vortex`` directory, so the module ``myapp`` is read from
+    ``.vortex/lib/myapp.py``. For example (in YAML):
+
+    .. code-block:: yaml
+
+       ---
+       python:
+         module: myapp
+         call:
+           - create_directories
+           - function: render_config
+             args:
+               template: etc/myapp.conf.in
+               dest: /etc/myapp.conf
+
+    The following configuration options are *required*:
+
+        ``module``
+           The name of the module to load from the ``lib`` directory.
+
+        ``call``
+           A list of functions to call, in order. Each entry is either the
+           name of a function in the module, or a mapping with a ``function``
+           key giving the name and an optional ``args`` mapping of keyword
+           arguments to pass to it.
+
+    Each function is called with a :class:`StepContext` as its only
+    positional argument, followed by any configured keyword arguments. The
+    return value is ignored. If a function raises an exception, the step fails
+    with a :exc:`vortex.deployment.DeploymentError` whose arguments include the
+    original exception object; the traceback is logged.
+    """
+    #: Name of the directory (within :data:`Deployer.CFG_DIRNAME`) from which
+    #: modules are loaded.
+    LIB_DIRNAME = 'lib'
+
+    #: Modules already loaded for each :class:`Deployer`, keyed by path and
+    #: content hash, so that a module used by several steps is only loaded
+    #: once per deployment but changes to it are picked up.
+    __modules = weakref.WeakKeyDictionary()
+    __modules_lock = threading.Lock()
+
+    def configure(self, config):
+        """
+        Configure this deployment helper based on settings from the deployment
+        configuration.
+
+        See :meth:`vortex.deployment.DeploymentHandler.configure`.
+        """
+        if not isinstance(config, collections.Mapping):
+            raise DeploymentError(
+                "python step configuration must be a mapping")
+
+        try:
+            self.module = config['module']
+            calls = config['call']
+        except KeyError as e:
+            raise DeploymentError(
+                "python step is missing '{key}'".format(key=e.args[0]))
+
+        if not _MODULE_RE.match(self.module):
+            raise DeploymentError(
+                "Invalid python step module name: {mod}".format(
+                    mod=self.module))
+
+        if not isinstance(calls, list):
+            raise DeploymentError("python step 'call' must be a list")
+
+        self.calls = []
+        for call in calls:
+            if isinstance(call, six.string_types):
+                self.calls.append((call, {}))
+                continue
+            if not isinstance(call, collections.Mapping):
+                raise DeploymentError(
+                    "python step call must be a function name or a mapping")
+
+            try:
+                name = call['function']
+            except KeyError:
+                raise DeploymentError(
+                    "python step call is missing 'function'")
+
+            args = call.get('args') or {}
+            if not isinstance(name, six.string_types) or \
+                    not isinstance(args, collections.Mapping):
+                raise DeploymentError(
+                    "Invalid python step call: {call}".format(call=call))
+            self.calls.append((name, args))
+
+    def _load_module(self):
+        # Load (or reuse) the configured module from the payload
+        path = os.path.join(
+            self.deployer.config_dir, self.LIB_DIRNAME, self.module + '.py')
+
+        if not os.path.isfile(path):
+            raise DeploymentError(
+                "python step module not found: {path}".format(path=path))
+
+        with open(path, 'rb') as fp:
+            key = (path, hashlib.sha256(fp.read()).hexdigest())
+
+        # Hold the lock while loading so that parallel steps don't both load
+        # the same module
+        with self.__modules_lock:
+            modules = self.__modules.setdefault(self.deployer, {})
+            try:
+                return modules[key]
+            except KeyError:
+                pass
+
+            module = self.__load(path)
+            modules[key] = module
+            return module
+
+    def __load(self, path):
+        # Give the module a name that can't clash with anything else loaded
+        name = "vortex.payloads.{payload}.{mod}".format(
+            payload=self.payload.name, mod=self.module)
+
+        try:
+            module = load_source(name, path)
+        except Exception as e:
+            logger.exception("Failed to load {path}".format(path=path))
+            raise DeploymentError(
+                "Cannot load python step module {mod}: {e}".format(
+                    mod=self.module, e=e), e)
+
+        return module
+
+    def deploy(self):
+        """
+        Perform the configured deployment step.
+
+        See :meth:`vortex.deployment.DeploymentHandler.deploy`.
+        """
+        module = self._load_module()
+        context = StepContext(self)
+
+        for (name, kwargs) in self.calls:
+            try:
+                func = getattr(module, name)
+            except AttributeError:
+                raise DeploymentError(
+                    "python step module {mod} has no function {fn}".format(
+                        mod=self.module, fn=name))
+
+            logger.debug("Calling {mod}.{fn}".format(mod=self.module, fn=name))
+
+            try:
+                func(context, **kwargs)
+            except DeploymentError:
+                raise
+            except Exception as e:
+                logger.exception("{mod}.{fn} failed".format(
+                    mod=self.module, fn=name))
+                raise DeploymentError(
+                    "python step {mod}.{fn} failed: {e}".format(
+                        mod=self.module, fn=name, e=e), e)
@@ -32,13 +32,19 @@ modules using distribution tooling (e.g. Apt or Yum).
 from __future__ import absolute_import, print_function, unicode_literals
 
 import collections
+import errno
+import fcntl
 import logging
 import os
 import platform
+import select
+import signal
 import subprocess
 import sys
+import threading
 
-from vortex.compat import import_module, shell_quote
+from vortex.compat import (
+    import_module, monotonic, new_session_kwargs, shell_quote)
 from vortex.utils import list_to_cmdline
 
 
@@ -47,6 +53,14 @@ logger = logging.getLogger(__name__)
 _PY3 = sys.version_info[0] == 3
 _STRING_TYPES = (str,) if _PY3 else (basestring,)  # noqa
 
+#: Default number of bytes of command output retained by :func:`runcmd` when
+#: running in streaming mode.
+TAIL_SIZE = 64 * 1024
+
+#: Number of seconds a timed-out process group is given to exit after being
+#: sent ``SIGTERM``, before it is sent ``SIGKILL``.
+KILL_GRACE = 10
+
 _REQUIRE_MODULES = {
     'six': {
         'centos': 'python-six',
@@ -68,6 +82,23 @@ class EnvironmentException(Exception):
     pass
 
 
+class CommandTimeout(EnvironmentException):
+    """
+    Raised by :func:`runcmd` when a command does not complete in time.
+
+    The `command` (argument list), the `elapsed` time in seconds and any
+    (possibly partial) `output` are available as attributes.
+    """
+    def __init__(self, command, elapsed, output=None):
+        super(CommandTimeout, self).__init__(
+            "Command timed out after {elapsed:.1f}s: {cmd}".format(
+                elapsed=elapsed, cmd=list_to_cmdline(command)),
+            output)
+        self.command = command
+        self.elapsed = elapsed
+        self.output = output
+
+
 def _check_prerequisites():
     """
     Validate the running environment for basic features that would make it
@@ -97,8 +128,218 @@ _check_prerequisites()
     full_distribution_name=0)
 _dist_name = _dist_name_.lower()
 
+# The system packaging tools lock their database, so only one of them may run
+# at once; this serialises install_package() calls made from different threads
+_install_lock = threading.Lock()
+
+
+class OutputTail(object):
+    """
+    Bounded buffer retaining the last `limit` bytes of command output.
+
+    Output is added a line at a time using :meth:`append`; once the buffer
+    holds more than `limit` bytes, the oldest lines are discarded. A single
+    line longer than `limit` is cut down to its last `limit` bytes. The
+    retained output is obtained using :meth:`getvalue`.
+    """
+    def __init__(self, limit=TAIL_SIZE):
+        super(OutputTail, self).__init__()
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        self.__lines = collections.deque()
+
+    def append(self, data):
+        """
+        Add a chunk of output (normally a single line) to the buffer.
+        """
+        if len(data) > self.limit:
+            data = data[-self.limit:]
+            self.truncated = True
+
+        self.__lines.append(data)
+        self.size += len(data)
+
+        while self.size > self.limit and len(self.__lines) > 1:
+            self.size -= len(self.__lines.popleft())
+            self.truncated = True
+
+    def getvalue(self):
+        """
+        Return the retained output as a single byte string.
+        """
+        return b''.join(self.__lines)
+
+
+class Watchdog(object):
+    """
+    Context manager enforcing a timeout on a running process.
+
+    If the :class:`subprocess.Popen` object `process` is still running
+    `timeout` seconds after the context is entered, its process group is sent
+    ``SIGTERM``, followed by ``SIGKILL`` if it has not finished `grace` seconds
+    later. The process must therefore have been started in its own process
+    group, for example using :data:`vortex.compat.new_session_kwargs`.
+
+    A `timeout` of ``None`` disables the watchdog entirely. After the context
+    exits, :attr:`expired` indicates whether the process was killed and
+    :attr:`elapsed` gives the time spent within the context.
+    """
+    def __init__(self, process, timeout, grace=KILL_GRACE):
+        super(Watchdog, self).__init__()
+        self.process = process
+        self.timeout = timeout
+        self.grace = grace
+        self.expired = False
+        self.elapsed = None
+        self.__done = threading.Event()
+        self.__timer = None
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = monotonic()
+        if self.timeout is not None:
+            self.__timer = threading.Timer(self.timeout, self.__expire)
+            self.__timer.daemon = True
+            self.__timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__done.set()
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.elapsed = monotonic() - self.__start
+        return False
+
+    def __kill(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError:
+            # The process group has already gone away
+            pass
+
+    def __expire(self):
+        # Called from the timer thread once the timeout has passed
+        if self.__done.is_set():
+            return
+
+        self.expired = True
+        logger.warning("Command timed out after {t}s; terminating pid {pid}"
+                       .format(t=self.timeout, pid=self.process.pid))
+        self.__kill(signal.SIGTERM)
+
+        self.__done.wait(self.grace)
+        if not self.__done.is_set():
+            logger.warning("Killing pid {pid}".format(pid=self.process.pid))
+            self.__kill(signal.SIGKILL)
+
+
+def decode_line(line):
+    """
+    Turn a raw line of command output (a byte string) into a text string
+    suitable for logging, stripping any trailing line ending.
+    """
+    return line.decode('utf-8', 'replace').rstrip('\r\n')
+
 
-def runcmd(args, env=None, cwd=None):
+class OutputPump(object):
+    """
+    Read lines from several pipes concurrently.
+
+    `pipes` is a dictionary mapping labels (for example ``'stdout'``) to
+    readable file objects, such as those obtained from a
+    :class:`subprocess.Popen` object. The pipes are switched to non-blocking
+    mode and read using :func:`select.select`, so that a command writing
+    heavily to one pipe cannot stall because nobody is reading the other.
+
+    `callback` is called with the label and the line (a byte string, including
+    its line ending) for each complete line read. Any incomplete final line is
+    passed to `callback` when its pipe is closed. If `callback` returns a true
+    value, :meth:`pump` returns once the data already read has been processed;
+    it may then be called again to carry on reading.
+
+    An incomplete line is not held back without limit: once it is longer than
+    `line_limit` bytes, all but the last :data:`PARTIAL_HOLD` bytes of it are
+    passed to `callback` (without a line ending) straight away.
+    """
+    #: Number of bytes at the end of an overlong incomplete line which are
+    #: held back, so that a short marker (such as the sentinel used by
+    #: :class:`vortex.deployment.exec.ExecHandler` session mode) arriving at
+    #: the end of a long line is never split
+    PARTIAL_HOLD = 1024
+
+    def __init__(self, pipes, callback, line_limit=TAIL_SIZE):
+        super(OutputPump, self).__init__()
+        self.callback = callback
+        self.line_limit = line_limit
+        self.__fds = {}
+        self.__partial = {}
+
+        for (label, pipe) in pipes.items():
+            fd = pipe.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.__fds[fd] = label
+            self.__partial[fd] = b''
+
+    def pump(self):
+        """
+        Read and dispatch lines until all the pipes are closed, or until the
+        callback asks us to stop.
+
+        Returns ``True`` if stopped at the callback's request, or ``False`` if
+        all the pipes have been closed.
+        """
+        fds = self.__fds
+        partial = self.__partial
+
+        while fds:
+            stop = False
+            (readable, _, _) = select.select(list(fds), [], [])
+
+            for fd in readable:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    raise
+
+                if not data:
+                    # End of file: flush any incomplete line and stop watching
+                    if partial[fd]:
+                        stop = self.callback(fds[fd], partial[fd]) or stop
+                    del fds[fd]
+                    continue
+
+                lines = (partial[fd] + data).split(b'\n')
+                partial[fd] = lines.pop()
+                for line in lines:
+                    stop = self.callback(fds[fd], line + b'\n') or stop
+
+                if len(partial[fd]) > self.line_limit:
+                    head = partial[fd][:-self.PARTIAL_HOLD]
+                    partial[fd] = partial[fd][-self.PARTIAL_HOLD:]
+                    stop = self.callback(fds[fd], head) or stop
+
+            if stop:
+                return True
+
+        return False
+
+
+def pump_output(pipes, callback):
+    """
+    Read lines from several pipes concurrently until they are all closed.
+
+    This is a convenience wrapper around :class:`OutputPump`; see there for a
+    description of the arguments.
+    """
+    OutputPump(pipes, callback).pump()
+
+
+def runcmd(args, env=None, cwd=None, stream=False, context=None,
+           timeout=None):
     """
     Simple wrapper around :class:`subprocess.Popen`.
 
@@ -116,9 +357,21 @@ def runcmd(args, env=None, cwd=None):
     * Standard input is always connected to ``/dev/null``.
     * Standard output and standard error are connected to the same pipe.
 
+    If `stream` is ``True``, the command's output is read incrementally as it
+    is produced and each line is sent to the logger at INFO level, prefixed
+    with `context` (for example a payload name) if given. Only the last
+    :data:`TAIL_SIZE` bytes of output are retained in memory, so arbitrarily
+    chatty commands may be run without holding all their output.
+
     This function returns a tuple consisting of (`returncode`, `output`), where
     `returncode` is the command's return code and `output` is the combination
-    of the commands standard output and standard error.
+    of the commands standard output and standard error. In streaming mode,
+    `output` is only the retained tail of the output.
+
+    If `timeout` is not ``None``, the command is run in its own process group
+    and is given `timeout` seconds to complete. If it does not, the whole
+    process group is terminated (see :class:`Watchdog`) and
+    :exc:`CommandTimeout` is raised.
     """
     if env is None:
         env = dict()
@@ -140,20 +393,55 @@ def runcmd(args, env=None, cwd=None):
         logger.debug("Running: env -i {env} {cmd}".format(
             env=debug_env, cmd=list_to_cmdline(args)))
 
+    # Only detach the command into its own process group if we might need to
+    # kill it, so that otherwise signals from the console still reach it.
+    popen_kw = new_session_kwargs if timeout is not None else {}
+
     with open(os.devnull, 'r') as devnull:
         p = subprocess.Popen(
             args,
             stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            close_fds=True, cwd=cwd, env=env)
-        output = p.communicate()[0]
+            close_fds=True, cwd=cwd, env=env, **popen_kw)
+
+        with Watchdog(p, timeout) as watchdog:
+            if stream:
+                output = _stream_output(p, context)
+            else:
+                output = p.communicate()[0]
+
+    if watchdog.expired:
+        raise CommandTimeout(args, watchdog.elapsed, output)
 
     return (p.returncode, output)
 
 
-def __apt_install(pkgs):
+def _stream_output(p, context):
+    # Read the output of the process a line at a time, logging each line as it
+    # arrives and keeping only a bounded tail for the caller.
+    tail = OutputTail()
+    prefix = "{ctx}: ".format(ctx=context) if context else ""
+
+    def handle_line(label, line):
+        tail.append(line)
+        logger.info(prefix + decode_line(line))
+
+    pump_output({'stdout': p.stdout}, handle_line)
+
+    p.stdout.close()
+    p.wait()
+
+    if tail.truncated:
+        logger.debug("{pfx}retained last {size} bytes of output".format(
+            pfx=prefix, size=tail.size))
+
+    return tail.getvalue()
+
+
+def __apt_install(pkgs, download_only=False):
     """
     Install package using apt-get, trying hard to get non-interactive behaviour
-    during the installation.
+    during the installation. If `download_only` is true, the packages are only
+    downloaded into Apt's package cache.
     """
     # Prevent apt-listchanges from doing anything, prevent debconf from asking
     # any questions. Either of these could block waiting for input from the
@@ -170,35 +458,40 @@ def __apt_install(pkgs):
         '-o', 'DPkg::Options::=--force-confold',
         'install',
     ]
+    if download_only:
+        args.append('--download-only')
     args.extend(pkgs)
 
-    (ret, out) = runcmd(args, env)
+    (ret, out) = runcmd(args, env, stream=True, context='apt-get')
 
     if ret != 0:
         raise EnvironmentException(
             "apt-get install failed: {ret}".format(ret=ret), out)
 
 
-def __yum_install(pkgs):
+def __yum_install(pkgs, download_only=False):
     """
     Install package using yum, trying hard to get non-interactive behaviour
-    during the installation.
+    during the installation. If `download_only` is true, the packages are only
+    downloaded into Yum's package cache.
     """
     args = [
         '/usr/bin/yum',
         '-d', '0', '-e', '0', '-y',
         'install',
     ]
+    if download_only:
+        args.append('--downloadonly')
     args.extend(pkgs)
 
-    (ret, out) = runcmd(args)
+    (ret, out) = runcmd(args, stream=True, context='yum')
 
     if ret != 0:
         raise EnvironmentException(
             "yum install failed: {ret}".format(ret=ret), out)
 
 
-def install_package(package):
+def install_package(package, download_only=False):
     """
     Helper to install a package on the system.
 
@@ -213,6 +506,15 @@ def install_package(package):
     :func:`platform.linux_distribution` with ``full_distribution_name=0``):
     when matched against the running system, the value of the entry (which may
     be a dictionary or list) is passed to the packaging tools.
+
+    If `download_only` is true, the packages (and their dependencies) are
+    downloaded into the packaging tools' cache but not installed, so that a
+    later installation need not download them. This is used when preparing a
+    machine image (see :mod:`vortex.prebake`).
+
+    The packaging tools can't run concurrently, so calls made at the same time
+    (for example by steps in a ``parallel`` deployment group) are run one
+    after another.
     """
     if isinstance(package, collections.Mapping):
         # Extract the package name(s) for this distribution
@@ -228,18 +530,19 @@ def install_package(package):
         package = [package]
 
     # Hand over the package list to the package manager function
-    if _dist_name in ['debian', 'ubuntu']:
-        logger.debug("Using Apt to install: {pkg}".format(
-            pkg=', '.join(package)))
-        __apt_install(package)
-    elif _dist_name in ['centos', 'redhat']:
-        logger.debug("Using Yum to install: {pkg}".format(
-            pkg=', '.join(package)))
-        __yum_install(package)
-    else:
-        raise EnvironmentException(
-            "Don't know how to install packages on {dist}".format(
-                dist=_dist_name))
+    with _install_lock:
+        if _dist_name in ['debian', 'ubuntu']:
+            logger.debug("Using Apt to install: {pkg}".format(
+                pkg=', '.join(package)))
+            __apt_install(package, download_only)
+        elif _dist_name in ['centos', 'redhat']:
+            logger.debug("Using Yum to install: {pkg}".format(
+                pkg=', '.join(package)))
+            __yum_install(package, download_only)
+        else:
+            raise EnvironmentException(
+                "Don't know how to install packages on {dist}".format(
+                    dist=_dist_name))
 
 
 def check_modules(install=False):
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Garbage collection for the persistent caches kept by Vortex.
+
+Every cache (see :mod:`vortex.cache`) beneath
+:attr:`vortex.runtime.Runtime.cache_dir` is subject to an overall size budget,
+and optionally to a quota of its own. When a cache or the caches as a whole
+are over budget, the least recently used entries are removed. Cache entries
+which are bare Git repositories (such as mirrors) are also tidied with
+``git gc --auto``.
+
+Garbage collection runs at the end of each successful :meth:`Runtime.run
+<vortex.runtime.Runtime.run>`, and may be run on its own using the
+:func:`vortex.gc` entry point (``python -m vortex gc``).
+
+The following configuration options are *optional*:
+
+``[gc].auto`` = ``yes``
+   Whether to collect garbage at the end of each run.
+
+``[gc].budget`` = ``4096``
+   The total size of all caches, in MiB.
+
+``[gc].tmp_age`` = ``3600``
+   Partially-written cache entries (left behind by an interrupted run) are
+   removed once they are older than this many seconds.
+
+``[gc].<cache>``
+   Any other option sets the quota, in MiB, of the cache of the same name.
+   For example, ``chunks = 1024`` limits the ``chunks`` cache to 1GiB.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import os
+import os.path
+import shutil
+import six
+import time
+
+from vortex.cache import Cache, disk_usage
+from vortex.compat import monotonic, scandir
+from vortex.config import cfg
+from vortex.environment import runcmd
+from vortex.runtime import runtime
+
+
+logger = logging.getLogger(__name__)
+
+#: Default values for the ``[gc]`` configuration section
+defaults = {
+    'auto': 'yes',
+    'budget': '4096',
+    'tmp_age': '3600',
+}
+
+#: Path to the git binary
+GIT = '/usr/bin/git'
+
+
+def _mib(option):
+    # Read a size in MiB from the [gc] section, returning bytes
+    try:
+        return int(cfg.get('gc', option)) * 1024 * 1024
+    except ValueError:
+        logger.warning("Ignoring invalid [gc].{opt}: {value}".format(
+            opt=option, value=cfg.get('gc', option)))
+        return None
+
+
+def caches():
+    """
+    Return a :class:`vortex.cache.Cache` for each cache directory which
+    currently exists.
+    """
+    try:
+        listing = list(scandir(runtime.cache_dir))
+    except OSError:
+        return []
+
+    return [Cache(entry.name) for entry in sorted(
+        listing, key=lambda entry: entry.name) if entry.is_dir()]
+
+
+def _remove_stale(cache, age):
+    # Remove temporary entries left behind by interrupted writes
+    reclaimed = 0
+    cutoff = time.time() - age
+
+    for entry in scandir(cache.path):
+        if not entry.name.endswith('.tmp'):
+            continue
+        try:
+            if os.lstat(entry.path).st_mtime > cutoff:
+                continue
+        except OSError:
+            continue
+
+        size = disk_usage(entry.path)
+        if os.path.isdir(entry.path) and not os.path.islink(entry.path):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                continue
+        reclaimed += size
+
+    return reclaimed
+
+
+def _tidy_repositories(cache):
+    # Run "git gc --auto" in any entries that are bare Git repositories
+    reclaimed = 0
+
+    if not os.path.isfile(GIT):
+        return reclaimed
+
+    for (key, mtime, size) in cache.entries():
+        path = cache.entry_path(key)
+        if not (os.path.isfile(os.path.join(path, 'HEAD')) and
+                os.path.isdir(os.path.join(path, 'objects'))):
+            continue
+
+        (ret, out) = runcmd([GIT, '--git-dir', path, 'gc', '--auto',
+                             '--quiet'])
+        if ret != 0:
+            logger.warning("git gc failed in {path}".format(path=path))
+            continue
+
+        # Don't let tidying a repository count as using it
+        os.utime(path, (mtime, mtime))
+        reclaimed += max(0, size - disk_usage(path))
+
+    return reclaimed
+
+
+def collect_garbage():
+    """
+    Collect garbage from all caches, as described above.
+
+    Returns a tuple of the number of bytes reclaimed and the number of seconds
+    taken.
+    """
+    for (option, value) in six.iteritems(defaults):
+        cfg.set_default('gc', option, value)
+
+    start = monotonic()
+    reclaimed = 0
+    budget = _mib('budget')
+    all_caches = caches()
+
+    try:
+        tmp_age = float(cfg.get('gc', 'tmp_age'))
+    except ValueError:
+        tmp_age = float(defaults['tmp_age'])
+
+    # Tidy each cache, and apply its own quota
+    for cache in all_caches:
+        reclaimed += _remove_stale(cache, tmp_age)
+        reclaimed += _tidy_repositories(cache)
+
+        if cfg.has_option('gc', cache.name) and cache.name not in defaults:
+            quota = _mib(cache.name)
+            if quota is not None:
+                reclaimed += cache.trim(quota)
+
+    # Then apply the overall budget, across all caches
+    if budget is not None:
+        entries = sorted(
+            ((mtime, cache, key, size)
+             for cache in all_caches
+             for (key, mtime, size) in cache.entries()),
+            key=lambda entry: entry[0])
+        used = sum(entry[3] for entry in entries)
+
+        for (mtime, cache, key, size) in entries:
+            if used <= budget:
+                break
+            logger.debug("Evicting {name} cache entry {key}".format(
+                name=cache.name, key=key))
+            cache.remove(key)
+            used -= size
+            reclaimed += size
+
+    elapsed = monotonic() - start
+    logger.info(
+        "Cache garbage collection reclaimed {n} bytes in {t:.2f}s".format(
+            n=reclaimed, t=elapsed))
+
+    return (reclaimed, elapsed)
+
+
+def auto_collect_garbage():
+    """
+    Call :func:`collect_garbage` if ``[gc].auto`` is enabled. Any errors are
+    logged rather than raised, since garbage collection is only housekeeping.
+    """
+    cfg.set_default('gc', 'auto', defaults['auto'])
+    if not cfg.getboolean('gc', 'auto'):
+        return
+
+    try:
+        collect_garbage()
+    except Exception:
+        logger.exception("Cache garbage collection failed")
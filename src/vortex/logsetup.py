@@ -42,11 +42,18 @@ stages of the Vortex runtime before the configuration file has been loaded.
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import io
 import logging
 import os
+import threading
 import vortex
 import vortex.syslog
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 #: Default values used unless overridden by the configuration
 defaults = {
@@ -140,3 +147,47 @@ def configure(cfg):
     except ValueError:
         syslogHandler.facility = vortex.syslog.facility(
             defaults['syslog_facility'])
+
+
+class AsyncFileWriter(object):
+    """
+    Write text to a file from a background thread.
+
+    Calls to :meth:`write` only place the text on a queue, so that callers
+    (for example code relaying the output of a chatty command) are never held
+    up waiting for the disk. The file at `path` is created (or truncated) when
+    the writer is constructed, and is written as UTF-8. :meth:`close` must be
+    called to flush the queue and close the file.
+    """
+    def __init__(self, path):
+        super(AsyncFileWriter, self).__init__()
+        self.path = path
+        self.__queue = queue.Queue()
+        self.__fp = io.open(path, 'w', encoding='utf-8')
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        # Write out queued text until we find the None sentinel
+        try:
+            while True:
+                text = self.__queue.get()
+                if text is None:
+                    break
+                self.__fp.write(text)
+        finally:
+            self.__fp.close()
+
+    def write(self, text):
+        """
+        Queue `text` to be written to the file.
+        """
+        self.__queue.put(text)
+
+    def close(self):
+        """
+        Wait for all queued text to be written, then close the file.
+        """
+        self.__queue.put(None)
+        self.__thread.join()
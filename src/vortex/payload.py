@@ -17,21 +17,131 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import atexit
+import functools
 import logging
 import os
 import os.path
+import shutil
+import threading
 
 from vortex.acquirer import Acquirer
+from vortex.compat import monotonic
 from vortex.config import cfg
-from vortex.deployment import Deployer
-from vortex.environment import runcmd
+from vortex.deployment import Deployer, Manifest
+from vortex.environment import CommandTimeout, decode_line, runcmd
+from vortex.release import ReleaseError, Releases
 from vortex.runtime import runtime
-from vortex.utils import cached_property
+from vortex.utils import cached_property, parse_timeout, run_concurrently
 
 
 logger = logging.getLogger(__name__)
 
 
+class AsyncHook(object):
+    """
+    A hook script running in the background.
+
+    Created by :meth:`Payload._call_hook` for hooks marked ``async``. The
+    script is run by :func:`vortex.environment.runcmd` (with the given
+    `timeout`) from a background thread, which is started immediately. All
+    such hooks are remembered, and :meth:`collect` waits for them to finish.
+    """
+    __running = []
+    __lock = threading.Lock()
+
+    def __init__(self, name, args, env, cwd, timeout):
+        super(AsyncHook, self).__init__()
+        self.name = name
+        self.args = args
+        self.env = env
+        self.cwd = cwd
+        self.timeout = timeout
+        self.result = None
+        self.error = None
+        self.elapsed = None
+
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+
+        with self.__lock:
+            if not self.__running:
+                # Make sure we wait for the hooks before the process exits
+                atexit.register(self.collect)
+            self.__running.append(self)
+
+        self.__thread.start()
+
+    def __run(self):
+        start = monotonic()
+        try:
+            self.result = runcmd(
+                self.args, env=self.env, cwd=self.cwd, timeout=self.timeout)
+        except Exception as e:
+            self.error = e
+        self.elapsed = monotonic() - start
+
+    def join(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for the hook to finish, returning whether
+        it has finished.
+        """
+        self.__thread.join(timeout)
+        return not self.__thread.is_alive()
+
+    def report(self):
+        """
+        Log the outcome of the (finished) hook.
+        """
+        if self.error is not None:
+            message = self.error.args[0] if self.error.args else self.error
+            logger.warning("{name}: async hook failed after {t:.1f}s: {e}"
+                           .format(name=self.name, t=self.elapsed, e=message))
+            return
+
+        (ret, out) = self.result
+        for line in out.splitlines():
+            logger.info("{name}: {line}".format(
+                name=self.name, line=decode_line(line)))
+
+        log = logger.info if ret == 0 else logger.warning
+        log("{name}: async hook exited {ret} after {t:.1f}s".format(
+            name=self.name, ret=ret, t=self.elapsed))
+
+    @classmethod
+    def collect(cls, deadline=None):
+        """
+        Wait for all outstanding async hooks to finish, and log their results.
+
+        Waits no longer than `deadline` seconds in total (defaulting to
+        ``[hooks].async_deadline``); hooks still running after that are
+        logged and abandoned. This is called automatically when the process
+        exits.
+        """
+        if deadline is None:
+            cfg.set_default('hooks', 'async_deadline',
+                            Payload.hook_defaults['async_deadline'])
+            deadline = parse_timeout(cfg.get('hooks', 'async_deadline'))
+
+        with cls.__lock:
+            hooks = list(cls.__running)
+            del cls.__running[:]
+
+        start = monotonic()
+        for hook in hooks:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - (monotonic() - start))
+
+            if hook.join(remaining):
+                hook.report()
+            else:
+                logger.warning(
+                    "{name}: async hook still running after {t:.1f}s; not "
+                    "waiting for it".format(
+                        name=hook.name, t=monotonic() - start))
+
+
 class Payload(object):
     """
     Represents a configured application payload.
@@ -58,7 +168,50 @@ class Payload(object):
            to configure the payload for a particular environment, for example
            using different settings for a development mode compared to a
            production environment.
+
+        ``release_dir``
+           Directory in which to keep releases of the payload. Each revision
+           is acquired into a new release directory and deployed from there,
+           and the ``current`` symlink in this directory is switched to it
+           once deployment succeeds. See :mod:`vortex.release`. By default the
+           payload is acquired into a temporary directory.
+
+        ``keep_releases`` = ``5``
+           The number of deployed releases to keep when ``release_dir`` is
+           set, for rolling back to.
+
+    The following configuration options for hook scripts are *optional*:
+
+        ``[hooks].parallel`` = ``no``
+           Whether to run the hook scripts for an event concurrently across
+           payloads. See :meth:`call_hooks`.
+
+        ``[hooks].workers`` = ``8``
+           The number of hook scripts which may run at the same time when
+           ``parallel`` is enabled.
+
+        ``[hooks].timeout`` = ``0``
+           The default number of seconds a hook script may run for before it
+           is killed. Zero means no timeout.
+
+        ``[hooks].async_timeout`` = ``300``
+           The default timeout for ``async`` hook scripts. Zero means no
+           timeout.
+
+        ``[hooks].async_deadline`` = ``60``
+           The number of seconds Vortex waits, when it is about to exit, for
+           any ``async`` hook scripts that are still running. Zero means wait
+           indefinitely.
     """
+    #: Default values for the ``[hooks]`` configuration section
+    hook_defaults = {
+        'async_deadline': '60',
+        'async_timeout': '300',
+        'parallel': 'no',
+        'timeout': '0',
+        'workers': '8',
+    }
+
     @classmethod
     def configured_payloads(cls):
         """
@@ -111,16 +264,83 @@ class Payload(object):
         successfully acquired, payloads then invokes them with the given method
         and any other optional arguments.
 
+        Hook scripts are normally run one after another, in payload order. If
+        ``[hooks].parallel`` is enabled, they are instead run concurrently,
+        and their output is logged once they have all finished, in payload
+        order. A payload may opt a hook out of concurrent running by setting
+        its ``serial`` option in the payload's hook options file (see
+        :class:`vortex.deployment.Manifest`), for example:
+
+        .. code-block:: yaml
+
+           post-deploy:
+             serial: true
+
+        A serial hook waits for all the hooks of preceding payloads to finish,
+        and the hooks of following payloads wait for it in turn.
+
+        The hook options file may also give the following options:
+
+            ``timeout``
+               The number of seconds the hook may run for before it is
+               killed, overriding ``[hooks].timeout`` (or
+               ``[hooks].async_timeout``).
+
+            ``async``
+               If true, the hook is started in the background and Vortex
+               carries on without waiting for it (see :class:`AsyncHook`). Its
+               outcome is logged when Vortex collects it before exiting, and
+               it is not included in the returned results.
+
         Returns a dictionary of payload names to execution results (as produced
         by :func:`vortex.environment.runcmd`.
         """
-        payloads = cls.configured_payloads()
+        for (option, value) in cls.hook_defaults.items():
+            cfg.set_default('hooks', option, value)
+
+        payloads = [
+            payload for payload in cls.configured_payloads()
+            if payload._has_hook(hook)]
         results = {}
 
-        for payload in payloads:
-            result = payload._call_hook(hook, method, *args)
-            if result is not None:
+        if not cfg.getboolean('hooks', 'parallel'):
+            for payload in payloads:
+                result = payload._call_hook(hook, method, *args)
+                if result is not None:
+                    results[payload.name] = result
+            return results
+
+        workers = cfg.getint('hooks', 'workers')
+        batch = []
+
+        def run_batch():
+            # Run the hooks in the batch concurrently, then report on them in
+            # payload order.
+            calls = [
+                functools.partial(
+                    payload._call_hook, hook, method, *args, stream=False)
+                for payload in batch]
+            for (payload, result) in zip(batch, run_concurrently(
+                    calls, workers)):
+                if result is None:
+                    continue
                 results[payload.name] = result
+                for line in result[1].splitlines():
+                    logger.info("{name}: {hook}: {line}".format(
+                        name=payload.name, hook=hook, line=decode_line(line)))
+            del batch[:]
+
+        for payload in payloads:
+            if payload._hook_option(hook, 'async', False):
+                payload._call_hook(hook, method, *args)
+            elif payload._hook_option(hook, 'serial', False):
+                run_batch()
+                result = payload._call_hook(hook, method, *args)
+                if result is not None:
+                    results[payload.name] = result
+            else:
+                batch.append(payload)
+        run_batch()
 
         return results
 
@@ -137,11 +357,19 @@ class Payload(object):
         ]
         defaults = {
             'environment': 'development',
+            'keep_releases': '5',
+            'release_dir': '',
         }
 
         # Validate the configuration and absorb the values into this object
         cfg.absorb(self, 'payload:' + self.name, required, defaults)
 
+        try:
+            self.keep_releases = int(self.keep_releases)
+        except ValueError:
+            raise ReleaseError("{name}: invalid keep_releases: {n}".format(
+                name=self.name, n=self.keep_releases))
+
     @cached_property
     def acquirer(self):
         """
@@ -153,6 +381,15 @@ class Payload(object):
         # Obtain an acquirer instance for the configured acquisition method
         return Acquirer.factory(self.acquire_method, section)
 
+    @cached_property
+    def revision(self):
+        """
+        The revision of the payload that will be acquired, as returned by
+        :meth:`vortex.acquirer.Acquirer.resolve_revision`, or ``None`` if it
+        cannot be determined in advance.
+        """
+        return self.acquirer.resolve_revision()
+
     @cached_property
     def deployer(self):
         """
@@ -160,17 +397,50 @@ class Payload(object):
         """
         return Deployer(self)
 
+    @cached_property
+    def manifest(self):
+        """
+        :class:`vortex.deployment.Manifest` listing the deployment
+        configuration and hook scripts in the acquired payload.
+
+        The manifest is built when first used after the payload has been
+        acquired, and is rebuilt if the payload is acquired again.
+        """
+        return Manifest(self.directory)
+
+    @cached_property
+    def releases(self):
+        """
+        :class:`vortex.release.Releases` managing the payload's release
+        directories, or ``None`` if ``release_dir`` is not set.
+        """
+        if not self.release_dir:
+            return None
+        return Releases(self.name, self.release_dir, self.keep_releases)
+
+    @cached_property
+    def release(self):
+        """
+        Path to the new release directory into which the payload will be
+        acquired, when ``release_dir`` is set.
+        """
+        return self.releases.new_release(self.revision)
+
     @property
     def directory(self):
         """
-        Path to a temporary holding directory into which the payload will be
-        acquired.
+        Path to a holding directory into which the payload will be acquired:
+        a new release directory if ``release_dir`` is set (see
+        :attr:`release`), otherwise a temporary directory.
 
         The directory is guaranteed *not* to exist until :meth:`acquire` is
         called. The parent directory *is* guaranteed to exist, however, so a
         simple :func:`os.mkdir` with the obtained path will be sufficient to
         create the payload directory.
         """
+        if self.releases is not None:
+            return self.release
+
         # We'll put all our payloads into a directory within our temporary
         # directory, so figure out its path and make sure the directory exists
         # before we use it.
@@ -181,6 +451,31 @@ class Payload(object):
         # Note: the payload directory itself is not automatically created
         return os.path.join(payloads, self.name)
 
+    def reset(self):
+        """
+        Forget any previous acquisition and deployment of the payload, so that
+        it can be acquired and deployed afresh.
+
+        The payload directory is removed (unless it is the current release),
+        and a new acquirer and deployer will be created when next needed, so
+        that the payload's revision is resolved again.
+        """
+        if self.releases is None:
+            directory = self.directory
+        else:
+            directory = self.__dict__.get('release')
+            if directory is not None and self.releases.is_current(directory):
+                directory = None
+
+        if directory is not None and os.path.isdir(directory):
+            shutil.rmtree(directory)
+
+        self.acquired = False
+        self.deployed = False
+        for attr in ('acquirer', 'deployer', 'manifest', 'release',
+                     'revision'):
+            self.__dict__.pop(attr, None)
+
     def acquire(self):
         """
         Acquire the payload data from its configured source.
@@ -200,19 +495,37 @@ class Payload(object):
             raise
 
         self.acquired = True
+        self.__dict__.pop('manifest', None)
 
         logger.info("Acquired payload {name}".format(name=self.name))
         self.call_hooks('post-acquire', 'payload', self.name)
 
+    def prepare(self):
+        """
+        Acquire the payload and prepare its deployment steps (see
+        :meth:`vortex.deployment.Deployer.prepare`), without deploying it.
+        This fills the persistent caches when preparing a machine image (see
+        :mod:`vortex.prebake`). No hook scripts are called.
+        """
+        logger.info("Preparing payload {name}".format(name=self.name))
+        self.acquirer.acquire_into(self.directory)
+        self.__dict__.pop('manifest', None)
+        self.deployer.prepare()
+        logger.info("Prepared payload {name}".format(name=self.name))
+
     def deploy(self):
         """
-        Run the payload's deployment scripts in order to deploy it.
+        Run the payload's deployment scripts in order to deploy it. If
+        ``release_dir`` is set, the new release is then made current.
         """
         logger.info("Deploying payload {name}".format(name=self.name))
         self.call_hooks('pre-deploy', 'payload', self.name)
 
         try:
             self.deployer.deploy()
+            if self.releases is not None:
+                self.releases.activate(self.directory)
+                self.releases.prune()
         except:
             logger.critical(
                 "Failed to deploy payload {name}".format(name=self.name))
@@ -224,33 +537,85 @@ class Payload(object):
         logger.info("Deployed payload {name}".format(name=self.name))
         self.call_hooks('post-deploy', 'payload', self.name)
 
-    def _call_hook(self, hook, method, *args):
+    def rollback(self):
+        """
+        Switch the payload back to its previous release, without running any
+        deployment steps. See :meth:`vortex.release.Releases.rollback`.
+
+        The caller must hold the run lock (see :mod:`vortex.runlock`), as
+        :func:`vortex.rollback` does, so that this can't race a deployment.
+        """
+        if self.releases is None:
+            raise ReleaseError("{name}: release_dir is not set".format(
+                name=self.name))
+
+        self.releases.rollback()
+        self.releases.prune()
+
+    def _has_hook(self, hook):
+        # Returns whether we have been successfully acquired and have a hook
+        # script with the given name.
+        return self.acquired and hook in self.manifest.hooks
+
+    def _hook_option(self, hook, option, default=None):
+        # Returns an option for the hook from the payload's hook options file
+        return self.manifest.hook_options.get(hook, {}).get(option, default)
+
+    def _call_hook(self, hook, method, *args, **kwargs):
         """
         Call a hook script resisiding within this payload.
 
         This method should not be used by consumers within Vortex: hook scripts
         in all payloads should be called for all hookable events, so only
         :meth:`call_hooks` should be used.
-        """
-        # Don't call hooks if we haven't been successfully acquired
-        if not self.acquired:
-            return None
 
-        hook = os.path.join(
-            self.directory, Deployer.CFG_DIRNAME, 'hooks', hook)
+        The hook's output is streamed to the logger as it is produced unless
+        the `stream` keyword argument is ``False``.
+        """
+        stream = kwargs.get('stream', True)
 
-        # Skip unless the hook is executable (and exists, etc...)
-        if not os.access(hook, os.R_OK | os.X_OK):
+        # Skip unless we've been successfully acquired and have an executable
+        # script for this hook
+        if not self._has_hook(hook):
             return None
 
-        script_args = [hook, method]
+        script_args = [self.manifest.hooks[hook], method]
         script_args.extend(args)
 
         env = {
             'VORTEX_ENVIRONMENT': self.environment,
         }
+        context = "{name}: {hook}".format(name=self.name, hook=hook)
 
+        is_async = self._hook_option(hook, 'async', False)
+        default_timeout = cfg.get(
+            'hooks', 'async_timeout' if is_async else 'timeout')
         try:
-            return runcmd(script_args, env=env, cwd=self.directory)
-        except:
+            timeout = parse_timeout(
+                self._hook_option(hook, 'timeout', default_timeout))
+        except ValueError:
+            logger.warning("{ctx}: invalid hook timeout".format(ctx=context))
+            timeout = parse_timeout(default_timeout)
+
+        if is_async:
+            AsyncHook(context, script_args, env, self.directory, timeout)
             return None
+
+        try:
+            result = runcmd(
+                script_args, env=env, cwd=self.directory, stream=stream,
+                context=context, timeout=timeout)
+        except CommandTimeout as e:
+            logger.warning("{ctx}: hook timed out after {t:.1f}s".format(
+                ctx=context, t=e.elapsed))
+            return None
+        except Exception as e:
+            logger.warning("{ctx}: hook failed to run: {e}".format(
+                ctx=context, e=e))
+            return None
+
+        if result[0] != 0:
+            logger.warning("{ctx}: hook exited {ret}".format(
+                ctx=context, ret=result[0]))
+
+        return result
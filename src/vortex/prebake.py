@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Preparation of machine images, and booting from a prepared image.
+
+Most of the time taken by a Vortex run at boot is spent downloading things:
+Vortex itself, its Python requirements, the payloads and the packages they
+install. When instances are started from a machine image built for the
+purpose, most of that work can be done once, while the image is being built,
+leaving only what has changed since to be done at boot.
+
+:func:`prepare` (the :func:`vortex.prepare` entry point, or ``python -m vortex
+prepare``) is run while building the image. It:
+
+* installs the Python modules Vortex requires, and byte-compiles Vortex
+  itself if it is installed as a directory (Eggs should be built with their
+  compiled files included);
+* resolves the revision of each payload and acquires it, filling the
+  persistent caches: the acquisition cache (see
+  :class:`vortex.acquirer.CachingAcquirer`) and the caches kept by the
+  acquirers themselves, such as Git mirrors (the ``mirror`` option of
+  :class:`vortex.acquirer.git.GitAcquirer`) and chunk stores;
+* downloads, but does not install, the packages the payloads' ``packages``
+  steps would install (see :meth:`vortex.deployment.Deployer.prepare`).
+
+Nothing is deployed, and no hook scripts are run. The revisions acquired are
+recorded in the ``prepared.json`` state file.
+
+:func:`finalize` (the :func:`vortex.finalize` entry point, or ``python -m
+vortex finalize``) is run at boot instead of :func:`vortex.stage2`. It
+revalidates the revision of each payload against the one prepared, then
+performs a normal run. Payloads which have not changed are copied out of the
+acquisition cache; for those which have, only the changes are downloaded
+where the acquisition method allows.
+
+For this to be effective, the state and cache directories (see
+:class:`vortex.runtime.Runtime`) must be kept in the image, the acquisition
+cache must be enabled, and the cache size budgets (``[acquirer].cache_size``
+and ``[gc].budget``) must be large enough to hold the prepared payloads.
+Enabling ``[bootstrap].cache`` (see :mod:`vortex.bootstrap`) also saves
+downloading Vortex itself again at boot.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import compileall
+import logging
+import os.path
+import time
+import vortex
+
+from vortex.acquirer import CachingAcquirer
+from vortex.config import cfg
+from vortex.payload import Payload
+from vortex.runtime import runtime
+from vortex.state import StateFile
+from vortex.throttle import splay
+
+
+logger = logging.getLogger(__name__)
+
+
+def compile_runtime():
+    """
+    Byte-compile the Vortex package, if it is installed as a directory of
+    source files (rather than, say, run from an Egg).
+    """
+    package = os.path.dirname(os.path.abspath(vortex.__file__))
+    if not os.path.isdir(package):
+        logger.info("Not byte-compiling Vortex in {path}".format(
+            path=package))
+        return
+
+    logger.info("Byte-compiling Vortex in {path}".format(path=package))
+    if not compileall.compile_dir(package, quiet=1):
+        logger.warning("Failed to byte-compile some of Vortex")
+
+
+def prepare():
+    """
+    Prepare a machine image, as described above. Returns ``True`` on success,
+    or ``False`` if any payload could not be prepared.
+    """
+    cfg.set_default('acquirer', 'cache', CachingAcquirer.defaults['cache'])
+    if not cfg.getboolean('acquirer', 'cache'):
+        logger.warning(
+            "The acquisition cache is disabled; most payloads will have to "
+            "be acquired again at boot.")
+
+    compile_runtime()
+
+    prepared = StateFile('prepared.json')
+    revisions = {}
+    success = True
+
+    for payload in Payload.configured_payloads():
+        try:
+            revisions[payload.name] = payload.revision
+            payload.prepare()
+        except Exception:
+            logger.exception("Failed to prepare payload {name}".format(
+                name=payload.name))
+            success = False
+
+    prepared.data['revisions'] = revisions
+    prepared.data['time'] = time.time()
+    prepared.save()
+
+    logger.info("Image preparation {result}.".format(
+        result='complete' if success else 'failed'))
+    return success
+
+
+def finalize():
+    """
+    Revalidate the payloads prepared in the image against their current
+    revisions, then perform a normal run (see
+    :meth:`vortex.runtime.Runtime.run`).
+    """
+    # Revalidation contacts the payload sources, so spread it out too
+    splay()
+
+    prepared = StateFile('prepared.json').data.get('revisions', {})
+    if not prepared:
+        logger.warning("This image was not prepared with vortex:prepare.")
+
+    for payload in Payload.configured_payloads():
+        try:
+            revision = payload.revision
+        except Exception:
+            logger.exception(
+                "Cannot resolve revision of payload {name}".format(
+                    name=payload.name))
+            revision = None
+
+        if revision is None:
+            logger.info("Payload {name} cannot be revalidated".format(
+                name=payload.name))
+        elif prepared.get(payload.name) == revision:
+            logger.info("Payload {name} is unchanged since preparation"
+                        .format(name=payload.name))
+        else:
+            logger.info("Payload {name} has changed since preparation"
+                        .format(name=payload.name))
+
+    runtime.run()
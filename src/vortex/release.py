@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Release directories for payloads.
+
+By default each payload is acquired into a temporary directory which is thrown
+away when Vortex exits. A payload may instead be given a release directory
+(the ``release_dir`` option of :class:`vortex.payload.Payload`), laid out as
+follows::
+
+    <release_dir>/
+        current -> releases/20261018T093000-5d41402abc4b
+        releases/
+            20261017T120000-7d793037a076/
+            20261018T093000-5d41402abc4b/
+
+Each acquisition of the payload goes into a new directory beneath
+``releases``, named after the time and the payload's revision, and the payload
+is deployed from there. Only once deployment has succeeded is the ``current``
+symbolic link switched to the new release. The switch is made by renaming a
+new link over the old one, so anything using ``current`` sees either the old
+release or the new one, never a mixture.
+
+A number of previously deployed releases are kept, so that ``current`` can be
+switched back to the previous release instantly (see :meth:`Releases.rollback`
+and :func:`vortex.rollback`). Releases whose deployment failed are removed
+when old releases are next pruned. The releases which have been made current
+are recorded, most recent last, in the ``releases/<payload>.json`` state file.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import time
+
+from vortex.state import StateFile
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReleaseError(Exception):
+    """
+    Problems raised while managing release directories.
+    """
+
+
+class Releases(object):
+    """
+    The release directories of the payload called `name`, kept in `path`.
+    At least `keep` releases which have been made current are kept.
+    """
+    #: Name of the symlink pointing at the current release
+    CURRENT = 'current'
+
+    #: Name of the directory containing the releases
+    RELEASES = 'releases'
+
+    def __init__(self, name, path, keep):
+        super(Releases, self).__init__()
+        self.name = name
+        self.path = os.path.abspath(path)
+        self.keep = max(1, keep)
+        self.releases_path = os.path.join(self.path, self.RELEASES)
+        self.current_path = os.path.join(self.path, self.CURRENT)
+        self.history = StateFile(os.path.join('releases', name + '.json'))
+
+    def new_release(self, revision):
+        """
+        Return the path of a new release directory for `revision` (which may
+        be ``None``). The directory does not exist yet, but its parent does.
+        """
+        if not os.path.isdir(self.releases_path):
+            os.makedirs(self.releases_path, 0o755)
+
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        tag = hashlib.sha256(revision.encode('utf-8')).hexdigest()[:12] \
+            if revision is not None else 'unknown'
+        base = os.path.join(self.releases_path, stamp + '-' + tag)
+
+        path = base
+        n = 0
+        while os.path.lexists(path):
+            n += 1
+            path = "{base}.{n}".format(base=base, n=n)
+
+        return path
+
+    def current(self):
+        """
+        Return the path of the current release, or ``None`` if there is none.
+        """
+        try:
+            target = os.readlink(self.current_path)
+        except OSError:
+            return None
+        return os.path.normpath(os.path.join(self.path, target))
+
+    def is_current(self, release):
+        """
+        Return whether `release` (a path) is the current release.
+        """
+        return self.current() == os.path.normpath(release)
+
+    def __switch(self, release):
+        # Atomically point the current symlink at release
+        if os.path.isdir(self.current_path) and \
+                not os.path.islink(self.current_path):
+            raise ReleaseError(
+                "{path} is a directory, not a symbolic link".format(
+                    path=self.current_path))
+
+        tmp = os.path.join(self.path, ".{cur}.{pid}.tmp".format(
+            cur=self.CURRENT, pid=os.getpid()))
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(os.path.relpath(release, self.path), tmp)
+        os.rename(tmp, self.current_path)
+
+    def activate(self, release):
+        """
+        Make `release` (a path) the current release.
+        """
+        self.__switch(release)
+
+        name = os.path.basename(release)
+        activated = [r for r in self.history.data.get('activated', [])
+                     if r != name]
+        activated.append(name)
+        self.history.data['activated'] = activated
+        self.history.save()
+
+        logger.info("{name}: current release is now {rel}".format(
+            name=self.name, rel=name))
+
+    def prune(self):
+        """
+        Remove all releases other than the current release and the most
+        recent :attr:`keep` releases which have been made current.
+        """
+        activated = [r for r in self.history.data.get('activated', [])
+                     if os.path.isdir(os.path.join(self.releases_path, r))]
+        keep = set(activated[-self.keep:])
+        current = self.current()
+        if current is not None:
+            keep.add(os.path.basename(current))
+
+        try:
+            names = os.listdir(self.releases_path)
+        except OSError:
+            names = []
+
+        for name in sorted(names):
+            if name in keep:
+                continue
+            logger.debug("{name}: removing release {rel}".format(
+                name=self.name, rel=name))
+            shutil.rmtree(
+                os.path.join(self.releases_path, name), ignore_errors=True)
+
+        self.history.data['activated'] = [r for r in activated if r in keep]
+        self.history.save()
+
+    def rollback(self):
+        """
+        Make the release which was current before the current one current
+        again, forgetting the current one (which will be removed when
+        releases are next pruned). Returns the path of the release now
+        current.
+
+        Only the ``current`` link is switched: no deployment steps are run.
+        A :exc:`ReleaseError` is raised if there is no earlier release.
+        """
+        current = self.current()
+        activated = [r for r in self.history.data.get('activated', [])
+                     if os.path.isdir(os.path.join(self.releases_path, r))]
+        if current is not None and os.path.basename(current) in activated:
+            activated = activated[:activated.index(os.path.basename(current))]
+
+        if not activated:
+            raise ReleaseError("{name}: no earlier release to roll back to"
+                               .format(name=self.name))
+
+        release = os.path.join(self.releases_path, activated[-1])
+        self.__switch(release)
+        self.history.data['activated'] = activated
+        self.history.save()
+
+        logger.info("{name}: rolled back to release {rel}".format(
+            name=self.name, rel=activated[-1]))
+        return release
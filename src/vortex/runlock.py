@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Serialisation of overlapping Vortex runs.
+
+Only one Vortex process may acquire and deploy payloads at a time; others
+wait for an exclusive :func:`fcntl.flock` lock in the state directory. Waiting
+runs are coalesced: each invocation registers a request (by incrementing a
+counter) before waiting, and a run, when it starts, covers every request
+registered so far. An invocation whose request was covered by a run which
+started while it was waiting simply reuses that run's result. However many
+invocations overlap, at most two runs take place: the one in progress, and
+one more covering everybody who arrived while it was running.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import fcntl
+import logging
+import os
+import os.path
+
+from vortex.runtime import runtime
+from vortex.state import StateFile
+
+
+logger = logging.getLogger(__name__)
+
+
+class RunLock(object):
+    """
+    Lock serialising Vortex runs, with request coalescing.
+
+    `name` names the lock files (``<name>.lock`` and ``<name>.state.lock``)
+    and the state file (``<name>.json``) used in the state directory.
+    """
+    def __init__(self, name='run'):
+        super(RunLock, self).__init__()
+        self.name = name
+        self.lock_path = os.path.join(runtime.state_dir, name + '.lock')
+        self.state_lock_path = os.path.join(
+            runtime.state_dir, name + '.state.lock')
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _flock(path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _update(self, func):
+        # Apply func to the run state while holding the state lock, saving
+        # any changes and returning func's result.
+        with self._flock(self.state_lock_path):
+            state = StateFile(self.name + '.json')
+            result = func(state.data)
+            state.save()
+            return result
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Context manager holding the run lock, without any coalescing. This is
+        for runs (such as those of :mod:`vortex.agent`) which only converge
+        some payloads, and so cannot stand in for a full run.
+        """
+        with self._flock(self.lock_path):
+            yield
+
+    def run(self, func):
+        """
+        Call `func` (with no arguments) while holding the run lock, and return
+        its result, unless a run which started after this call was made has
+        already completed, in which case its result is returned instead.
+        """
+        def register(data):
+            data['requested'] = data.get('requested', 0) + 1
+            return data['requested']
+
+        request = self._update(register)
+
+        if not self.__try_lock():
+            logger.info("Another Vortex run is in progress; waiting.")
+
+        with self._flock(self.lock_path):
+            done = self._update(lambda data: dict(data))
+            if done.get('completed', 0) >= request:
+                logger.info("Request satisfied by a concurrent run.")
+                return done.get('result')
+
+            # This run covers all requests registered so far
+            covers = done.get('requested', request)
+            result = func()
+
+            def complete(data):
+                data['completed'] = covers
+                data['result'] = result
+            self._update(complete)
+
+            return result
+
+    def __try_lock(self):
+        # Return whether the run lock is currently free (without taking it)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            os.close(fd)
@@ -19,12 +19,15 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import atexit
 import logging
+import os
+import os.path
 import shutil
 import sys
 import tempfile
 import vortex.logsetup
 
 from vortex.config import cfg
+from vortex.throttle import splay
 from vortex.utils import cached_property
 
 
@@ -37,6 +40,54 @@ else:
 
 
 class Runtime(object):
+    """
+    The Vortex runtime: the top-level object driving a Vortex run.
+
+    The following configuration options are *optional*:
+
+    ``[runtime].state_dir`` = ``/var/lib/vortex``
+       Directory in which Vortex keeps state between runs (see
+       :mod:`vortex.state`).
+
+    ``[runtime].cache_dir`` = ``/var/cache/vortex``
+       Directory in which Vortex keeps caches between runs (see
+       :mod:`vortex.cache`).
+    """
+    #: Default values for the ``[runtime]`` configuration section
+    defaults = {
+        'cache_dir': '/var/cache/vortex',
+        'state_dir': '/var/lib/vortex',
+    }
+
+    def _option(self, option):
+        # Obtain a [runtime] option from the configuration, or its default
+        cfg.set_default('runtime', option, self.defaults[option])
+        return cfg.get('runtime', option)
+
+    @cached_property
+    def state_dir(self):
+        """
+        Path to the directory in which state is kept between runs.
+
+        The directory is created (accessible only to the user running Vortex)
+        if it does not already exist.
+        """
+        path = self._option('state_dir')
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        return path
+
+    @cached_property
+    def cache_dir(self):
+        """
+        Path to the directory in which caches are kept between runs.
+
+        Unlike :attr:`state_dir`, the directory is not created here: caches
+        create their own directories when they first store something, and a
+        missing or unwritable cache directory merely disables caching.
+        """
+        return self._option('cache_dir')
+
     @cached_property
     def tmpdir(self):
         """
@@ -62,23 +113,28 @@ class Runtime(object):
 
         return tmpdir
 
-    def run(self):
+    def converge(self, payloads=None):
         """
-        Main runtime entry point.
-
-        Obtains and deploys the configured payloads.
+        Acquire and deploy payloads, returning ``True`` on success or ``False``
+        if any payload failed to be acquired or deployed.
+
+        `payloads` is a list of :class:`vortex.payload.Payload` objects to
+        converge; by default, all configured payloads. All the payloads are
+        acquired before any is deployed, so nothing is deployed if any payload
+        cannot be acquired.
+
+        The revision of each successfully deployed payload, as recorded by its
+        acquirer (see :attr:`vortex.acquirer.Acquirer.acquired_revision`, or
+        failing that :attr:`vortex.payload.Payload.revision`), is recorded in
+        the ``revisions.json`` state file, for use by :mod:`vortex.agent`.
         """
-        # First, configure logging
-        vortex.logsetup.configure(cfg)
-
-        # Tell the user something is happening
-        logger.info("Vortex runtime is starting up.")
-
         # Avoid circular module dependency
         from vortex.payload import Payload
+        from vortex.state import StateFile
 
         # Obtain all configured payloads
-        payloads = Payload.configured_payloads()
+        if payloads is None:
+            payloads = Payload.configured_payloads()
 
         # No point calling hooks because no payloads have yet been acquired
         logger.info("Payload acquisition commencing.")
@@ -90,10 +146,10 @@ class Runtime(object):
         try:
             for payload in payloads:
                 payload.acquire()
-        except:
+        except Exception:
             logger.critical("Payload acquisition failed. Aborting.")
             Payload.call_hooks('post-acquire', 'failed-payloads')
-            sys.exit(1)
+            return False
 
         logger.info("Payload acquisition complete.")
         Payload.call_hooks('post-acquire', 'payloads')
@@ -101,17 +157,53 @@ class Runtime(object):
         logger.info("Payload deployment commencing.")
         Payload.call_hooks('pre-deploy', 'payloads')
 
+        revisions = StateFile('revisions.json')
         try:
             for payload in payloads:
                 payload.deploy()
-        except:
+                revision = payload.acquirer.acquired_revision
+                if revision is None:
+                    revision = payload.revision
+                revisions.data[payload.name] = revision
+        except Exception:
             logger.critical("Payload deployment failed. Aborting.")
             Payload.call_hooks('post-deploy', 'failed-payloads')
-            sys.exit(1)
+            return False
+        finally:
+            revisions.save()
 
         logger.info("Payload deployment complete.")
         Payload.call_hooks('post-deploy', 'payloads')
 
+        return True
+
+    def run(self):
+        """
+        Main runtime entry point.
+
+        Obtains and deploys the configured payloads using :meth:`converge`,
+        exiting with status 1 if that fails. Overlapping runs are serialised
+        and coalesced using a :class:`vortex.runlock.RunLock`. The start may
+        be delayed to spread load across a fleet; see
+        :func:`vortex.throttle.splay`.
+        """
+        # First, configure logging
+        vortex.logsetup.configure(cfg)
+
+        # Tell the user something is happening
+        logger.info("Vortex runtime is starting up.")
+        splay()
+
+        # Avoid circular module dependency
+        from vortex.runlock import RunLock
+
+        if not RunLock().run(self.converge):
+            sys.exit(1)
+
+        # Keep the caches within their budgets
+        from vortex.housekeeping import auto_collect_garbage
+        auto_collect_garbage()
+
 #: Singleton instance of the Vortex Runtime class
 runtime = Runtime()
 
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Persistent state kept by Vortex between runs.
+
+State is stored as small JSON documents beneath the directory given by
+:attr:`vortex.runtime.Runtime.state_dir`.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import io
+import json
+import logging
+import os
+import os.path
+import six
+
+from vortex.runtime import runtime
+
+
+logger = logging.getLogger(__name__)
+
+
+class StateFile(object):
+    """
+    A JSON document persisted between Vortex runs.
+
+    `name` is the path of the file relative to the state directory, for
+    example ``steps/myapp.json``. The document is read when the object is
+    constructed and made available as the :attr:`data` dictionary; changes to
+    :attr:`data` are written back by calling :meth:`save`.
+
+    A missing or unreadable file is treated as empty, so that corrupt state
+    merely causes Vortex to redo work rather than fail.
+    """
+    def __init__(self, name):
+        super(StateFile, self).__init__()
+        self.path = os.path.join(runtime.state_dir, name)
+        self.data = self.__load()
+
+    def __load(self):
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            logger.warning("{path}: ignoring corrupt state file".format(
+                path=self.path))
+            return {}
+
+        if not isinstance(data, dict):
+            return {}
+
+        return data
+
+    def save(self):
+        """
+        Write :attr:`data` back to the file.
+
+        The file is written alongside its final location and then renamed
+        into place, so a crash part way through never leaves a truncated
+        file behind.
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        tmp = self.path + '.tmp'
+        with io.open(tmp, 'w', encoding='utf-8') as fp:
+            fp.write(six.text_type(
+                json.dumps(self.data, sort_keys=True, indent=1)))
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        """
+        Remove all data, deleting the file if it exists.
+        """
+        self.data = {}
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Protection for origin servers against a fleet of instances starting at once.
+
+When many instances are launched together (for example by an autoscaling
+group), they would otherwise all fetch Vortex and their payloads in the same
+second. Two mechanisms spread that load out:
+
+* A start delay (the *splay*, ``[runtime].splay``), applied once per boot
+  before Vortex is fetched or, when Vortex is not bootstrapped, before the run
+  starts. The boot is marked as splayed by creating :data:`SPLAYED_FILE` (on
+  ``/run``, which is emptied at boot); if that can't be created (when not
+  running as root, say), the splay is applied once per process instead. See
+  :func:`splay`.
+* A token bucket limiting the rate of requests to payload sources
+  (``[runtime].acquire_rate`` and ``[runtime].acquire_burst``). Every call to
+  :meth:`vortex.acquirer.Acquirer.acquire_into` or
+  :meth:`vortex.acquirer.Acquirer.resolve_revision` takes a token
+  (acquisitions satisfied from the acquisition cache, and revisions already
+  resolved, do not). See :func:`acquisition_bucket`.
+
+A further token bucket, counting bytes rather than acquisitions, caps the
+bandwidth used by acquisitions, so that large downloads do not saturate the
+network interface. The cap is the lower of ``[runtime].bandwidth`` (shared by
+all acquisitions in the process) and the acquirer's own ``bandwidth`` option.
+See :class:`BandwidthLimit`.
+
+Neither is random from run to run: both the splay and the initial level of the
+token bucket are derived from the instance's identity (see
+:func:`instance_identity`), so each host always waits for the same time, while
+different hosts wait for different times. The bootstrap script (see
+:mod:`vortex.bootstrap`) contains a stand-alone implementation of the same
+calculation.
+
+The following configuration options are *optional*:
+
+``[runtime].splay`` = ``0``
+   The maximum start delay, in seconds.
+
+``[runtime].acquire_rate`` = ``0``
+   The number of payload acquisitions allowed per second, on average. Zero
+   means no limit.
+
+``[runtime].acquire_burst`` = ``1``
+   The number of payload acquisitions allowed in quick succession before the
+   rate limit applies.
+
+``[runtime].bandwidth`` = ``0``
+   The maximum total download rate of acquisitions, in KiB/s. Zero means no
+   limit.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+from vortex.compat import monotonic
+from vortex.config import cfg
+
+
+logger = logging.getLogger(__name__)
+
+#: Default values for the ``[runtime]`` options used here
+defaults = {
+    'acquire_burst': '1',
+    'acquire_rate': '0',
+    'bandwidth': '0',
+    'splay': '0',
+}
+
+#: Files which may contain a unique, stable identifier for this instance
+IDENTITY_FILES = ('/etc/machine-id', '/var/lib/dbus/machine-id')
+
+#: Environment variable set once the splay has been applied, so that it is not
+#: applied again by a later stage of the same boot
+SPLAYED_ENV = 'VORTEX_SPLAYED'
+
+#: File created once the splay has been applied, so that later processes
+#: during the same boot don't apply it again. ``/run`` is emptied at boot.
+SPLAYED_FILE = '/run/vortex-splayed'
+
+#: Largest block acquirers should read from the network at once, so that each
+#: call to :meth:`BandwidthLimit.consume` waits for a short time only
+READ_SIZE = 64 * 1024
+
+
+def _option(option):
+    # Obtain a [runtime] option as a float, falling back to its default
+    cfg.set_default('runtime', option, defaults[option])
+    try:
+        return float(cfg.get('runtime', option))
+    except ValueError:
+        logger.warning("Ignoring invalid [runtime].{opt}: {value}".format(
+            opt=option, value=cfg.get('runtime', option)))
+        return float(defaults[option])
+
+
+def instance_identity():
+    """
+    Return a string identifying this instance: the systemd machine ID if there
+    is one, otherwise the host name.
+    """
+    for path in IDENTITY_FILES:
+        try:
+            with open(path) as f:
+                identity = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if identity:
+            return identity
+
+    return socket.gethostname()
+
+
+def host_fraction(purpose):
+    """
+    Return a number in the range [0, 1) which is fixed for this instance and
+    the given `purpose`, but uniformly distributed across instances.
+    """
+    seed = '{id}:{purpose}'.format(id=instance_identity(), purpose=purpose)
+    digest = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / float(1 << 32)
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket, which fills at `rate` tokens per second up to
+    a capacity of `burst` tokens, and initially holds `tokens` (by default, a
+    full bucket). A `rate` of zero means no limit.
+
+    Callers reserve tokens in turn, so the bucket level may become negative; a
+    caller asking for more tokens than the capacity simply waits longer.
+    """
+    def __init__(self, rate, burst=1, tokens=None):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst if tokens is None else float(tokens)
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n=1):
+        """
+        Take `n` tokens from the bucket, first waiting until they are
+        available. Returns the number of seconds waited.
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            wait = max(0.0, -self.tokens / self.rate)
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def splay():
+    """
+    Wait for this instance's share of ``[runtime].splay`` seconds, unless the
+    splay has already been applied during this boot (by the bootstrap script,
+    or an earlier run, for example). Returns the number of seconds waited.
+    """
+    delay = 0.0
+    if not (os.environ.get(SPLAYED_ENV) or os.path.exists(SPLAYED_FILE)):
+        os.environ[SPLAYED_ENV] = '1'
+        delay = _option('splay') * host_fraction('splay')
+        if delay > 0:
+            logger.info("Delaying start by {t:.1f}s (splay)".format(t=delay))
+            time.sleep(delay)
+
+    try:
+        with open(SPLAYED_FILE, 'a'):
+            pass
+    except (IOError, OSError):
+        # Without the marker, the splay applies once per process
+        pass
+
+    return delay
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _shared_bucket(name, create):
+    # Return the process-wide bucket called name, calling create to make it
+    with _buckets_lock:
+        if name not in _buckets:
+            _buckets[name] = create()
+        return _buckets[name]
+
+
+def acquisition_bucket():
+    """
+    Return the :class:`TokenBucket` shared by all acquisitions (and revision
+    lookups) in this process, created from the ``[runtime].acquire_rate`` and
+    ``[runtime].acquire_burst`` options. Its initial level is this instance's
+    share of a full bucket (see :func:`host_fraction`).
+    """
+    def create():
+        burst = max(1.0, _option('acquire_burst'))
+        return TokenBucket(_option('acquire_rate'), burst,
+                           tokens=burst * host_fraction('acquire'))
+
+    return _shared_bucket('acquire', create)
+
+
+def bandwidth_bucket():
+    """
+    Return the :class:`TokenBucket`, counting bytes, shared by all
+    acquisitions in this process and limiting them to
+    ``[runtime].bandwidth``.
+    """
+    def create():
+        rate = _option('bandwidth') * 1024
+        return TokenBucket(rate, max(1.0, rate))
+
+    return _shared_bucket('bandwidth', create)
+
+
+class BandwidthLimit(object):
+    """
+    Limits the rate at which an acquirer downloads data to
+    ``[runtime].bandwidth`` and to its own `rate` (in KiB/s, zero meaning no
+    limit), and measures the throughput achieved.
+
+    Acquirers call :meth:`consume` for each block (of at most
+    :data:`READ_SIZE` bytes) of data downloaded (passing the object as the
+    `throttle` of a :class:`vortex.archive.HashingReader` does this), or
+    :meth:`record` for data transferred by other means.
+    """
+    def __init__(self, rate=0):
+        super(BandwidthLimit, self).__init__()
+        rate = float(rate) * 1024
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def limit(self):
+        """
+        The effective limit in bytes per second, or zero if there is none.
+        """
+        rates = [rate for rate in (self.bucket.rate, bandwidth_bucket().rate)
+                 if rate > 0]
+        return min(rates) if rates else 0
+
+    def reset(self):
+        """
+        Reset the throughput measurements.
+        """
+        with self.lock:
+            self.bytes = 0
+            self.delayed = 0.0
+            self.start = monotonic()
+
+    def record(self, n):
+        """
+        Count `n` bytes as transferred, without waiting.
+        """
+        with self.lock:
+            self.bytes += n
+
+    def consume(self, n):
+        """
+        Count `n` bytes as transferred, first waiting as long as the bandwidth
+        limits require.
+        """
+        waited = bandwidth_bucket().consume(n) + self.bucket.consume(n)
+        with self.lock:
+            self.bytes += n
+            self.delayed += waited
+
+    def report(self):
+        """
+        Return a dictionary of the throughput measurements since the last
+        :meth:`reset`: the number of ``bytes`` transferred, the ``seconds``
+        taken, the resulting ``rate`` in bytes per second, and the number of
+        seconds spent ``delayed`` by the limits.
+        """
+        with self.lock:
+            elapsed = monotonic() - self.start
+            return {
+                'bytes': self.bytes,
+                'delayed': round(self.delayed, 3),
+                'rate': int(self.bytes / max(elapsed, 0.001)),
+                'seconds': round(elapsed, 3),
+            }
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Tiger Computing Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Push notifications for the Vortex agent.
+
+When ``[agent].listen`` is set, the agent (see :mod:`vortex.agent`) accepts
+HTTP requests on a Unix socket or a local TCP port telling it that a payload
+has changed, and starts an incremental run for that payload straight away
+rather than waiting for its next periodic cycle.
+
+The listen address is given as ``unix:<path>`` or ``tcp:<host>:<port>``. The
+following requests are accepted:
+
+``POST /notify/<payload>``
+   The named payload has changed.
+
+``POST /notify``
+   Any payload may have changed.
+
+Any request body is ignored, so a webhook relay can simply be pointed at the
+URL. For example::
+
+    curl -X POST --unix-socket /run/vortex.sock http://localhost/notify/myapp
+
+The :func:`notify` function (also available as ``python -m vortex notify
+[payload...]``) sends the same requests to the configured address.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import errno
+import logging
+import os
+import socket
+import stat
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import quote, unquote
+
+from vortex.config import cfg
+
+
+logger = logging.getLogger(__name__)
+
+#: URL path prefix for notifications
+NOTIFY_PATH = '/notify'
+
+
+def parse_address(address):
+    """
+    Parse a listen address, returning a tuple of the socket family and the
+    address to bind or connect to. A :exc:`ValueError` is raised if the
+    address is not understood.
+    """
+    if address.startswith('unix:'):
+        return (socket.AF_UNIX, address[len('unix:'):])
+    if address.startswith('/'):
+        return (socket.AF_UNIX, address)
+    if address.startswith('tcp:'):
+        (host, port) = address[len('tcp:'):].rsplit(':', 1)
+        return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+
+    raise ValueError("Unknown listen address: {addr}".format(addr=address))
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Handles notification requests, passing them on to the agent
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == NOTIFY_PATH:
+            names = None
+        elif path.startswith(NOTIFY_PATH + '/'):
+            names = [unquote(path[len(NOTIFY_PATH) + 1:])]
+        else:
+            self.send_error(404)
+            return
+
+        self.server.agent.trigger(names)
+
+        body = b'queued\n'
+        self.send_response(202)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Trigger request: " + format % args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port)-style client address
+        (request, address) = self.socket.accept()
+        return (request, ('unix', 0))
+
+
+def _remove_stale_socket(path):
+    # Remove a Unix socket left behind by an agent which is no longer running.
+    # Raises socket.error if there is something else at the path, or if
+    # another agent is still listening on the socket.
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        raise socket.error(errno.EEXIST, "{path} exists and is not a socket"
+                           .format(path=path))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        logger.info("Removing stale socket {path}".format(path=path))
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+
+    raise socket.error(errno.EADDRINUSE, "Another agent is listening on "
+                       "{path}".format(path=path))
+
+
+class TriggerListener(object):
+    """
+    Accepts notifications at `address` (see :func:`parse_address`) on a
+    background thread, passing each one to ``agent.trigger()``.
+
+    Unix sockets are created accessible only to the user running Vortex. A
+    stale socket left behind by a previous agent is replaced, but a
+    :exc:`socket.error` is raised if anything else is at the path, or if
+    another agent is still listening on it.
+    """
+    def __init__(self, agent, address):
+        super(TriggerListener, self).__init__()
+        (family, bind) = parse_address(address)
+
+        if family == socket.AF_UNIX:
+            _remove_stale_socket(bind)
+            umask = os.umask(0o077)
+            try:
+                self.server = _UnixServer(bind, _Handler)
+            finally:
+                os.umask(umask)
+        else:
+            self.server = _TCPServer(bind, _Handler)
+
+        self.address = address
+        self.path = bind if family == socket.AF_UNIX else None
+        self.server.agent = agent
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        """
+        Start accepting notifications.
+        """
+        self.thread.start()
+        logger.info("Listening for notifications on {addr}".format(
+            addr=self.address))
+
+    def close(self):
+        """
+        Stop accepting notifications.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def notify(payloads=None, address=None, timeout=10):
+    """
+    Tell the agent listening at `address` (by default, ``[agent].listen``)
+    that the named `payloads` have changed, or that any payload may have
+    changed if `payloads` is empty. A :exc:`socket.error` is raised if the
+    agent cannot be reached, or an :exc:`IOError` if it rejects the request.
+    A :exc:`ValueError` is raised if there is no address to use.
+    """
+    if address is None and cfg.has_option('agent', 'listen'):
+        address = cfg.get('agent', 'listen')
+    if not address:
+        raise ValueError("No agent listen address is configured")
+    (family, target) = parse_address(address)
+
+    paths = [NOTIFY_PATH + '/' + quote(name, safe='') for name in payloads] \
+        if payloads else [NOTIFY_PATH]
+
+    for path in paths:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(target)
+            sock.sendall(
+                "POST {path} HTTP/1.0\r\nHost: localhost\r\n"
+                "Content-Length: 0\r\n\r\n".format(path=path).encode('utf-8'))
+            response = sock.makefile('rb').read().decode('latin-1')
+            status = response.split('\n', 1)[0]
+        finally:
+            sock.close()
+
+        if status.split()[1:2] != ['202']:
+            raise IOError("Notification {path} rejected: {status}".format(
+                path=path, status=status.strip()))
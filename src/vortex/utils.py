@@ -17,7 +17,31 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
-from vortex.compat import shell_quote
+import errno
+import io
+import os
+import os.path
+import shutil
+import stat
+import six
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from vortex.compat import scandir, shell_quote
+
+#: The Linux ``FICLONE`` ioctl, which makes a file share the data blocks of
+#: another (a "reflink" copy) on filesystems that support it.
+FICLONE = 0x40049409
+
+#: Errors meaning that a fast copying method isn't supported for a file
+_UNSUPPORTED = frozenset(
+    getattr(errno, name) for name in
+    ('EBADF', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EOPNOTSUPP', 'EPERM', 'EXDEV')
+    if hasattr(errno, name))
 
 
 # class cached_property is
@@ -58,3 +82,200 @@ def list_to_cmdline(seq):
     components distinct.
     """
     return ' '.join(shell_quote(x) for x in seq)
+
+
+def parse_timeout(value):
+    """
+    Parse a timeout value (in seconds) from the configuration.
+
+    Returns a positive :class:`float`, or ``None`` if `value` is empty, zero or
+    negative (meaning "no timeout"). A :exc:`ValueError` is raised if `value`
+    is not a number.
+    """
+    if value is None or value == '':
+        return None
+
+    timeout = float(value)
+    if timeout <= 0:
+        return None
+
+    return timeout
+
+
+def parse_boolean(value):
+    """
+    Parse a boolean option value from a deployment configuration.
+
+    Returns `value` itself if it is a :class:`bool`; strings are interpreted as
+    :meth:`vortex.config.VortexConfiguration.getboolean` would. A
+    :exc:`ValueError` is raised for anything else.
+    """
+    if isinstance(value, bool):
+        return value
+
+    if isinstance(value, six.string_types):
+        lowered = value.strip().lower()
+        if lowered in ('1', 'yes', 'true', 'on'):
+            return True
+        if lowered in ('0', 'no', 'false', 'off'):
+            return False
+
+    raise ValueError("Not a boolean: {v!r}".format(v=value))
+
+
+def is_within(path, directory):
+    """
+    Return whether `path`, once any symlinks in it are resolved, is
+    `directory` or lies beneath it.
+    """
+    root = os.path.realpath(directory)
+    path = os.path.realpath(path)
+    return path == root or path.startswith(root + os.sep)
+
+
+def run_concurrently(funcs, workers):
+    """
+    Call each of the callables in `funcs` using a pool of up to `workers`
+    threads, and return a list of their results in the same order.
+
+    If any of the callables raises an exception, no further callables are
+    started; once those already running have finished, the exception raised
+    by the earliest failing callable in `funcs` is re-raised.
+    """
+    funcs = list(funcs)
+    results = [None] * len(funcs)
+    errors = {}
+    lock = threading.Lock()
+    state = {'next': 0}
+
+    def worker():
+        while True:
+            with lock:
+                i = state['next']
+                if i >= len(funcs) or errors:
+                    return
+                state['next'] = i + 1
+
+            try:
+                results[i] = funcs[i]()
+            except Exception as e:
+                with lock:
+                    errors[i] = e
+
+    threads = [
+        threading.Thread(target=worker)
+        for _ in range(max(1, min(workers, len(funcs))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[min(errors)]
+
+    return results
+
+
+class _TreeCopier(object):
+    # Copies files using the cheapest method available, remembering which
+    # methods fail so that they aren't retried for every file.
+    def __init__(self, link):
+        self.try_link = link
+        self.try_reflink = fcntl is not None
+        self.try_range = hasattr(os, 'copy_file_range')
+        self.counts = {'linked': 0, 'reflinked': 0, 'copied': 0}
+
+    def _reflink(self, fsrc, fdst):
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            self.try_reflink = False
+            return False
+
+    def _copy_range(self, fsrc, fdst, size):
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copied:
+                raise
+            self.try_range = False
+            return False
+
+    def copy_file(self, src, dst, st):
+        if self.try_link:
+            try:
+                os.link(src, dst)
+                self.counts['linked'] += 1
+                return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                self.try_link = False
+
+        with io.open(src, 'rb') as fsrc:
+            with io.open(dst, 'wb') as fdst:
+                if self.try_reflink and self._reflink(fsrc, fdst):
+                    self.counts['reflinked'] += 1
+                elif self.try_range and \
+                        self._copy_range(fsrc, fdst, st.st_size):
+                    self.counts['copied'] += 1
+                else:
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+                    self.counts['copied'] += 1
+
+        shutil.copystat(src, dst)
+
+    def copy_tree(self, src, dst):
+        if not os.path.isdir(dst):
+            os.mkdir(dst)
+
+        for entry in scandir(src):
+            path = os.path.join(dst, entry.name)
+            st = os.lstat(entry.path)
+
+            if stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(entry.path), path)
+            elif stat.S_ISDIR(st.st_mode):
+                self.copy_tree(entry.path, path)
+            elif stat.S_ISREG(st.st_mode):
+                self.copy_file(entry.path, path, st)
+
+        shutil.copystat(src, dst)
+
+
+def copy_tree(src, dst, link=False):
+    """
+    Copy the directory tree `src` to `dst` as cheaply as possible, preserving
+    permissions, modification times and symbolic links (which are copied as
+    links). `dst` is created if it does not exist. Special files (devices,
+    sockets and FIFOs) are skipped.
+
+    Each file is copied using the first of these methods which works:
+
+    * If `link` is true, the file is hard-linked. The copy then shares the
+      original's inode, so this must only be used when neither tree will be
+      modified in place.
+    * A reflink (``FICLONE``), which shares data blocks copy-on-write on
+      filesystems such as Btrfs and XFS, and so takes no time or space.
+    * :func:`os.copy_file_range` (Python >= 3.8), which copies within the
+      kernel and may itself use reflinks or server-side copies.
+    * A plain read and write.
+
+    Once a method fails as unsupported it is not tried again for the rest of
+    the tree. Returns a dictionary giving the number of files ``linked``,
+    ``reflinked`` and ``copied``.
+    """
+    copier = _TreeCopier(link)
+    copier.copy_tree(src, dst)
+    return copier.counts